@@ -0,0 +1,107 @@
+""" Generate.py:
+    Makes synthetic project csv files for the benchmarks, in the layout the importer
+    reads. The status mix and memoranda sizes are roughly those of the real thing:
+    mostly short notes, with a long tail that goes over MEMO_THRESHOLD. The same
+    size and seed always give the same file.
+    usage: python generate.py ROWS FILENAME [--seed N]
+    """
+
+import argparse
+import csv
+import datetime
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import model  # pylint: disable=wrong-import-position
+
+# Share of projects in each status
+STATUS_MIX = {"todo": 0.34, "done": 0.30, "paused": 0.19, "active": 0.10, "habit": 0.07}
+
+# Memoranda: this share have none, and the rest have a log-normal length in bytes,
+# with this median and spread. About one in twenty goes over 4KB.
+NO_MEMO = 0.2
+MEMO_MEDIAN = 300
+MEMO_SIGMA = 1.6
+MEMO_MAX = 65536
+
+# Projects are created over these years
+FIRST_YEAR = 2010
+LAST_YEAR = 2024
+
+WORDS = ("idea project build write learn fix garden kitchen bike guitar python flask "
+         "database cache index search paint shed fence novel chapter recipe bread "
+         "coffee camera photo album trip map walk run swim train clock radio lamp "
+         "desk shelf book notes letter game puzzle chess model robot sensor garden "
+         "compost seeds tomato herbs window door roof gutter paint wall tile floor").split()
+
+
+def _words(rng, length):
+    """ Text of about length bytes, made of WORDS """
+    text = []
+    size = 0
+    while size < length:
+        word = rng.choice(WORDS)
+        text.append(word)
+        size = size + len(word) + 1
+    return " ".join(text)
+
+
+def _date(minutes):
+    """ A date in the csv's format, from minutes since the start of FIRST_YEAR,
+    or blank for None """
+    if minutes is None:
+        return ""
+    when = datetime.datetime(FIRST_YEAR, 1, 1) + datetime.timedelta(minutes=minutes)
+    return when.strftime(model.CSV_DATE_FORMAT)
+
+
+def project(rng, number):
+    """ One synthetic project
+    ::parameter rng: random.Random
+    ::parameter number: its project number
+    ::returns list of values, in model.CSV_COLUMNS order """
+    span = (LAST_YEAR - FIRST_YEAR + 1) * 365 * 24 * 60
+    created = rng.randrange(span)
+    status = rng.choices(list(STATUS_MIX), weights=list(STATUS_MIX.values()))[0]
+    started = stopped = done = None
+    if status in ("active", "paused", "done"):
+        started = created + rng.randrange(span - created + 1)
+    if status == "paused":
+        stopped = started + rng.randrange(span - started + 1)
+    if status == "done":
+        done = started + rng.randrange(span - started + 1)
+    modified = max(stamp for stamp in (created, started, stopped, done) if stamp is not None)
+
+    memo = None
+    if rng.random() >= NO_MEMO:
+        length = min(MEMO_MAX, int(rng.lognormvariate(math.log(MEMO_MEDIAN), MEMO_SIGMA)))
+        memo = _words(rng, length)
+    return [number, _words(rng, rng.randint(10, 60)), _date(created), _date(done),
+            _date(started), _date(stopped), 1 if status == "habit" else 0,
+            f"https://example.com/{number}" if rng.random() < 0.3 else "",
+            memo or "", _date(modified)]
+
+
+def generate(filename, rows, seed=1):
+    """ Write a csv file of synthetic projects, a row at a time
+    ::parameter filename: where to write it
+    ::parameter rows: how many projects
+    ::parameter seed: for the random numbers """
+    rng = random.Random(seed)
+    with open(filename, "w", newline="", encoding="utf-8") as out:
+        writer = csv.writer(out)
+        writer.writerow(model.CSV_COLUMNS)
+        for number in range(1, rows + 1):
+            writer.writerow(project(rng, number))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="writes a csv file of synthetic projects")
+    parser.add_argument("rows", type=int, help="how many projects")
+    parser.add_argument("filename", help="csv file to write")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default 1)")
+    options = parser.parse_args()
+    generate(options.filename, options.rows, options.seed)
@@ -0,0 +1,333 @@
+""" Run.py:
+    Benchmarks the importer and every route, on sqlite3 and on dynamodb (the
+    in-memory stand-in from memtable.py, so no AWS account or capacity is needed),
+    at each size asked for. Datasets come from generate.py and are kept in
+    benchmarks/data, so a rerun with the same sizes and seed loads the same rows.
+    Each backend and size runs in a process of its own, with its own database files,
+    through the importer and then the Flask test client: times are the app's own,
+    with no web server or network in them. Results are written as json, to compare
+    one run with another with --baseline.
+    usage: python run.py [--sizes 1000,100000] [--backends sqlite3,dynamodb]
+                         [--requests N] [--output FILE] [--baseline FILE]
+    """
+
+import argparse
+import contextlib
+import datetime
+import html.parser
+import io
+import json
+import os
+import platform
+import random
+import runpy
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# generate puts the app's directory on the path, for model; run uses it for the rest
+import generate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, os.pardir)
+DATA_DIR = os.path.join(HERE, "data")
+RESULTS_DIR = os.path.join(HERE, "results")
+
+BACKENDS = ("sqlite3", "dynamodb")
+
+# Name and path of each route timed; {number} is a different project each request,
+# and {word} a different search
+GET_ROUTES = (
+    ("home", "/"),
+    ("paused", "/paused"),
+    ("todo", "/todo"),
+    ("done", "/done"),
+    ("list", "/list"),
+    ("habits", "/habits"),
+    ("timeline", "/timeline?on=done&from=2023-01-01&to=2023-03-31"),
+    ("project", "/project/{number}"),
+    ("edit_form", "/project/{number}/edit"),
+    ("new_form", "/project/new"),
+    ("search", "/search?q={word}"),
+    ("stats", "/stats"),
+    ("stats_json", "/stats.json"),
+    ("metrics", "/metrics"),
+)
+
+
+class FormReader(html.parser.HTMLParser):
+    """ Reads the fields of the project form, as a browser would submit them """
+
+    def __init__(self):
+        super().__init__()
+        self.fields = {}
+        self.textarea = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "input" and attrs.get("name"):
+            if attrs.get("type") != "radio" or "checked" in attrs:
+                self.fields[attrs["name"]] = attrs.get("value") or ""
+        elif tag == "textarea":
+            self.textarea = attrs.get("name")
+            self.fields[self.textarea] = ""
+
+    def handle_data(self, data):
+        if self.textarea:
+            self.fields[self.textarea] = self.fields[self.textarea] + data
+
+    def handle_endtag(self, tag):
+        if tag == "textarea":
+            self.textarea = None
+
+
+def form_fields(page):
+    """ The project form's fields, from a rendered edit page """
+    reader = FormReader()
+    reader.feed(page)
+    return {name: "" if value == "None" else value for name, value in reader.fields.items()}
+
+
+def summary(times, elapsed):
+    """ Latency and throughput of a set of requests
+    ::parameter times: seconds for each request
+    ::parameter elapsed: seconds for the lot, the test client's own time included
+    ::returns dict """
+    times = sorted(times)
+    millis = [seconds * 1000 for seconds in times]
+    return {'requests': len(times),
+            'mean_ms': round(statistics.mean(millis), 3),
+            'p50_ms': round(statistics.median(millis), 3),
+            'p95_ms': round(millis[min(len(millis) - 1, int(len(millis) * 0.95))], 3),
+            'max_ms': round(millis[-1], 3),
+            'requests_per_second': round(len(times) / elapsed, 1)}
+
+
+def time_requests(call, count, warmup):
+    """ Time call, count times, after warmup untimed calls
+    ::parameter call: function taking the request's index, making one request
+    ::returns summary, with the time of the first (cold) request added """
+    start = time.perf_counter()
+    call(-1)
+    first = time.perf_counter() - start
+    for index in range(warmup):
+        call(index - warmup)
+    times = []
+    began = time.perf_counter()
+    for index in range(count):
+        start = time.perf_counter()
+        call(index)
+        times.append(time.perf_counter() - start)
+    result = summary(times, time.perf_counter() - began)
+    result['first_ms'] = round(first * 1000, 3)
+    return result
+
+
+def check(response, path, expected=200):
+    """ Read a response to the end, as a browser would, and fail unless it has the
+    status expected: a form that's been saved redirects, one that hasn't doesn't """
+    response.get_data()
+    if response.status_code != expected:
+        raise RuntimeError(f"{path} returned {response.status_code}")
+    return response
+
+
+def import_csv(backend, filename, sqlite_path):
+    """ Load a dataset with the importer, as the command line would
+    ::returns seconds taken """
+    argv = sys.argv
+    cwd = os.getcwd()
+    sys.argv = ["data_import.py", backend, filename, "-q", "--sqlite-path", sqlite_path]
+    os.chdir(os.path.join(ROOT, "data-import"))
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            runpy.run_path("data_import.py", run_name="__main__")
+        return time.perf_counter() - start
+    finally:
+        sys.argv = argv
+        os.chdir(cwd)
+
+
+def time_edits(client, numbers, options):
+    """ Time saving an edit, as time_requests does. Only the post is timed: the
+    form is fetched before the clock starts, as a browser would already have it. """
+    times = []
+    for index in range(-1 - options.warmup, options.requests):
+        path = f"/project/{numbers[index]}/edit"
+        fields = form_fields(check(client.get(path), path).get_data(as_text=True))
+        fields['idea'] = f"Benchmark edit {index}"
+        start = time.perf_counter()
+        check(client.post(path, data=fields), path, 302)
+        times.append(time.perf_counter() - start)
+    timed = times[options.warmup + 1:]
+    return dict(summary(timed, sum(timed)), first_ms=round(times[0] * 1000, 3))
+
+
+def bench_routes(client, rows, options):
+    """ Time each route, then an edit and a new project
+    ::returns dict of route name: summary """
+    rng = random.Random(options.seed)
+    numbers = [rng.randint(1, rows) for _ in range(options.requests + options.warmup + 1)]
+    words = [rng.choice(generate.WORDS) for _ in numbers]
+    results = {}
+    for name, path in GET_ROUTES:
+        def get(index, path=path):
+            url = path.format(number=numbers[index], word=words[index])
+            check(client.get(url), url)
+        results[name] = time_requests(get, options.requests, options.warmup)
+
+    results['edit_post'] = time_edits(client, numbers, options)
+
+    def new(index):
+        check(client.post("/project/new", data={
+            'idea': f"Benchmark project {index}", 'memoranda': "", 'links': "",
+            'created': "", 'done': "", 'started_on': "", 'stopped_on': "",
+            'continuous': "0", 'last_modified': ""}), "new", 302)
+    results['new_post'] = time_requests(new, options.requests, options.warmup)
+    return results
+
+
+def child(options):
+    """ Benchmark one backend on one dataset, in this process. Prints the result as
+    json. The app's settings come from the environment the parent set up. """
+    if options.backend == "dynamodb":
+        # pylint: disable=import-outside-toplevel
+        import boto3
+        import memtable
+        table = memtable.MemoryDynamoDB()
+        boto3.resource = lambda *args, **kwargs: table
+        boto3.client = lambda *args, **kwargs: table.meta.client
+    rows = options.rows
+    seconds = import_csv(options.backend, options.csv,
+                         json.loads(os.environ["FLASK_SQLITE_PATH"]))
+    result = {'backend': options.backend, 'rows': rows,
+              'import': {'seconds': round(seconds, 3),
+                         'rows_per_second': round(rows / seconds, 1)}}
+
+    os.chdir(ROOT)
+    import projects  # pylint: disable=import-outside-toplevel
+    projects.app.logger.disabled = True
+    result['routes'] = bench_routes(projects.app.test_client(), rows, options)
+    print(json.dumps(result))
+
+
+def dataset(rows, seed):
+    """ The csv file for a dataset, generated the first time it's asked for """
+    filename = os.path.join(DATA_DIR, f"projects-{rows}-{seed}.csv")
+    if not os.path.exists(filename):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        print(f"Generating {rows} projects", file=sys.stderr)
+        generate.generate(filename + ".part", rows, seed)
+        os.replace(filename + ".part", filename)
+    return filename
+
+
+def run_child(backend, rows, options):
+    """ Benchmark one backend on one dataset, in a fresh process with its own
+    database files
+    ::returns its result """
+    filename = dataset(rows, options.seed)
+    with tempfile.TemporaryDirectory(prefix="projects-bench-") as work:
+        env = dict(os.environ,
+                   FLASK_DBTYPE=json.dumps(backend),
+                   FLASK_SQLITE_PATH=json.dumps(os.path.join(work, "sql3-database.sdb")),
+                   FLASK_SEARCH_INDEX_PATH=json.dumps(os.path.join(work, "search-index.sdb")),
+                   FLASK_TEMPLATE_CACHE_PATH=json.dumps(os.path.join(work, "templates")),
+                   FLASK_REPLICA_PATH=json.dumps(""),
+                   FLASK_SECRET_KEY=json.dumps("benchmark"))
+        if not options.cache:
+            env['FLASK_CACHE_SIZE'] = "0"
+        command = [sys.executable, os.path.abspath(__file__), "--child", backend,
+                   "--csv", filename, "--rows", str(rows), "--seed", str(options.seed),
+                   "--requests", str(options.requests), "--warmup", str(options.warmup)]
+        output = subprocess.run(command, env=env, cwd=work, check=True,
+                                stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def git_commit():
+    """ The commit being benchmarked, if it can be found """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """ Print how each p50 and the import rate moved since a baseline run """
+    before = {(run['backend'], run['rows']): run for run in baseline['runs']}
+    for run in results['runs']:
+        old = before.get((run['backend'], run['rows']))
+        if old is None:
+            continue
+        print(f"\n{run['backend']}, {run['rows']} rows: p50 ms, baseline -> now")
+        rates = old['import']['rows_per_second'], run['import']['rows_per_second']
+        print(f"  {'import rows/s':14} {rates[0]:10.1f} -> {rates[1]:10.1f}"
+              f" {rates[1] / rates[0] - 1:+7.1%}")
+        for name, now in run['routes'].items():
+            if name in old['routes']:
+                was = old['routes'][name]['p50_ms']
+                print(f"  {name:14} {was:10.3f} -> {now['p50_ms']:10.3f}"
+                      f" {now['p50_ms'] / was - 1:+7.1%}")
+
+
+def parse_cmdline():
+    """ Parse the command line """
+    parser = argparse.ArgumentParser(description="benchmarks the importer and the routes")
+    parser.add_argument("--sizes", default="1000",
+                        help="comma separated dataset sizes, e.g. 1000,100000,1000000 "
+                             "(default 1000)")
+    parser.add_argument("--backends", default=",".join(BACKENDS),
+                        help="comma separated backends (default sqlite3,dynamodb)")
+    parser.add_argument("--requests", type=int, default=50,
+                        help="timed requests per route (default 50)")
+    parser.add_argument("--warmup", type=int, default=5,
+                        help="untimed requests per route before those (default 5)")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed for the datasets and requests (default 1)")
+    parser.add_argument("--cache", action="store_true",
+                        help="leave the read cache on; by default the list views read "
+                             "the database every time")
+    parser.add_argument("--output", help="results file (default results/TIMESTAMP.json)")
+    parser.add_argument("--baseline", help="earlier results file to compare with")
+    # Used by run_child
+    parser.add_argument("--child", choices=BACKENDS, dest="backend", help=argparse.SUPPRESS)
+    parser.add_argument("--csv", help=argparse.SUPPRESS)
+    parser.add_argument("--rows", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main(options):
+    """ Run every backend at every size, and write out the results """
+    started = datetime.datetime.now()
+    results = {'started': started.isoformat(timespec="seconds"), 'commit': git_commit(),
+               'python': platform.python_version(), 'platform': platform.platform(),
+               'options': {'requests': options.requests, 'warmup': options.warmup,
+                           'seed': options.seed, 'cache': options.cache},
+               'runs': []}
+    for rows in [int(size) for size in options.sizes.split(",")]:
+        for backend in options.backends.split(","):
+            print(f"Benchmarking {backend} with {rows} projects", file=sys.stderr)
+            results['runs'].append(run_child(backend, rows, options))
+
+    output = options.output or os.path.join(
+        RESULTS_DIR, started.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as out:
+        json.dump(results, out, indent=2)
+    print(f"Results in {output}", file=sys.stderr)
+    if options.baseline:
+        with open(options.baseline, encoding="utf-8") as previous:
+            compare(results, json.load(previous))
+
+
+if __name__ == '__main__':
+    cmdline = parse_cmdline()
+    if cmdline.backend:
+        child(cmdline)
+    else:
+        main(cmdline)
@@ -0,0 +1,130 @@
+""" Startup.py:
+    How long a new worker takes to start: from a fresh python process to the app
+    imported, and on to its first rendered page, on each backend. The importer's
+    --help is timed too. Each is run several times in a new process, sharing one
+    template cache as workers on a host would, so the first run compiles the
+    templates and the rest load them. Fails if the median time to the first page is
+    over the budget, so a change that slows start up shows.
+    usage: python startup.py [--runs N] [--budget SECONDS] [--output FILE]
+    """
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import run
+
+# Most seconds from starting python to the first page, by default
+STARTUP_BUDGET = 1.0
+
+
+def child():
+    """ Start the app in this process, and print how long it took as json """
+    started = time.perf_counter()
+    import projects  # pylint: disable=import-outside-toplevel
+    imported = time.perf_counter()
+    run.check(projects.app.test_client().get("/project/new"), "/project/new")
+    print(json.dumps({'import_seconds': imported - started,
+                      'first_page_seconds': time.perf_counter() - started,
+                      'boto3_imported': "boto3" in sys.modules}))
+
+
+def timed(command, **kwargs):
+    """ Run a command to the end
+    ::returns (seconds it took, its standard output) """
+    start = time.perf_counter()
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True,
+                            **kwargs).stdout
+    return time.perf_counter() - start, output
+
+
+def startup(backend, runs):
+    """ Time starting the app runs times on a backend
+    ::returns dict of medians, and the slowest """
+    with tempfile.TemporaryDirectory(prefix="projects-startup-") as work:
+        env = dict(os.environ,
+                   FLASK_DBTYPE=json.dumps(backend),
+                   FLASK_SQLITE_PATH=json.dumps(os.path.join(work, "sql3-database.sdb")),
+                   FLASK_TEMPLATE_CACHE_PATH=json.dumps(os.path.join(work, "templates")),
+                   FLASK_SECRET_KEY=json.dumps("benchmark"))
+        results = []
+        for _ in range(runs):
+            seconds, output = timed([sys.executable, os.path.abspath(__file__), "--child"],
+                                    env=env, cwd=run.ROOT)
+            results.append(dict(json.loads(output.splitlines()[-1]), process_seconds=seconds))
+    summary = {name: round(statistics.median(result[name] for result in results[1:]), 4)
+               for name in ('import_seconds', 'first_page_seconds', 'process_seconds')}
+    summary['first_run_page_seconds'] = round(results[0]['first_page_seconds'], 4)
+    summary['max_process_seconds'] = round(max(result['process_seconds']
+                                               for result in results), 4)
+    summary['boto3_imported'] = results[-1]['boto3_imported']
+    return summary
+
+
+def importer_help(runs):
+    """ Median seconds for the importer to print its --help """
+    return round(statistics.median(
+        timed([sys.executable, "data_import.py", "--help"],
+              cwd=os.path.join(run.ROOT, "data-import"))[0] for _ in range(runs)), 4)
+
+
+def main(options):
+    """ Time starting up on every backend, write out the results, and check them
+    against the budget
+    ::returns exit status """
+    started = datetime.datetime.now()
+    results = {'started': started.isoformat(timespec="seconds"), 'commit': run.git_commit(),
+               'python': platform.python_version(), 'platform': platform.platform(),
+               'options': {'runs': options.runs, 'budget': options.budget},
+               'startup': {}, 'importer_help_seconds': importer_help(options.runs)}
+    over = []
+    for backend in options.backends.split(","):
+        result = results['startup'][backend] = startup(backend, options.runs)
+        print(f"{backend}: import {result['import_seconds']:.3f}s, first page "
+              f"{result['first_page_seconds']:.3f}s ({result['first_run_page_seconds']:.3f}s "
+              f"compiling templates), whole process {result['process_seconds']:.3f}s",
+              file=sys.stderr)
+        if result['first_page_seconds'] > options.budget:
+            over.append(backend)
+    print(f"importer --help: {results['importer_help_seconds']:.3f}s", file=sys.stderr)
+
+    output = options.output or os.path.join(
+        run.RESULTS_DIR, "startup-" + started.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as out:
+        json.dump(results, out, indent=2)
+    print(f"Results in {output}", file=sys.stderr)
+    if over:
+        print(f"Over the {options.budget}s budget: {', '.join(over)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def parse_cmdline():
+    """ Parse the command line """
+    parser = argparse.ArgumentParser(description="times starting the app")
+    parser.add_argument("--runs", type=int, default=10,
+                        help="times to start each backend (default 10)")
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET,
+                        help="most seconds allowed to the first page "
+                             f"(default {STARTUP_BUDGET})")
+    parser.add_argument("--backends", default=",".join(run.BACKENDS),
+                        help="comma separated backends (default sqlite3,dynamodb)")
+    parser.add_argument("--output", help="results file (default results/startup-TIMESTAMP.json)")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cmdline = parse_cmdline()
+    if cmdline.child:
+        child()
+    else:
+        sys.exit(main(cmdline))
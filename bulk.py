@@ -0,0 +1,211 @@
+""" Bulk.py:
+    Make the same change to many projects at once: mark them all done, say, or start
+    or pause a batch of them. Projects are picked by number, or as every project in
+    a status with a date before a given one. Only model.BULK_EDITABLE attributes can
+    be set this way. Each project is written as an edit would write it, only if
+    nobody else has written it since it was read, but many to a round trip: one
+    transaction and commit on sqlite3, and TransactWriteItems of up to
+    database.TRANSACTION_ITEMS on dynamodb, whose stats counters, local search index
+    and replica are then brought up to date in one go rather than per project.
+    Every project gets a result of its own, see RESULTS.
+    """
+
+import collections
+import datetime
+from flask import current_app
+import database
+import model
+import replica
+import search
+import stats
+
+# What can happen to each project: written; already as asked, so left alone; no
+# such project; someone else wrote it between it being read and written, so it
+# was left alone and the change should be made again; or dynamodb wouldn't read or
+# write it, even after retrying (see database.batch_get and update_projects), so it
+# should be tried later
+RESULTS = ("updated", "unchanged", "missing", "conflict", "failed")
+
+# The result for each of the ways database.update_projects reports a write
+WRITE_RESULTS = {True: "updated", False: "conflict", None: "failed"}
+
+# Most project numbers in one sqlite3 "in (...)", well inside its variable limit
+SELECT_NUMBERS = 500
+
+# The dates projects can be selected by
+SELECT_COLUMNS = tuple(column for column in model.BULK_EDITABLE if column in model.DATE_COLUMNS)
+
+# What's read of each project before it's changed
+READ_COLUMNS = ("number", "last_modified") + model.BULK_EDITABLE
+
+
+def _stored_date(value, message):
+    """ An ISO date as stored, to the minute. Anything else is refused, rather than
+    passed through to be compared as text.
+    ::parameter value: the date as typed
+    ::parameter message: what to say if it isn't one
+    ::returns string in model.STORED_DATE_FORMAT
+    ::raises ValueError if it isn't an ISO date
+    >>> _stored_date("2015-01-01", "before must be an ISO date")
+    '2015-01-01T00:00'
+    >>> _stored_date("soon", "before must be an ISO date")
+    Traceback (most recent call last):
+    ValueError: before must be an ISO date, not 'soon'
+    >>> _stored_date("2015/01/01", "before must be an ISO date")
+    Traceback (most recent call last):
+    ValueError: before must be an ISO date, not '2015/01/01'
+    """
+    try:
+        when = datetime.datetime.fromisoformat(str(value).strip())
+    except ValueError as error:
+        raise ValueError(f"{message}, not {value!r}") from error
+    return when.strftime(model.STORED_DATE_FORMAT)
+
+
+def parse_change(pairs):
+    """ Check and normalise the change to make
+    ::parameter pairs: (attribute, value) pairs, as typed. Dates are ISO, or "now";
+                       continuous is 1 or 0; a blank value clears the attribute.
+    ::returns dict of attribute: value to store, None meaning cleared
+    ::raises ValueError if there's anything in it that can't be set """
+    now = datetime.datetime.now().strftime(model.STORED_DATE_FORMAT)
+    change = {}
+    for column, value in pairs:
+        if column not in model.BULK_EDITABLE:
+            raise ValueError(f"{column} can't be bulk edited, only "
+                             f"{', '.join(model.BULK_EDITABLE)}")
+        value = None if value is None else str(value).strip()
+        if not value or (column == "continuous" and value == "0"):
+            change[column] = None
+        elif column == "continuous":
+            if value != "1":
+                raise ValueError(f"continuous must be 1 or 0, not {value!r}")
+            change[column] = 1
+        elif value.lower() == "now":
+            change[column] = now
+        else:
+            change[column] = _stored_date(value, f"{column} must be an ISO date or now")
+    if not change:
+        raise ValueError("Nothing to change")
+    return change
+
+
+def select(status, column, before):
+    """ Numbers of the projects in a status with a date before a given one, read
+    from the database itself, never the dynamodb replica
+    ::parameter status: one of model.STATUSES
+    ::parameter column: one of SELECT_COLUMNS, e.g. "started_on"
+    ::parameter before: ISO date; projects without the date aren't picked
+    ::returns list of project numbers
+    ::raises ValueError if any of them isn't one of those """
+    if status not in model.STATUSES:
+        raise ValueError(f"status must be one of {', '.join(model.STATUSES)}, not {status!r}")
+    if column not in SELECT_COLUMNS:
+        raise ValueError(f"{column} isn't a date that can be selected on")
+    if not model.is_set(before):
+        raise ValueError("A date to select before is needed")
+    before = _stored_date(before, "before must be an ISO date")
+
+    db = database.get_db()
+    if current_app.config["DBTYPE"] == "sqlite3":
+        return [row['number'] for row in db.execute(
+            f"""select number from projects where status = ? and {column} < ?
+            order by number""", (status, before))]
+    return sorted(int(item['number'])
+                  for item in database.query_status_before(db, status, column, before,
+                                                           ("number", column))
+                  if model.is_set(item.get(column))
+                  and model.parse_date(item[column])[0] < before)
+
+
+def _read(numbers):
+    """ The projects to change, as stored
+    ::returns dict of number: project, for those that exist, and on dynamodb None for
+              those it wouldn't read (see database.batch_get) """
+    db = database.get_db()
+    if current_app.config["DBTYPE"] == "sqlite3":
+        found = {}
+        for start in range(0, len(numbers), SELECT_NUMBERS):
+            chunk = numbers[start:start + SELECT_NUMBERS]
+            for row in db.execute(f"""select {','.join(READ_COLUMNS)} from projects
+                                  where number in ({','.join('?' * len(chunk))})""", chunk):
+                found[row['number']] = dict(row)
+        return found
+    return database.batch_get(db, numbers, READ_COLUMNS + model.DERIVED_COLUMNS)
+
+
+def _plan(numbers, change):
+    """ Work out what to write to each project
+    ::returns (dict of number: result for those with nothing to write,
+               list of (number, project as read, changed, project as it'll be)) """
+    results = {}
+    writes = []
+    found = _read(numbers)
+    for number in numbers:
+        item = found.get(number)
+        if item is None:
+            results[number] = "failed" if number in found else "missing"
+            continue
+        project = model.with_dates(item)
+        changed = model.changes(project, dict(project, **change))
+        if not changed:
+            results[number] = "unchanged"
+            continue
+        changed['last_modified'] = model.modified_stamp(item.get('last_modified'))
+        after = dict(item, **changed)
+        if current_app.config["DBTYPE"] == "dynamodb":
+            # Keep the status and timeline indexes up to date, as an edit does
+            model.add_timeline(model.add_status(after))
+            for column in model.DERIVED_COLUMNS:
+                if after.get(column) != item.get(column):
+                    changed[column] = after.get(column)
+        writes.append((number, item, changed, after))
+    return results, writes
+
+
+def _write(writes):
+    """ Write the planned changes, and bring what sqlite3's triggers would have
+    along with them on dynamodb
+    ::returns dict of number: True if written, False if it had been changed, and
+              on dynamodb None if it failed """
+    db = database.get_db()
+    updates = [(number, changed, item.get('last_modified'))
+               for number, item, changed, _ in writes]
+    if current_app.config["DBTYPE"] == "sqlite3":
+        return database.update_project_rows(db, updates)
+
+    written = database.update_projects(db, updates)
+    done = [(item, after) for number, item, _, after in writes if written[number]]
+    if done:
+        stats.count_many(done)
+        search.update_shown([after for _, after in done])
+        replica.apply_changes({number: changed for number, _, changed, _ in writes
+                               if written[number]})
+    return written
+
+
+def apply(numbers, change):
+    """ Make the same change to many projects
+    ::parameter numbers: project numbers
+    ::parameter change: dict of attribute: value, from parse_change
+    ::returns list of {'number': n, 'result': one of RESULTS}, in the order given """
+    numbers = list(dict.fromkeys(int(number) for number in numbers))
+    results, writes = _plan(numbers, change)
+    if writes:
+        written = _write(writes)
+        statuses = set()
+        for number, item, _, after in writes:
+            results[number] = WRITE_RESULTS[written[number]]
+            if written[number]:
+                statuses.update((model.project_status(item), model.project_status(after)))
+        # Drop any cached list that showed these projects before, or should now
+        database.invalidate(*statuses)
+    return [{'number': number, 'result': results[number]} for number in numbers]
+
+
+def summary(results):
+    """ How many projects had each result
+    ::parameter results: from apply
+    ::returns dict of result: count, for every one of RESULTS """
+    counts = collections.Counter(result['result'] for result in results)
+    return {result: counts.get(result, 0) for result in RESULTS}
@@ -1,5 +1,5 @@
 """ Data importer - imports a csv file in the expected format into a local sqlite3 db
-    Does convert dates from D-M-YYYY HH:MM to python datetime objects
+    Does convert dates from D-M-YYYY HH:MM to YYYY-MM-DDTHH:MM strings
     Otherwise, imports as-is
     """
 # Importer for data from csv
@@ -8,31 +8,107 @@
 # simples
 # (C)2023 DJM LZP
 import argparse
-import datetime
+import collections
+import json
+import os
+import random
+import re
 import sqlite3
 import sys
-
-import boto3
-import pandas as pd
-import yaml
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# The record rules are shared with the web app, which lives one level up
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import lazy  # pylint: disable=wrong-import-position
+import model  # pylint: disable=wrong-import-position
+
+# Imported when first used, so --help doesn't wait for them, and a sqlite3 import
+# never loads boto3 or yaml
+boto3 = lazy.Module("boto3")
+conditions = lazy.Module("boto3.dynamodb.conditions")
+dynamodb_types = lazy.Module("boto3.dynamodb.types")
+np = lazy.Module("numpy")
+pd = lazy.Module("pandas")
+yaml = lazy.Module("yaml")
 
 # CSVFILE = "projects.csv"
 SCHEMA_SQL = "db_init.sql"
 SCHEMA_YAML = "db_init.yaml"
+SQLITE_PATH = "../db/sql3-database.sdb"
+
+# The csv columns, in order, and which of them are dates
+COLUMNS = list(model.CSV_COLUMNS)
+DATE_COLUMNS = list(model.DATE_COLUMNS)
+CSV_DATE_FORMAT = model.CSV_DATE_FORMAT
+
+INSERT_SQL = """INSERT INTO projects VALUES(:number, :idea, :created, :done, :started_on,
+             :stopped_on, :continuous, :links, :memoranda, :last_modified)"""
+
+# Rows already there are updated, unless they haven't changed
+UPSERT_SQL = INSERT_SQL + """
+             ON CONFLICT(number) DO UPDATE SET
+             idea = excluded.idea, created = excluded.created, done = excluded.done,
+             started_on = excluded.started_on, stopped_on = excluded.stopped_on,
+             continuous = excluded.continuous, links = excluded.links,
+             memoranda = excluded.memoranda, last_modified = excluded.last_modified
+             WHERE excluded.last_modified IS NOT projects.last_modified"""
+
+MEMO_UPSERT_SQL = """INSERT INTO memoranda (number, body) VALUES (?, ?)
+                  ON CONFLICT (number) DO UPDATE SET body = excluded.body"""
 
+# Retry waits for throttled dynamodb batch writes, in seconds
+BACKOFF_BASE = 0.05
+BACKOFF_CAP = 5
 
-def dt_from_str(string):
-    """ Simple func to return ISO formatted date based on string input
+
+def dates_from_str(column):
+    """ Convert a whole column of dates in one go
     Expects format "%d/%m/%Y %H:%M" as that was in the original input,
     returns format "%Y-%m-%dT%H:%M"
-    If NULL or NAN is passed, we return None type
-    We will interpret this as 'Not Set' for key-value stores, and as NaN for SQL stores
-    """
-    if not pd.isna(string):
-        dt_tmp = datetime.datetime.strptime(str(string), "%d/%m/%Y %H:%M")
-        return datetime.datetime.strftime(dt_tmp, "%Y-%m-%dT%H:%M")
-    else:
-        return None
+    Blank/NaN entries stay NaN, and become None when the rows are built
+    We will interpret this as 'Not Set' for key-value stores, and as NULL for SQL stores
+    ::parameter column: pandas Series of strings
+    ::returns pandas Series of strings """
+    parsed = pd.to_datetime(column, format=CSV_DATE_FORMAT)
+    # numpy's ISO format at minute resolution is our "%Y-%m-%dT%H:%M",
+    # and it's a lot quicker than strftime
+    text = np.datetime_as_string(parsed.to_numpy(dtype="datetime64[m]"), unit="m")
+    return pd.Series(text, index=column.index).where(parsed.notna())
+
+
+def transform_chunk(db_type, frame, since=None):
+    """ Turn a chunk of the csv file into rows ready for db_insert
+    Everything is done a column at a time, rather than row by row.
+    ::parameter db_type: either sqlite3 or dynamodb
+    ::parameter frame: pandas DataFrame, with the csv columns in the usual order
+    ::parameter since: watermark; drop rows last modified before this
+    ::returns list of dicts, one per row """
+    frame.columns = COLUMNS
+    for column in DATE_COLUMNS:
+        frame[column] = dates_from_str(frame[column])
+    if since:
+        # Anything stamped in the watermark's own minute may have changed after the last
+        # run read it, so only rows strictly older are skipped. No stamp, no skip.
+        frame = frame[~(frame["last_modified"] < since)]
+    # Nullable integers, so a blank doesn't turn the whole column into floats
+    frame["continuous"] = frame["continuous"].astype("Int64")
+
+    present = frame.notna().to_numpy()
+    values = frame.astype(object).to_numpy()
+    if db_type == 'sqlite3':
+        values[~present] = None
+        return [dict(zip(COLUMNS, row)) for row in values]
+
+    # Must be dynamodb so
+    # We need to remove any NaN/Null/None values
+    rows = []
+    for row, mask in zip(values, present):
+        item = {key: value for key, value, keep in zip(COLUMNS, row, mask) if keep}
+        # Keep the status and timeline indexes up to date. SQLite needs neither.
+        rows.append(model.add_timeline(model.add_status(item)))
+    return rows
 
 
 def parse_cmdline():
@@ -40,6 +116,14 @@ def parse_cmdline():
     Parse the command line options:
         -t type (database type, either sqlite3 or dynamodb)
         filename.csv (filename of csv data for import)
+        --chunk-size (rows per write)
+        -q / --quiet (no progress count)
+        -i / --incremental (upsert rather than reload, see load_state)
+        --checkpoint (state file for incremental runs)
+        --workers, --target-wcu (parallel, rate limited dynamodb writes)
+        --rcu, --wcu, --on-demand (capacity for a new dynamodb table)
+        --memo-threshold (size above which memoranda are stored compressed, out of line)
+        --sqlite-path (the sqlite3 database file)
     :return:
     """
     # Parse any command line options.
@@ -51,17 +135,59 @@ def parse_cmdline():
                         choices=['sqlite3', 'dynamodb'])
     parser.add_argument("filename", action="store",
                         help="filename to use for csv input")
+    parser.add_argument("--chunk-size", action="store", type=int, default=500,
+                        help="rows to read, convert and write at a time (default 500)")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="don't show the progress count")
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="update the existing table in place, skipping rows that haven't "
+                             "changed since the last incremental run, and resume an "
+                             "interrupted run from its checkpoint")
+    parser.add_argument("--checkpoint", action="store",
+                        help="checkpoint file for --incremental (default filename.checkpoint)")
+    parser.add_argument("--workers", action="store", type=int, default=1,
+                        help="dynamodb writer threads (default 1)")
+    parser.add_argument("--target-wcu", action="store", type=float,
+                        help="keep dynamodb writes to about this many write units a second, "
+                             "backing off if throttled (default no limit)")
+    parser.add_argument("--rcu", action="store", type=int, default=1,
+                        help="read capacity units for a new dynamodb table (default 1)")
+    parser.add_argument("--wcu", action="store", type=int, default=1,
+                        help="write capacity units for a new dynamodb table (default 1)")
+    parser.add_argument("--on-demand", action="store_true",
+                        help="create the dynamodb table with on-demand capacity instead")
+    parser.add_argument("--memo-threshold", action="store", type=int,
+                        default=model.MEMO_THRESHOLD,
+                        help="compress memoranda longer than this many bytes and store them "
+                             "apart from the project, as the app does with MEMO_THRESHOLD "
+                             f"(default {model.MEMO_THRESHOLD})")
+    parser.add_argument("--sqlite-path", action="store", default=SQLITE_PATH,
+                        help=f"sqlite3 database file to load into (default {SQLITE_PATH})")
     args = parser.parse_args()
     return args
 
 
-def db_init(db_type):
+def db_init(db_type, incremental=False, sqlite_path=SQLITE_PATH):
     """ Initialise a database connection
     ::parameter db_type: either 'sqlite3' or 'dynamodb'
+    ::parameter incremental: True if we're updating a live database in place
+    ::parameter sqlite_path: the sqlite3 database file
     ::returns connection object """
 
     if db_type == 'sqlite3':
-        db_conn = sqlite3.connect("../db/sql3-database.sdb")  # pylint: disable=wrong-import-order
+        db_conn = sqlite3.connect(sqlite_path)  # pylint: disable=wrong-import-order
+        if incremental:
+            # The app may be reading while we write, so stay crash safe, as it does
+            db_conn.execute("PRAGMA journal_mode = WAL")
+            db_conn.execute("PRAGMA synchronous = NORMAL")
+        else:
+            # We're loading from scratch, so if it goes wrong part way we'll just run it
+            # again. That means no need for a journal on disk or waiting for fsync.
+            db_conn.execute("PRAGMA journal_mode = MEMORY")
+            db_conn.execute("PRAGMA synchronous = OFF")
+        db_conn.execute("PRAGMA cache_size = -64000")
+        # The search triggers need this to see out of line memoranda
+        db_conn.create_function("memo_text", 1, model.unsplit_memo, deterministic=True)
     elif db_type == 'dynamodb':
         db_conn = boto3.resource('dynamodb', region_name='eu-west-1')
     else:
@@ -70,70 +196,131 @@ def db_init(db_type):
     return db_conn
 
 
-def setup_db(db_type, db_conn):
+def load_schema():
+    """ Load the yaml schema for dynamodb
+    ::returns dict, or None if it couldn't be read """
+    try:
+        with open(SCHEMA_YAML, mode="r", encoding="utf-8") as my_schema:
+            return yaml.safe_load(my_schema)
+    except (yaml.YAMLError, IOError) as err:
+        print("R Tape Loading Error, ", err)
+        return None
+
+
+def billing(capacity):
+    """ create_table parameters for the given capacity
+    ::parameter capacity: (read units, write units) for provisioned capacity,
+                          or None for on-demand
+    ::returns dict """
+    if capacity is None:
+        return {'BillingMode': 'PAY_PER_REQUEST'}
+    return {'BillingMode': 'PROVISIONED',
+            'ProvisionedThroughput': {'ReadCapacityUnits': capacity[0],
+                                      'WriteCapacityUnits': capacity[1]}}
+
+
+def create_table(db_conn, schema, capacity):
+    """ Create the dynamodb table and its indexes from the yaml schema
+    ::parameter db_conn: dynamodb resource
+    ::parameter schema: the loaded yaml schema
+    ::parameter capacity: see billing; used for the table and each index alike
+    ::returns table object """
+    indexes = [dict(index) for index in schema['ddb_gsi']]
+    throughput = billing(capacity)
+    if capacity is not None:
+        for index in indexes:
+            index['ProvisionedThroughput'] = throughput['ProvisionedThroughput']
+
+    return db_conn.create_table(TableName=schema['ddb_tablename'],
+                                KeySchema=schema['ddb_keyschema'],
+                                AttributeDefinitions=schema['ddb_attribdefs'],
+                                GlobalSecondaryIndexes=indexes,
+                                **throughput)
+
+
+def missing_schema(db_conn):
+    """ What an existing sqlite3 database lacks of SCHEMA_SQL: the tables, views,
+    indexes and triggers it creates, and the projects table's generated status column
+    ::parameter db_conn: sqlite3 connection
+    ::returns list of names, empty if it's all there """
+    with open(SCHEMA_SQL, mode="r", encoding="utf-8") as schema:
+        wanted = re.findall(r"CREATE (?:VIRTUAL )?(?:TABLE|VIEW|INDEX|TRIGGER) (\w+)",
+                            schema.read())
+    found = {row[0] for row in db_conn.execute("SELECT name FROM sqlite_master")}
+    missing = [name for name in wanted if name not in found]
+    if "status" not in {row[1] for row in db_conn.execute("PRAGMA table_xinfo(projects)")}:
+        missing.insert(0, "projects.status")
+    return missing
+
+
+def setup_db(db_type, db_conn, incremental=False, capacity=(1, 1)):
     """ Configure the schema
     ::parameter db_type: either 'sqlite3' or 'dynamodb'
+    ::parameter incremental: keep an existing table and its data, rather than start again
+    ::parameter capacity: dynamodb capacity for a new table, see create_table
     ::returns True on success """
 
     if db_type == 'sqlite3':
-        schema = open(SCHEMA_SQL, mode="r", encoding="utf-8")  # pylint: disable=consider-using-with
-        ret = db_conn.executescript(schema.read())
+        exists = db_conn.execute("""SELECT name FROM sqlite_master
+                                 WHERE type = 'table' AND name = 'projects'""").fetchone()
+        if incremental and exists:
+            # Leave the table, and everything in it, where it is, as long as it's the
+            # table the app expects. One from before the current schema can't be
+            # written to or read as it is.
+            missing = missing_schema(db_conn)
+            if missing:
+                more = f" and {len(missing) - 3} more" if len(missing) > 3 else ""
+                print(f"The database was made with an older schema, and is missing "
+                      f"{', '.join(missing[:3])}{more}. Run a full import, without "
+                      f"--incremental, to rebuild it first.")
+            ret = not missing
+        else:
+            schema = open(SCHEMA_SQL, mode="r", encoding="utf-8")  # pylint: disable=consider-using-with
+            ret = db_conn.executescript(schema.read())
     elif db_type == 'dynamodb':
         # Load the yaml config file for the key type and attributes
-        try:
-            with open(SCHEMA_YAML, mode="r", encoding="utf-8") as my_schema:
-                schema = yaml.safe_load(my_schema)
-        except (yaml.YAMLError, IOError) as err:
-            print("R Tape Loading Error, ", err)
+        schema = load_schema()
+        if schema is None:
             return False
 
         # Create table unless exists, in which case this thing throws shapes
         try:
-            dtable = db_conn.create_table(TableName=schema['ddb_tablename'],
-                                         KeySchema=schema['ddb_keyschema'],
-                                         AttributeDefinitions=schema['ddb_attribdefs'],
-                                         ProvisionedThroughput={
-                                            'ReadCapacityUnits': 1,
-                                            'WriteCapacityUnits': 1
-                                            }
-                                         )
+            dtable = create_table(db_conn, schema, capacity)
         except db_conn.meta.client.exceptions.ResourceInUseException:
-            print("Oh dear, the table already exists!")
-            print("Will now delete it first")
-
-            # Let's just re-use the existing table and update it to be sure.
-            # Fingers crossed we're not blowing something away here,
-            # so make sure you've setup the right
-            # resources in AWS or otherwise ka-blooey
-
-            # Get the client connection object first
-            dtable = db_conn.meta.client
-
-            # Now we can delete it and re-create
-            dtable.delete_table(TableName=schema['ddb_tablename'])
-
-            # If we jump ahead now, the table may not yet be deleted
-            # and we'll end up having to redo from start
-            # So use these waiter processes.
-            print("Waiting for table deletion to be confirmed...", end='')
-            waiter = dtable.get_waiter('table_not_exists')
-            waiter.wait(TableName=schema['ddb_tablename'])
-            print("done")
-
-            print("Re-creating table...", end='')
-            dtable = db_conn.create_table(TableName=schema['ddb_tablename'],
-                                         KeySchema=schema['ddb_keyschema'],
-                                         AttributeDefinitions=schema['ddb_attribdefs'],
-                                         ProvisionedThroughput={
-                                             'ReadCapacityUnits': 1,
-                                             'WriteCapacityUnits': 1
-                                         }
-                                         )
+            if incremental:
+                # Leave the table, and everything in it, where it is
+                print("Table exists, so updating it in place...", end='')
+                dtable = db_conn.Table(schema['ddb_tablename'])
+            else:
+                print("Oh dear, the table already exists!")
+                print("Will now delete it first")
+
+                # Let's just re-use the existing table and update it to be sure.
+                # Fingers crossed we're not blowing something away here,
+                # so make sure you've setup the right
+                # resources in AWS or otherwise ka-blooey
+
+                # Get the client connection object first
+                dtable = db_conn.meta.client
+
+                # Now we can delete it and re-create
+                dtable.delete_table(TableName=schema['ddb_tablename'])
+
+                # If we jump ahead now, the table may not yet be deleted
+                # and we'll end up having to redo from start
+                # So use these waiter processes.
+                print("Waiting for table deletion to be confirmed...", end='')
+                waiter = dtable.get_waiter('table_not_exists')
+                waiter.wait(TableName=schema['ddb_tablename'])
+                print("done")
+
+                print("Re-creating table...", end='')
+                dtable = create_table(db_conn, schema, capacity)
 
         dtable.wait_until_exists()
         print("done")
         # if empty, this will return 0
-        if dtable.item_count == 0:
+        if incremental or dtable.item_count == 0:
             # for dynamodb, we want to return the table object,
             # so we can use it for inserts later
             ret = dtable
@@ -146,23 +333,236 @@ def setup_db(db_type, db_conn):
     return ret
 
 
-def db_insert(db_type, db_conn, data):
-    """ Insert data into database
+def setup_memo_table(db_conn, incremental=False, capacity=(1, 1)):
+    """ Set up the dynamodb table that large memoranda are kept in, see
+    model.split_memo. As with the projects table, it's started afresh unless
+    this is an incremental run.
+    ::parameter db_conn: dynamodb resource
+    ::parameter incremental: keep an existing table and its data
+    ::parameter capacity: see billing
+    ::returns table object """
+    schema = load_schema()
+    name = schema['ddb_memo_tablename']
+    client = db_conn.meta.client
+
+    def create():
+        return db_conn.create_table(TableName=name, KeySchema=schema['ddb_keyschema'],
+                                    AttributeDefinitions=schema['ddb_memo_attribdefs'],
+                                    **billing(capacity))
+
+    try:
+        memo_table = create()
+    except client.exceptions.ResourceInUseException:
+        if incremental:
+            return db_conn.Table(name)
+        client.delete_table(TableName=name)
+        client.get_waiter('table_not_exists').wait(TableName=name)
+        memo_table = create()
+    memo_table.wait_until_exists()
+    return memo_table
+
+
+class RateLimiter:
+    """ Token bucket for dynamodb writes, in write capacity units per second.
+    Writers take tokens before each batch, waiting if there aren't any. A batch can
+    cost more than a second's worth, in which case the bucket goes into debt and
+    the next writer waits it off. When dynamodb says we're going too fast, the rate
+    is halved (once a second at most, as parallel writers all get throttled at
+    once); each clean batch after that nudges it back up towards the target.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.rate = target
+        self.tokens = target
+        self.stamp = time.monotonic()
+        self.slowed = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, units):
+        """ Wait until there's capacity, then take units of it """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 0:
+                    self.tokens = self.tokens - units
+                    return
+                wait = -self.tokens / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        """ We've been throttled, so halve the rate (but never stop altogether) """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.slowed >= 1:
+                self.slowed = now
+                self.rate = max(self.target / 64, self.rate / 2)
+
+    def speed_up(self):
+        """ A batch went through cleanly, so creep back towards the target """
+        with self.lock:
+            self.rate = min(self.target, self.rate + self.target / 50)
+
+
+def write_units(request):
+    """ Rough write capacity cost of a typed PutRequest: 1 WCU per 1KB, rounded up
+    ::parameter request: {'PutRequest': {'Item': {...}}}
+    ::returns int """
+    size = sum(len(key) + len(str(value)) for key, value in request['PutRequest']['Item'].items())
+    return size // 1024 + 1
+
+
+def write_batch(client, table_name, batch, limiter=None, max_retries=8):
+    """ Write up to 25 typed PutRequests with BatchWriteItem.
+    Anything dynamodb hands back as unprocessed, or all of it if the whole call
+    was throttled, is resent after an exponentially growing, jittered wait.
+    ::parameter client: low level dynamodb client
+    ::parameter table_name: name of the table
+    ::parameter batch: list of PutRequests
+    ::parameter limiter: RateLimiter, or None to write as fast as we can
+    ::parameter max_retries: give up after this many goes
+    ::returns True on success, False if the batch never got through """
+    attempt = 0
+    while batch:
+        if limiter is not None:
+            limiter.acquire(sum(write_units(request) for request in batch))
+        try:
+            unprocessed = client.batch_write_item(RequestItems={table_name: batch})
+            batch = unprocessed['UnprocessedItems'].get(table_name, [])
+        except client.exceptions.ProvisionedThroughputExceededException:
+            pass  # none of it went in, so try the lot again
+        if not batch:
+            if limiter is not None:
+                limiter.speed_up()
+            break
+        if limiter is not None:
+            limiter.slow_down()
+        attempt = attempt + 1
+        if attempt > max_retries:
+            return False
+        time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+    return True
+
+
+def batch_write(dtable, items, pool=None, limiter=None):
+    """ Write items to a dynamodb table with BatchWriteItem, 25 at a time,
+    optionally spread over a pool of writer threads.
+    ::parameter dtable: dynamodb table object
+    ::parameter items: list of item dicts
+    ::parameter pool: ThreadPoolExecutor to run the batches on, or None for this thread
+    ::parameter limiter: RateLimiter shared by all the writers, or None
+    ::returns True on success, False if a batch never got through """
+    client = dtable.meta.client
+    serializer = dynamodb_types.TypeSerializer()
+    batches = []
+    for start in range(0, len(items), 25):
+        batches.append([
+            {'PutRequest': {'Item': {key: serializer.serialize(value)
+                                     for key, value in item.items()}}}
+            for item in items[start:start + 25]])
+
+    def write(batch):
+        return write_batch(client, dtable.name, batch, limiter)
+
+    if pool is None:
+        return all(write(batch) for batch in batches)
+    # Wait for the whole lot, so a checkpoint after this really means done
+    return all(list(pool.map(write, batches)))
+
+
+def split_memos(rows, threshold):
+    """ Take large memoranda out of rows, to be stored apart, see model.split_memo
+    ::parameter rows: list of dicts from transform_chunk, updated in place
+    ::parameter threshold: most bytes of memoranda to leave in a row
+    ::returns list of (number, compressed memoranda) """
+    memos = []
+    for row in rows:
+        body = model.split_memo(row, threshold)
+        if body is not None:
+            memos.append((row['number'], body))
+    return memos
+
+
+def read_before(dtable, numbers):
+    """ What some dynamodb projects count towards in the stats (see model.stat_counters)
+    before they're overwritten, with BatchGetItem, 100 at a time
+    ::parameter dtable: dynamodb table object
+    ::parameter numbers: project numbers
+    ::returns dict of number: item with number, status and done, for those that exist """
+    client = dtable.meta.client
+    serializer = dynamodb_types.TypeSerializer()
+    deserializer = dynamodb_types.TypeDeserializer()
+    found = {}
+    for start in range(0, len(numbers), 100):
+        request = {dtable.name: {
+            'Keys': [{'number': serializer.serialize(number)}
+                     for number in numbers[start:start + 100]],
+            'ProjectionExpression': "#n, #s, #d",
+            'ExpressionAttributeNames': {'#n': "number", '#s': "status", '#d': "done"}}}
+        while request:
+            response = client.batch_get_item(RequestItems=request)
+            for typed in response['Responses'].get(dtable.name, []):
+                item = {key: deserializer.deserialize(value) for key, value in typed.items()}
+                found[int(item['number'])] = item
+            request = response.get('UnprocessedKeys')
+    return found
+
+
+def count_stats(dtable, rows, before):
+    """ Move the stats counters on the dynamodb counter item for rows just written,
+    in one atomic ADD for the lot (sqlite3 has triggers for this)
+    ::parameter dtable: dynamodb table object
+    ::parameter rows: the items written
+    ::parameter before: dict of number: the item as it was, see read_before """
+    counts = collections.Counter()
+    for row in rows:
+        counts.update(model.count_changes(before.get(row['number']), row))
+    counts = {name: change for name, change in counts.items() if change}
+    if counts:
+        dtable.update_item(**model.counter_update(counts))
+
+
+def db_insert(db_type, db_conn, data, upsert=False, **writers):
+    """ Insert a chunk of rows into the database
+    For sqlite3, this is one executemany inside the caller's transaction,
+    so there's no commit here; see db_close.
     ::parameter db_type: either sqlite3 or dynamodb
     ::parameter db_conn: database connection string (sqlite3) or table object (dynamodb)
-    ::parameter data: named tuple with a single row from the csvfile
+    ::parameter data: list of dicts, one per row from the csvfile
+    ::parameter upsert: replace existing rows with the same number, rather than fail.
+                        For dynamodb, they're read first to keep the stats right.
+    ::parameter writers: memo_threshold, above which memoranda are stored out of line;
+                         memo_table, the table they go in (dynamodb); and pool and
+                         limiter for dynamodb, see batch_write
     ::returns True on success """
+    memos = split_memos(data, writers.pop('memo_threshold', model.MEMO_THRESHOLD))
+    memo_table = writers.pop('memo_table', None)
 
     if db_type == 'sqlite3':
-        ret = db_conn.execute("""INSERT INTO projects VALUES(:number, :idea, :created, :done,
-                              :started_on, :stopped_on, :continuous, :links, :memoranda, 
-                              :last_modified)""",
-                              data)
-        db_conn.commit()
+        for row in data:
+            row.setdefault('memoranda', None)
+        ret = db_conn.executemany(UPSERT_SQL if upsert else INSERT_SQL, data)
+        db_conn.executemany(MEMO_UPSERT_SQL, memos)
+        if upsert:
+            # Any that have shrunk since last time live in the row again
+            moved = {number for number, _ in memos}
+            db_conn.executemany("DELETE FROM memoranda WHERE number = ?",
+                                [(row['number'],) for row in data
+                                 if row['number'] not in moved])
     elif db_type == 'dynamodb':
         # we've got the table object as database so carry on
         # Bonus points - we have the data in the right structure already.
-        ret = table.put_item(Item=data)
+        # A put replaces any item with the same number, so it's an upsert anyway.
+        # Memoranda go in first, so no project points at memoranda that aren't there.
+        # Anything being replaced has to come out of the stats it counted towards.
+        before = read_before(db_conn, [row['number'] for row in data]) if upsert else {}
+        ret = batch_write(memo_table, [{'number': number, 'body': body}
+                                       for number, body in memos], **writers) \
+            and batch_write(db_conn, data, **writers)
+        if ret:
+            count_stats(db_conn, data, before)
     else:
         # Something went wrong with the db_type parameter!
         ret = False
@@ -170,6 +570,57 @@ def db_insert(db_type, db_conn, data):
     return ret
 
 
+def seed_counter(dtable, highest):
+    """ Make sure the app's project numbers (see database.next_number) carry on
+    from the highest number imported, without ever moving the counter back
+    ::parameter dtable: dynamodb table object
+    ::parameter highest: highest project number imported """
+    try:
+        dtable.update_item(
+            Key={'number': model.COUNTER_NUMBER},
+            UpdateExpression="SET #last = :highest",
+            ConditionExpression=conditions.Attr(model.LAST_NUMBER).not_exists()
+            | conditions.Attr(model.LAST_NUMBER).lt(highest),
+            ExpressionAttributeNames={'#last': model.LAST_NUMBER},
+            ExpressionAttributeValues={':highest': highest})
+    except dtable.meta.client.exceptions.ConditionalCheckFailedException:
+        pass  # It's already past there
+
+
+def source_id(filename):
+    """ Identify a particular version of the csv file, so a checkpoint is only ever
+    resumed against the file it was made from
+    ::parameter filename: csv filename
+    ::returns string """
+    stat = os.stat(filename)
+    return os.path.abspath(filename) + ":" + str(stat.st_size) + ":" + str(stat.st_mtime_ns)
+
+
+def load_state(checkpoint):
+    """ Read the incremental import state. It holds:
+        watermark: the newest last_modified from the last complete run. Rows older
+                   than this haven't changed since, and are skipped.
+        source, rows_done, newest: where an unfinished run got to, so it can pick up
+                   from there. rows_done counts csv rows, skipped ones included.
+    ::parameter checkpoint: state filename
+    ::returns dict, empty if there's no state yet """
+    try:
+        with open(checkpoint, mode="r", encoding="utf-8") as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(checkpoint, import_state):
+    """ Write the incremental import state. It goes to a temporary file first, so
+    being interrupted part way through never leaves a half written checkpoint
+    ::parameter checkpoint: state filename
+    ::parameter import_state: dict, see load_state """
+    with open(checkpoint + ".tmp", mode="w", encoding="utf-8") as state_file:
+        json.dump(import_state, state_file)
+    os.replace(checkpoint + ".tmp", checkpoint)
+
+
 def db_close(db_type, db_conn):
     """ Close the open database connection
     ::parameter db_type: either sqlite3 or dynamodb
@@ -177,6 +628,8 @@ def db_close(db_type, db_conn):
     ::returns True on success """
 
     if db_type == 'sqlite3':
+        # Everything went in as one transaction, so this is where it lands
+        db_conn.commit()
         db_conn.close()
         ret = True
     elif db_type == 'dynamodb':
@@ -198,28 +651,32 @@ def strip_nan(string):
     return "NA"
 
 
-def check_is_null(my_item):
-    """ Check for null, nan, None type
-    ::parameter item to test
-    ::returns True if we see a None, NaN or NULL value, False otherwise """
-    if pd.isna(my_item):
-        return True
-    elif my_item is None:
-        return True
-
-    return False
-
-
 if __name__ == '__main__':
 
     # See what we're asked to do
     options = parse_cmdline()
     CSVFILE = options.filename
 
-    csvdata = pd.read_csv(CSVFILE)
+    # For an incremental run, find out where the last one got to
+    state = {}
+    resume_from = 0
+    if options.incremental:
+        CHECKPOINT = options.checkpoint or CSVFILE + ".checkpoint"
+        state = load_state(CHECKPOINT)
+        if state.get("source") == source_id(CSVFILE):
+            resume_from = state["rows_done"]
+            print("Resuming from row " + str(resume_from) + " of the last run.")
+        else:
+            state = {"watermark": state.get("watermark"), "source": source_id(CSVFILE),
+                     "rows_done": 0, "newest": state.get("watermark")}
+
+    # Nothing's read yet, this just opens the file ready to read chunk_size rows at a time
+    # Skipping rows an interrupted run already did, but not the header
+    csvdata = pd.read_csv(CSVFILE, chunksize=options.chunk_size,
+                          skiprows=range(1, resume_from + 1))
 
     # Get a database connection
-    database = db_init(options.type)
+    database = db_init(options.type, options.incremental, options.sqlite_path)
     if database is None:
         print("Error getting DB connection!")
         sys.exit(2)
@@ -230,53 +687,53 @@ if __name__ == '__main__':
 
     # need the return value here, the dynamodb table object
     # for sqlite3, this will be 'true' and can be discarded
-    table = setup_db(options.type, database)
+    table = setup_db(options.type, database, options.incremental,
+                     None if options.on_demand else (options.rcu, options.wcu))
     if not table:
         print("Error initialising DB")
         sys.exit(2)
     # Ok, we're good so far
 
-    # Load the data, fix the dates, insert a row at a time
+    # Read the csv a chunk at a time, fix the dates and insert each chunk as it's read
     # It's in a dataframe, and we can discard the dataframe index as we don't need it
+    write_options = {'memo_threshold': options.memo_threshold}
+    if options.type == 'dynamodb':
+        write_options['memo_table'] = setup_memo_table(
+            database, options.incremental,
+            None if options.on_demand else (options.rcu, options.wcu))
+        # set param to table object for dynamodb
+        database = table
+        if options.workers > 1:
+            write_options['pool'] = ThreadPoolExecutor(max_workers=options.workers)
+        if options.target_wcu:
+            write_options['limiter'] = RateLimiter(options.target_wcu)
+
     count = 0
-    for row in csvdata.itertuples(index=False):
-        f_created = dt_from_str(row[2])
-        f_done = dt_from_str(row[3])
-        f_started_on = dt_from_str(row[4])
-        f_stopped_on = dt_from_str(row[5])
-        f_last_modified = dt_from_str(row[9])
-
-        if options.type == 'sqlite3':
-            rowdata = (
-                {"number": row[0], "idea": row[1], "created": f_created, "done": f_done,
-                 "started_on": f_started_on, "stopped_on": f_stopped_on, "continuous": row[6],
-                 "links": row[7], "memoranda": row[8], "last_modified": f_last_modified
-                 }
-            )
-        else:
-            # Must be dynamodb so
-            # We need to remove any NaN/Null/None values
-            itemlist = {
-                    "number": row[0], "idea": row[1], "created": f_created, "done": f_done,
-                    "started_on": f_started_on, "stopped_on": f_stopped_on, "continuous": row[6],
-                    "links": row[7], "memoranda": row[8], "last_modified": f_last_modified
-                    }
-
-            rowdata = {}
-            for ikey, item in itemlist.items():
-                if not check_is_null(item):
-                    rowdata[ikey] = item
-            print(rowdata)
-
-        print(".", end='')
-        count = count + 1
-        if options.type == 'dynamodb':
-            # set param to table object for dynamodb
-            database = table
-
-        if not db_insert(options.type, database, rowdata):
+    for csvchunk in csvdata:
+        rowcount = len(csvchunk)
+        rowdata = transform_chunk(options.type, csvchunk, state.get("watermark"))
+        if not db_insert(options.type, database, rowdata, options.incremental,
+                         **write_options):
             print("Error inserting values!")
             sys.exit(2)
+        count = count + len(rowdata)
+        if options.type == 'dynamodb' and rowdata:
+            # A chunk at a time, so an interrupted run has still moved it on
+            seed_counter(database, max(row['number'] for row in rowdata))
+        if options.incremental:
+            # Make the chunk stick before recording that it's done
+            if options.type == 'sqlite3':
+                database.commit()
+            state["rows_done"] = state["rows_done"] + rowcount
+            state["newest"] = max([state["newest"] or ""] + [row.get("last_modified") or ""
+                                                              for row in rowdata])
+            save_state(CHECKPOINT, state)
+        if not options.quiet:
+            print("\rInserted " + str(count) + " rows...", end='')
+
+    if options.incremental:
+        # All done, so next time only rows changed since this run's newest are wanted
+        save_state(CHECKPOINT, {"watermark": state["newest"]})
 
     print("")
     print("Inserted " + str(count) + " rows into database.")
@@ -3,6 +3,8 @@
 -- Only use this to start from scratch, natch.
 
 DROP TABLE IF EXISTS projects;
+DROP TABLE IF EXISTS memoranda;
+DROP TABLE IF EXISTS project_stats;
 
 CREATE TABLE projects (
   number INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -14,5 +16,138 @@ CREATE TABLE projects (
   continuous INT,
   links TEXT,
   memoranda TEXT,
-  last_modified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
-);
\ No newline at end of file
+  last_modified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  -- Derived from the other columns on every write, see model.project_status
+  status TEXT GENERATED ALWAYS AS (
+    CASE
+      WHEN done IS NOT NULL AND done NOT IN ('', '0') THEN 'done'
+      WHEN continuous = 1 THEN 'habit'
+      WHEN started_on IS NOT NULL AND started_on <> ''
+           AND stopped_on IS NOT NULL AND stopped_on <> '' THEN 'paused'
+      WHEN started_on IS NOT NULL AND started_on <> '' THEN 'active'
+      ELSE 'todo'
+    END) STORED
+);
+
+-- One partial index per list view, in the order that view is shown.
+-- These can't also cover the columns a view shows, as sqlite won't count an index
+-- that has the generated status column in it as covering. But the list columns
+-- are all stored ahead of links and memoranda, so looking up the rows never has
+-- to read the large text.
+CREATE INDEX projects_active ON projects(started_on) WHERE status = 'active';
+CREATE INDEX projects_paused ON projects(stopped_on) WHERE status = 'paused';
+CREATE INDEX projects_todo ON projects(number) WHERE status = 'todo';
+CREATE INDEX projects_done ON projects(done) WHERE status = 'done';
+CREATE INDEX projects_habit ON projects(number) WHERE status = 'habit';
+
+-- Date ranges for /timeline, each in date then number order, as number is the
+-- rowid. Its done ranges use projects_done, as only done projects have a done date.
+CREATE INDEX projects_created ON projects(created);
+CREATE INDEX projects_started ON projects(started_on) WHERE started_on IS NOT NULL;
+
+-- Covers /list, which reads every project in number order (see projects.py)
+CREATE INDEX projects_all ON projects(number, idea, created, done);
+
+-- Memoranda too long to keep in the projects row, zlib compressed (see
+-- model.split_memo). The row's memoranda is NULL when they're here.
+CREATE TABLE memoranda (
+  number INTEGER PRIMARY KEY,
+  body BLOB NOT NULL
+);
+
+-- A project's text, wherever its memoranda are kept. memo_text() is
+-- model.unsplit_memo, which every connection registers (see database.py).
+DROP VIEW IF EXISTS projects_text;
+CREATE VIEW projects_text AS
+  SELECT p.number, p.idea, coalesce(p.memoranda, memo_text(m.body)) AS memoranda, p.links
+  FROM projects p LEFT JOIN memoranda m ON m.number = p.number;
+
+-- Full text search over the text columns, see search.py. It reads its text from
+-- projects_text rather than keeping a copy, and these triggers keep it in step.
+-- Each one takes out what was indexed for the project and puts back what's there
+-- now, looking at both tables, so a write to either (in either order) leaves the
+-- index right.
+DROP TABLE IF EXISTS projects_search;
+CREATE VIRTUAL TABLE projects_search USING fts5(
+  idea, memoranda, links,
+  content = 'projects_text', content_rowid = 'number',
+  tokenize = 'porter unicode61'
+);
+
+CREATE TRIGGER projects_search_insert AFTER INSERT ON projects BEGIN
+  INSERT INTO projects_search(rowid, idea, memoranda, links)
+    SELECT number, idea, memoranda, links FROM projects_text WHERE number = new.number;
+END;
+
+CREATE TRIGGER projects_search_delete AFTER DELETE ON projects BEGIN
+  INSERT INTO projects_search(projects_search, rowid, idea, memoranda, links)
+    VALUES ('delete', old.number, old.idea,
+            coalesce(old.memoranda,
+                     (SELECT memo_text(body) FROM memoranda WHERE number = old.number)),
+            old.links);
+END;
+
+CREATE TRIGGER projects_search_update AFTER UPDATE OF idea, memoranda, links ON projects BEGIN
+  INSERT INTO projects_search(projects_search, rowid, idea, memoranda, links)
+    VALUES ('delete', old.number, old.idea,
+            coalesce(old.memoranda,
+                     (SELECT memo_text(body) FROM memoranda WHERE number = old.number)),
+            old.links);
+  INSERT INTO projects_search(rowid, idea, memoranda, links)
+    SELECT number, idea, memoranda, links FROM projects_text WHERE number = new.number;
+END;
+
+CREATE TRIGGER memoranda_search_insert AFTER INSERT ON memoranda BEGIN
+  INSERT INTO projects_search(projects_search, rowid, idea, memoranda, links)
+    SELECT 'delete', number, idea, memoranda, links FROM projects WHERE number = new.number;
+  INSERT INTO projects_search(rowid, idea, memoranda, links)
+    SELECT number, idea, memoranda, links FROM projects_text WHERE number = new.number;
+END;
+
+CREATE TRIGGER memoranda_search_update AFTER UPDATE ON memoranda BEGIN
+  INSERT INTO projects_search(projects_search, rowid, idea, memoranda, links)
+    SELECT 'delete', number, idea, coalesce(memoranda, memo_text(old.body)), links
+    FROM projects WHERE number = old.number;
+  INSERT INTO projects_search(rowid, idea, memoranda, links)
+    SELECT number, idea, memoranda, links FROM projects_text WHERE number = new.number;
+END;
+
+CREATE TRIGGER memoranda_search_delete AFTER DELETE ON memoranda BEGIN
+  INSERT INTO projects_search(projects_search, rowid, idea, memoranda, links)
+    SELECT 'delete', number, idea, coalesce(memoranda, memo_text(old.body)), links
+    FROM projects WHERE number = old.number;
+  INSERT INTO projects_search(rowid, idea, memoranda, links)
+    SELECT number, idea, memoranda, links FROM projects WHERE number = old.number;
+END;
+
+-- Running counts for /stats, so it doesn't have to count anything (see stats.py):
+-- "status:<status>" for each status, and "done:<YYYY-MM>" for each month projects
+-- were done in, as in model.stat_counters. These triggers move them on every write.
+CREATE TABLE project_stats (
+  name TEXT PRIMARY KEY,
+  count INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TRIGGER projects_stats_insert AFTER INSERT ON projects BEGIN
+  INSERT INTO project_stats VALUES ('status:' || new.status, 1)
+    ON CONFLICT (name) DO UPDATE SET count = count + 1;
+  INSERT INTO project_stats SELECT 'done:' || substr(new.done, 1, 7), 1 WHERE new.status = 'done'
+    ON CONFLICT (name) DO UPDATE SET count = count + 1;
+END;
+
+CREATE TRIGGER projects_stats_delete AFTER DELETE ON projects BEGIN
+  UPDATE project_stats SET count = count - 1 WHERE name = 'status:' || old.status;
+  UPDATE project_stats SET count = count - 1
+    WHERE name = 'done:' || substr(old.done, 1, 7) AND old.status = 'done';
+END;
+
+CREATE TRIGGER projects_stats_update AFTER UPDATE ON projects
+  WHEN old.status IS NOT new.status OR old.done IS NOT new.done BEGIN
+  UPDATE project_stats SET count = count - 1 WHERE name = 'status:' || old.status;
+  UPDATE project_stats SET count = count - 1
+    WHERE name = 'done:' || substr(old.done, 1, 7) AND old.status = 'done';
+  INSERT INTO project_stats VALUES ('status:' || new.status, 1)
+    ON CONFLICT (name) DO UPDATE SET count = count + 1;
+  INSERT INTO project_stats SELECT 'done:' || substr(new.done, 1, 7), 1 WHERE new.status = 'done'
+    ON CONFLICT (name) DO UPDATE SET count = count + 1;
+END;
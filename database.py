@@ -5,43 +5,966 @@
     """
 # Let's use SQL-Lite for now, we can always change this up later if needed
 
+import base64
+import json
+import queue
+import random
 import sqlite3
-import boto3
-from flask import current_app, g
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, g, has_request_context, request
+
+import lazy
+import metrics
+import model
+
+# Only imported if the app runs on dynamodb, see lazy.py
+boto3 = lazy.Module("boto3")
+conditions = lazy.Module("boto3.dynamodb.conditions")
+dynamodb_types = lazy.Module("boto3.dynamodb.types")
+botocore_config = lazy.Module("botocore.config")
+botocore_exceptions = lazy.Module("botocore.exceptions")
+
+
+class SQLitePool:
+    """ A pool of open sqlite connections, so a request borrows a connection that's
+    already open and tuned rather than paying to set one up. A connection is only
+    ever used by the thread that borrowed it, until it's handed back.
+    """
+
+    def __init__(self, path, size, backend="sqlite3"):
+        self.path = path
+        self.backend = backend
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def connect(self):
+        """ Open and tune a new connection """
+        conn = metrics.connect(self.path, self.backend, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # WAL lets readers carry on while a write is going on. NORMAL sync is safe
+        # with WAL, and skips an fsync per commit.
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA cache_size = -16000")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA mmap_size = 268435456")
+        # The search triggers need this to see out of line memoranda
+        conn.create_function("memo_text", 1, model.unsplit_memo, deterministic=True)
+        return conn
+
+    def get(self):
+        """ Borrow a connection, opening a new one if none are idle """
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def put(self, conn):
+        """ Hand a connection back, discarding anything left uncommitted. If the pool
+        is already full, it's closed instead. """
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+# Most writes in one dynamodb TransactWriteItems, which is its limit
+TRANSACTION_ITEMS = 100
+
+# Most keys in one dynamodb BatchGetItem, which is its limit
+BATCH_GET_ITEMS = 100
+
+# How many more goes a transaction that was throttled, or clashed with another, or
+# a batch read's unprocessed keys get, and the shortest and longest jittered waits
+# before them (see _backoff), in seconds
+RETRIES = 5
+BACKOFF_BASE = 0.05
+BACKOFF_CAP = 2
+
+# Errors, and transaction cancellation reasons, that mean try again in a bit
+RETRY_CODES = ("ThrottlingError", "ThrottlingException", "ProvisionedThroughputExceeded",
+               "ProvisionedThroughputExceededException", "RequestLimitExceeded",
+               "TransactionConflict", "InternalServerError")
+
+# Long lived, per worker process connection objects, set up on first use. boto3
+# resources aren't thread safe, so each thread has its own in _local.
+_sqlite_pool = None
+_dynamodb = None
+_connect_lock = threading.Lock()
+_local = threading.local()
+
+# The worker's reserved block of dynamodb project numbers, as [next, last]
+_numbers = [1, 0]
+_numbers_lock = threading.Lock()
+
+
+def _get_sqlite_pool():
+    """ The worker's sqlite connection pool """
+    global _sqlite_pool  # pylint: disable=global-statement
+    with _connect_lock:
+        if _sqlite_pool is None:
+            _sqlite_pool = SQLitePool(current_app.config['SQLITE_PATH'],
+                                      current_app.config['SQLITE_POOL_SIZE'])
+        return _sqlite_pool
+
+
+def _get_dynamodb_resource():
+    """ This thread's dynamodb resource object. A resource isn't thread safe, but the
+    low level client under it is, so the worker has one client, and with it one
+    keep-alive HTTP connection pool, and each thread wraps it in a resource of its
+    own, as boto3.resource does. """
+    global _dynamodb  # pylint: disable=global-statement
+    resource = getattr(_local, 'dynamodb', None)
+    if resource is None:
+        with _connect_lock:
+            if _dynamodb is None:
+                config = botocore_config.Config(
+                    max_pool_connections=current_app.config['DYNAMODB_POOL_SIZE'],
+                    tcp_keepalive=True)
+                _dynamodb = boto3.resource('dynamodb', region_name='eu-west-1',
+                                           config=config)
+        resource = _local.dynamodb = type(_dynamodb)(client=_dynamodb.meta.client)
+        _local.dynamodb_tables = {}
+    return resource
+
+
+def _get_dynamodb_table(name):
+    """ This thread's table object for a dynamodb table, see _get_dynamodb_resource """
+    resource = _get_dynamodb_resource()
+    if name not in _local.dynamodb_tables:
+        _local.dynamodb_tables[name] = metrics.instrument_table(resource.Table(name))
+    return _local.dynamodb_tables[name]
 
 
 def get_db():
-    """Connect to the application's configured database. The connection
-    is unique for each request and will be reused if this is called
-    again.
+    """Get a connection to the application's configured database. The connection
+    comes from a pool shared by the whole worker, is unique for each request,
+    and will be reused if this is called again.
     """
     if "db" not in g:
         if current_app.config['DBTYPE'] == "sqlite3":
-            g.db = sqlite3.connect("db/sql3-database.sdb")
-            g.db.row_factory = sqlite3.Row
+            g.db = _get_sqlite_pool().get()
         elif current_app.config['DBTYPE'] == "dynamodb":
-            conn = boto3.resource('dynamodb', region_name='eu-west-1')
-            g.db = conn.Table(current_app.config['TABLENAME'])  # return table object for dynamodb
+            # return table object for dynamodb
+            g.db = _get_dynamodb_table(current_app.config['TABLENAME'])
         else:
             g.db = None  # ruh-roh raggy!
 
     return g.db
 
 
-def close_db(e=None):
-    """If this request connected to the database, close the
-    connection.
+def get_memo_table():
+    """ The dynamodb table large memoranda are kept in, see insert_project """
+    return _get_dynamodb_table(current_app.config['MEMOTABLE'])
+
+
+def insert_project(table, item):
+    """ Write a new project to dynamodb, as long as there's no project with its number
+    already. Memoranda over MEMO_THRESHOLD go to the memo table, compressed, in the
+    same transaction, so a taken number leaves the memoranda there alone, and the
+    project item is left with just memo_size.
+    ::parameter table: dynamodb table object
+    ::parameter item: project item, updated in place to what was written
+    ::returns True if written, False if the number was taken """
+    body = model.split_memo(item, current_app.config['MEMO_THRESHOLD'])
+    new = {'ConditionExpression': "attribute_not_exists(#num)",
+           'ExpressionAttributeNames': {'#num': 'number'}}
+    client = table.meta.client
+    if body is None:
+        try:
+            table.put_item(Item=item, **new)
+        except client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    serializer = dynamodb_types.TypeSerializer()
+    try:
+        client.transact_write_items(TransactItems=[
+            {'Put': {'TableName': current_app.config['MEMOTABLE'],
+                     'Item': {'number': serializer.serialize(item['number']),
+                              'body': serializer.serialize(body)}}},
+            {'Put': dict(new, TableName=table.name,
+                         Item={name: serializer.serialize(value)
+                               for name, value in item.items()})}])
+    except client.exceptions.TransactionCanceledException as err:
+        reasons = err.response.get('CancellationReasons', [])
+        if any(reason.get('Code') == 'ConditionalCheckFailed' for reason in reasons):
+            return False
+        raise
+    return True
+
+
+def _seed_counter(table):
+    """ Start LAST_NUMBER off at the highest project number there is, if there's no
+    counter yet, as the importer does. A table loaded before there was one would
+    otherwise have its numbers handed out again from 1. """
+    counter = table.get_item(Key={'number': model.COUNTER_NUMBER},
+                             **projection((model.LAST_NUMBER,))).get('Item', {})
+    if model.LAST_NUMBER in counter:
+        return
+    highest = max((int(item['number'])
+                   for item in iter_pages(table.scan, **projection(("number",)))), default=0)
+    try:
+        table.update_item(Key={'number': model.COUNTER_NUMBER},
+                          UpdateExpression="SET #last = :highest",
+                          ConditionExpression="attribute_not_exists(#last)",
+                          ExpressionAttributeNames={'#last': model.LAST_NUMBER},
+                          ExpressionAttributeValues={':highest': highest})
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        pass  # Another worker got there first
+
+
+def next_number(table):
+    """ Hand out a new dynamodb project number. There's no auto increment, so numbers
+    come from LAST_NUMBER on the counter item, which the importer starts off at the
+    highest number it loaded (or, if it's not there, see _seed_counter). Each worker
+    reserves NUMBER_BLOCK numbers at a time with an atomic ADD, then hands them out
+    from memory, so the counter is only written once a block rather than for every
+    project. A worker that stops part way through a block leaves a gap in the numbers.
+    ::parameter table: dynamodb table object
+    ::returns int """
+    with _numbers_lock:
+        if _numbers[0] > _numbers[1]:
+            if _numbers[1] == 0:
+                # The worker's first block
+                _seed_counter(table)
+            block = current_app.config['NUMBER_BLOCK']
+            response = table.update_item(
+                Key={'number': model.COUNTER_NUMBER},
+                UpdateExpression="ADD #last :block",
+                ExpressionAttributeNames={'#last': model.LAST_NUMBER},
+                ExpressionAttributeValues={':block': block},
+                ReturnValues='UPDATED_NEW')
+            last = int(response['Attributes'][model.LAST_NUMBER])
+            _numbers[:] = [last - block + 1, last]
+        number = _numbers[0]
+        _numbers[0] = number + 1
+        return number
+
+
+def insert_project_row(db, project):
+    """ Add a new project to sqlite3, with AUTOINCREMENT picking its number. Large
+    memoranda go to the memoranda table, as store_memoranda does. Commits.
+    ::parameter db: sqlite3 connection
+    ::parameter project: dict of column: value, columns from model.EDITABLE only,
+                         as they go straight into the SQL
+    ::returns the new project's number """
+    project = dict(project)
+    body = model.split_memo(project, current_app.config['MEMO_THRESHOLD'])
+    project.pop('memo_size', None)
+    cursor = db.execute(f"""INSERT INTO projects ({', '.join(project)})
+                        VALUES ({', '.join('?' for _ in project)})""", tuple(project.values()))
+    if body is not None:
+        db.execute("INSERT INTO memoranda (number, body) VALUES (?, ?)",
+                   (cursor.lastrowid, body))
+    db.commit()
+    return cursor.lastrowid
+
+
+def update_expression(changed, prefix="u"):
+    """ An UpdateExpression that SETs or REMOVEs attributes, in string form so it
+    works in a transaction too
+    ::parameter changed: dict of attribute: new value, None meaning remove it
+    ::parameter prefix: for the placeholder names, so they don't clash with others
+    ::returns (expression, ExpressionAttributeNames, ExpressionAttributeValues) """
+    names = {}
+    values = {}
+    sets = []
+    removes = []
+    for count, (column, value) in enumerate(changed.items()):
+        names[f"#{prefix}{count}"] = column
+        if value is None:
+            removes.append(f"#{prefix}{count}")
+        else:
+            values[f":{prefix}{count}"] = value
+            sets.append(f"#{prefix}{count} = :{prefix}{count}")
+    expression = []
+    if sets:
+        expression.append("SET " + ", ".join(sets))
+    if removes:
+        expression.append("REMOVE " + ", ".join(removes))
+    return " ".join(expression), names, values
+
+
+def _conditional_update(number, changed, expected):
+    """ update_item parameters to SET or REMOVE the changed attributes of a project,
+    only if its last_modified is still what it was loaded with. String expressions
+    throughout, so they work in a transaction too.
+    ::returns dict of update_item parameters """
+    expression, names, values = update_expression(changed)
+    names['#lm'] = 'last_modified'
+    if expected is None:
+        names['#num'] = 'number'
+        condition = "attribute_exists(#num) AND attribute_not_exists(#lm)"
+    else:
+        values[':expected'] = expected
+        condition = "#lm = :expected"
+    update = {'Key': {'number': number}, 'UpdateExpression': expression,
+              'ConditionExpression': condition, 'ExpressionAttributeNames': names}
+    if values:
+        update['ExpressionAttributeValues'] = values
+    return update
+
+
+def _transact_update(update, table_name):
+    """ update_item parameters as a TransactWriteItems action, for the low level
+    client, which wants everything typed """
+    serializer = dynamodb_types.TypeSerializer()
+    action = dict(update, TableName=table_name,
+                  Key={name: serializer.serialize(value) for name, value in update['Key'].items()})
+    values = action.pop('ExpressionAttributeValues', None)
+    if values:
+        action['ExpressionAttributeValues'] = {name: serializer.serialize(value)
+                                               for name, value in values.items()}
+    return {'Update': action}
+
+
+def update_project(table, project, changed, expected):
+    """ Write just the changed attributes of a dynamodb project, as long as nobody
+    else has written it since it was loaded. Large memoranda go to the memo table,
+    as insert_project does, in the same transaction so a lost race leaves them alone.
+    ::parameter table: dynamodb table object
+    ::parameter project: the project as loaded (see load_memoranda)
+    ::parameter changed: dict of attribute: new value, None to remove it
+    ::parameter expected: the last_modified it was loaded with, None if it had none
+    ::returns True if written, False if it had been changed in the meantime """
+    changed = dict(changed)
+    number = project['number']
+    body = None
+    if 'memoranda' in changed:
+        moved = {'memoranda': changed['memoranda']}
+        body = model.split_memo(moved, current_app.config['MEMO_THRESHOLD'])
+        if body is not None:
+            changed['memoranda'] = None
+            changed['memo_size'] = moved['memo_size']
+        elif 'memo_size' in project:
+            changed['memo_size'] = None
+
+    update = _conditional_update(number, changed, expected)
+    client = table.meta.client
+    if body is None:
+        try:
+            table.update_item(**update)
+        except client.exceptions.ConditionalCheckFailedException:
+            return False
+        if changed.get('memo_size', 0) is None:
+            # They've come back inline, so the out of line copy can go
+            get_memo_table().delete_item(Key={'number': number})
+        return True
+
+    serializer = dynamodb_types.TypeSerializer()
+    try:
+        client.transact_write_items(TransactItems=[
+            {'Put': {'TableName': current_app.config['MEMOTABLE'],
+                     'Item': {'number': serializer.serialize(number),
+                              'body': serializer.serialize(body)}}},
+            _transact_update(update, table.name)])
+    except client.exceptions.TransactionCanceledException as err:
+        reasons = err.response.get('CancellationReasons', [])
+        if any(reason.get('Code') == 'ConditionalCheckFailed' for reason in reasons):
+            return False
+        raise
+    return True
+
+
+def update_projects(table, updates):
+    """ Write the changed attributes of many dynamodb projects, as update_project
+    does but TRANSACTION_ITEMS at a time, each in one TransactWriteItems. A project
+    someone else has written since it was loaded is left alone, and the rest of its
+    transaction tried again without it. A transaction that's throttled is tried
+    again after a wait; one that still can't be written leaves its projects failed,
+    and the rest are carried on with. Memoranda can't be changed this way.
+    ::parameter table: dynamodb table object
+    ::parameter updates: list of (number, changed, expected), as for update_project
+    ::returns dict of number: True if written, False if it had been changed, None if
+              it failed """
+    written = {}
+    for start in range(0, len(updates), TRANSACTION_ITEMS):
+        written.update(_update_batch(table, updates[start:start + TRANSACTION_ITEMS]))
+    return written
+
+
+def _update_batch(table, batch):
+    """ One TransactWriteItems of update_projects, retried as it says
+    ::returns dict of number: True, False or None, as for update_projects """
+    client = table.meta.client
+    written = {}
+    attempt = 0
+    while batch:
+        error, retry = None, False
+        try:
+            client.transact_write_items(TransactItems=[
+                _transact_update(_conditional_update(number, changed, expected), table.name)
+                for number, changed, expected in batch])
+        except client.exceptions.TransactionCanceledException as err:
+            reasons = [reason.get('Code') for reason in err.response.get('CancellationReasons', [])]
+            if 'ConditionalCheckFailed' in reasons:
+                written.update((number, False) for (number, _, _), reason in zip(batch, reasons)
+                               if reason == 'ConditionalCheckFailed')
+                batch = [update for update, reason in zip(batch, reasons)
+                         if reason != 'ConditionalCheckFailed']
+                continue
+            error = err
+            retry = any(reason in RETRY_CODES for reason in reasons)
+        except client.exceptions.ProvisionedThroughputExceededException as err:
+            error, retry = err, True
+        except botocore_exceptions.ClientError as err:
+            error, retry = err, err.response.get('Error', {}).get('Code') in RETRY_CODES
+        else:
+            written.update((number, True) for number, _, _ in batch)
+            break
+        attempt = attempt + 1
+        if not retry or attempt > RETRIES:
+            current_app.logger.warning("Couldn't write %d projects, from %s: %s",
+                                       len(batch), batch[0][0], error)
+            written.update((number, None) for number, _, _ in batch)
+            break
+        _backoff(attempt)
+    return written
+
+
+def _backoff(attempt):
+    """ Wait before another go at a throttled dynamodb call: a random time up to one
+    that doubles with each attempt, as far as BACKOFF_CAP, as the importer does
+    ::parameter attempt: how many goes there have been """
+    time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+
+
+def update_project_row(db, number, changed, expected):
+    """ sqlite3 version of update_project: write just the changed columns, as long as
+    nobody else has written the project since it was loaded. Commits if it does.
+    ::parameter db: sqlite3 connection
+    ::parameter number: project number
+    ::parameter changed: dict of column: new value, None for NULL. Columns must be
+                         from model.EDITABLE, as they go straight into the SQL.
+    ::parameter expected: the last_modified it was loaded with
+    ::returns True if written, False if it had been changed in the meantime """
+    changed = dict(changed)
+    if 'memoranda' in changed:
+        changed['memoranda'] = store_memoranda(db, number, changed['memoranda'])
+    if not _update_row(db, number, changed, expected):
+        db.rollback()
+        return False
+    db.commit()
+    return True
+
+
+def _update_row(db, number, changed, expected):
+    """ The conditional UPDATE for update_project_row and update_project_rows, in
+    the caller's transaction
+    ::returns True if it changed the row """
+    cursor = db.execute(f"""UPDATE projects SET {', '.join(c + ' = ?' for c in changed)}
+                        WHERE number = ? AND last_modified IS ?""",
+                        (*changed.values(), number, expected))
+    return cursor.rowcount == 1
+
+
+def update_project_rows(db, updates):
+    """ sqlite3 version of update_projects: update_project_row for many projects,
+    all in one transaction and one commit. A project someone else has written since
+    it was loaded is left alone; the rest are still written.
+    ::parameter db: sqlite3 connection
+    ::parameter updates: list of (number, changed, expected), as for update_project_row,
+                         but without memoranda
+    ::returns dict of number: True if written, False if it had been changed """
+    written = {number: _update_row(db, number, changed, expected)
+               for number, changed, expected in updates}
+    db.commit()
+    return written
+
+
+def batch_get(table, numbers, columns):
+    """ Read many dynamodb projects by number, BATCH_GET_ITEMS at a time. Keys dynamodb
+    hands back unprocessed, as it does when throttled, are asked for again after a
+    wait (see _backoff), up to RETRIES times running without any being read.
+    ::parameter table: dynamodb table object
+    ::parameter numbers: project numbers
+    ::parameter columns: the attributes to read
+    ::returns dict of number: item, for those that exist, and None for those still
+              unprocessed once the retries ran out """
+    client = table.meta.client
+    serializer = dynamodb_types.TypeSerializer()
+    deserializer = dynamodb_types.TypeDeserializer()
+    found = {}
+    for start in range(0, len(numbers), BATCH_GET_ITEMS):
+        wanted = {table.name: dict(projection(columns), Keys=[
+            {'number': serializer.serialize(number)}
+            for number in numbers[start:start + BATCH_GET_ITEMS]])}
+        attempt = 0
+        while wanted:
+            response = client.batch_get_item(RequestItems=wanted)
+            items = response['Responses'].get(table.name, [])
+            for typed in items:
+                item = {key: deserializer.deserialize(value) for key, value in typed.items()}
+                found[int(item['number'])] = item
+            wanted = response.get('UnprocessedKeys')
+            if not wanted:
+                break
+            attempt = 1 if items else attempt + 1
+            if attempt > RETRIES:
+                unread = [int(deserializer.deserialize(key['number']))
+                          for key in wanted[table.name]['Keys']]
+                current_app.logger.warning("Couldn't read %d projects, from %s",
+                                           len(unread), unread[0])
+                found.update((number, None) for number in unread)
+                break
+            _backoff(attempt)
+    return found
+
+
+def load_memoranda(project):
+    """ Put a dynamodb project's memoranda back, if they're kept out of line.
+    (sqlite3 reads them from projects_text.) Only show and edit need them.
+    ::parameter project: project item, updated in place
+    ::returns the same item """
+    if 'memo_size' in project:
+        memo = get_memo_table().get_item(Key={'number': project['number']})
+        project['memoranda'] = model.unsplit_memo(memo.get('Item', {}).get('body'))
+    return project
+
+
+def store_memoranda(db, number, memo):
+    """ Keep a sqlite3 project's memoranda in the memoranda table, compressed, if
+    they're over MEMO_THRESHOLD; otherwise make sure there's nothing there.
+    ::parameter db: sqlite3 connection, in the caller's transaction
+    ::parameter number: project number
+    ::parameter memo: the memoranda
+    ::returns what the projects row's memoranda column should hold """
+    project = {'memoranda': memo}
+    body = model.split_memo(project, current_app.config['MEMO_THRESHOLD'])
+    if body is None:
+        db.execute("DELETE FROM memoranda WHERE number = ?", (number,))
+        return memo
+    db.execute("""INSERT INTO memoranda (number, body) VALUES (?, ?)
+               ON CONFLICT (number) DO UPDATE SET body = excluded.body""", (number, body))
+    return None
+
+
+def _cursor_type():
+    """ What this request's cursors are good for: the kind of database its pages are
+    read from, and the view they're read for. With a dynamodb replica, the kind can
+    change between one page and the next (see replica.read_type), and each kind's
+    cursors mean nothing to the other. Each view's keys have a shape of their own
+    too: a number, a date and a number, or a month and a dynamodb key. The view is
+    the endpoint, or g.cursor_view where one endpoint has more than one shape.
+    ::returns [kind, view] """
+    view = g.get("cursor_view") or (request.endpoint if has_request_context() else None)
+    return [g.get("read_type", current_app.config['DBTYPE']), view]
+
+
+def encode_cursor(key):
+    """ Turn the key of the last row on a page into an opaque, url safe cursor.
+    Dynamodb keys are all whole numbers or strings, so Decimals go out as ints.
+    ::parameter key: anything json can take, or None
+    ::returns cursor string, or None if key is None """
+    if key is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps([_cursor_type(), key],
+                                               default=int).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """ Reverse of encode_cursor. A missing or mangled cursor, or one from the other
+    kind of database or another view, means start from the top.
+    ::parameter cursor: cursor string from the query string
+    ::returns the key, or None """
+    if not cursor:
+        return None
+    try:
+        kind, key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    return key if kind == _cursor_type() else None
+
+
+class Page:  # pylint: disable=too-few-public-methods
+    """ One page of a keyset paginated list view.
+    Iterating over it yields the rows as they are read from the database. Once it's
+    been iterated, next_cursor is the cursor for the following page, or None if this
+    was the last one. Pass size and key_of when rows has been asked for one row more
+    than the page size, so we can tell whether there's anything after this page.
+    """
+
+    def __init__(self, rows, size=None, key_of=None, next_cursor=None):
+        self.rows = rows
+        self.size = size
+        self.key_of = key_of
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        last = None
+        for count, row in enumerate(self.rows):
+            if count == self.size:
+                # There's at least one row past the end of this page
+                self.next_cursor = encode_cursor(self.key_of(last))
+                break
+            last = row
+            yield row
+
+
+def iter_pages(read, **kwargs):
+    """ Call a dynamodb read (scan or query) repeatedly until there's no
+    LastEvaluatedKey left, yielding items as each page comes in. Each call returns
+    at most 1MB of data, so that's all that's ever held at once.
+    ::parameter read: table.scan or table.query
+    ::parameter kwargs: the parameters for the read
+    ::returns generator of items """
+    while True:
+        page = read(**kwargs)
+        yield from page['Items']
+        if 'LastEvaluatedKey' not in page:
+            break
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def read_all_pages(read, **kwargs):
+    """ Every item from a dynamodb read (scan or query), following all its pages
+    ::parameter read: table.scan or table.query
+    ::parameter kwargs: the parameters for the read
+    ::returns list of items """
+    return list(iter_pages(read, **kwargs))
+
+
+def read_page(read, after=None, **kwargs):
+    """ Call a dynamodb read (scan or query) for a single page of PAGE_SIZE items
+    ::parameter read: table.scan or table.query
+    ::parameter after: decoded cursor from the previous page, i.e. its LastEvaluatedKey
+    ::parameter kwargs: the parameters for the read
+    ::returns Page """
+    kwargs['Limit'] = current_app.config['PAGE_SIZE']
+    if after:
+        kwargs['ExclusiveStartKey'] = after
+    page = read(**kwargs)
+    return Page(page['Items'], next_cursor=encode_cursor(page.get('LastEvaluatedKey')))
+
+
+def projection(columns):
+    """ Read parameters to fetch only the given attributes of each item. Every name
+    goes through ExpressionAttributeNames, as number and status are reserved words.
+    ::parameter columns: attribute names
+    ::returns dict of ProjectionExpression and ExpressionAttributeNames """
+    names = {f"#p{count}": column for count, column in enumerate(columns)}
+    return {'ProjectionExpression': ", ".join(names),
+            'ExpressionAttributeNames': names}
+
+
+def _status_query(status, newest_first):
+    """ Parameters for reading one status from the status index. Items come back
+    sorted on status_key, which is the order the list view for that status wants. """
+    return {'IndexName': model.STATUS_INDEX,
+            'KeyConditionExpression': conditions.Key('status').eq(status),
+            'ScanIndexForward': not newest_first}
+
+
+def query_status(table, status, columns, newest_first=False):
+    """ Read every project in one status from the status index.
+    ::parameter table: dynamodb table object
+    ::parameter status: one of model.STATUSES
+    ::parameter columns: the attributes to read, which the index must include
+    ::parameter newest_first: reverse the index order
+    ::returns list of items """
+    return read_all_pages(table.query, **_status_query(status, newest_first),
+                          **projection(columns))
+
+
+def query_status_before(table, status, column, before, columns):
+    """ Read the projects in one status with a date before a given one from the status
+    index. Where that's the date the status is sorted on (see model.STATUS_DATES)
+    it's a range on status_key, so only those projects are read. Otherwise dynamodb
+    filters the rest out, which still reads the whole status but sends back less.
+    ::parameter table: dynamodb table object
+    ::parameter status: one of model.STATUSES
+    ::parameter column: date attribute, e.g. "started_on"
+    ::parameter before: ISO date string
+    ::parameter columns: the attributes to read, which the index must include
+    ::returns list of items """
+    query = _status_query(status, False)
+    if model.STATUS_DATES.get(status) == column:
+        query['KeyConditionExpression'] = (query['KeyConditionExpression']
+                                           & conditions.Key('status_key').lt(before))
+    else:
+        query['FilterExpression'] = conditions.Attr(column).lt(before)
+    return read_all_pages(table.query, **query, **projection(columns))
+
+
+def query_status_page(table, status, columns, after=None, newest_first=False):
+    """ Read one page of projects in one status from the status index.
+    ::parameter table: dynamodb table object
+    ::parameter status: one of model.STATUSES
+    ::parameter columns: the attributes to read, which the index must include
+    ::parameter after: decoded cursor from the previous page
+    ::parameter newest_first: reverse the index order
+    ::returns Page """
+    return read_page(table.query, after, **_status_query(status, newest_first),
+                     **projection(columns))
+
+
+def _timeline_query(column, month, span, columns):
+    """ Parameters for reading one month of a date range from the timeline index
+    on that date. Items come back in date order. """
+    index, month_key, time_key = model.timeline_index(column)
+    return {'IndexName': index,
+            'KeyConditionExpression': conditions.Key(month_key).eq(month)
+            & conditions.Key(time_key).between(model.epoch(span[0]), model.epoch(span[1]) - 1),
+            **projection(columns)}
+
+
+def query_timeline_page(table, column, span, columns, after=None):
+    """ Read one page of the projects with a date in a range, oldest first, from that
+    date's timeline index (see model.add_timeline). The range is read a month's
+    partition at a time, so it costs what's in the range, not the size of the table.
+    ::parameter table: dynamodb table object
+    ::parameter column: one of model.TIMELINE_COLUMNS
+    ::parameter span: (start, end) ISO date strings, the earliest in the range and
+                      the first after it
+    ::parameter columns: the attributes to read, which the index must include
+    ::parameter after: decoded cursor from the previous page: [month, the key to
+                       carry on from in that month, or None for all of it]
+    ::returns Page """
+    months = model.months(*span)
+    start_key = None
+    if after:
+        months = [month for month in months if month >= after[0]]
+        start_key = after[1]
+
+    size = current_app.config['PAGE_SIZE']
+    items = []
+    for position, month in enumerate(months):
+        kwargs = _timeline_query(column, month, span, columns)
+        if start_key:
+            kwargs['ExclusiveStartKey'] = start_key
+            start_key = None
+        while True:
+            kwargs['Limit'] = size - len(items)
+            page = table.query(**kwargs)
+            items.extend(page['Items'])
+            if 'LastEvaluatedKey' not in page:
+                break
+            if len(items) == size:
+                return Page(items, next_cursor=encode_cursor([month,
+                                                              page['LastEvaluatedKey']]))
+            kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+        if len(items) == size and position + 1 < len(months):
+            return Page(items, next_cursor=encode_cursor([months[position + 1], None]))
+    return Page(items)
+
+
+def scan_segment(table, segment=None, total_segments=None, **kwargs):
+    """ Scan one segment of a dynamodb table, following every page.
+    ::parameter table: dynamodb table object
+    ::parameter segment, total_segments: which slice of a parallel scan to read,
+                                         or None for the whole table
+    ::parameter kwargs: any other scan parameters, e.g. FilterExpression
+    ::returns list of items """
+    if total_segments is not None:
+        kwargs['Segment'] = segment
+        kwargs['TotalSegments'] = total_segments
+
+    return read_all_pages(table.scan, **kwargs)
+
+
+def scan_table(table, **kwargs):
+    """ Scan the whole of a dynamodb table and return every matching item.
+    The table is split into SCAN_SEGMENTS parallel segment scans on a thread pool,
+    and the results merged. With SCAN_SEGMENTS of 1 (or unset), it's a plain
+    paginated scan on this thread.
+    ::parameter table: dynamodb table object
+    ::parameter kwargs: any other scan parameters, e.g. FilterExpression
+    ::returns list of items """
+    segments = current_app.config.get('SCAN_SEGMENTS', 1)
+    if segments <= 1:
+        return scan_segment(table, **kwargs)
+
+    app = current_app._get_current_object()  # pylint: disable=protected-access
+
+    def scan(segment):
+        # On the pool's thread, with a table object of its own
+        with app.app_context():
+            return scan_segment(_get_dynamodb_table(table.name), segment, segments, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        results = pool.map(scan, range(segments))
+        items = []
+        for result in results:
+            items.extend(result)
+
+    return items
+
+
+def reindex(table):
+    """ Set the derived attributes the indexes are keyed on (model.DERIVED_COLUMNS:
+    status, status_key and the timeline keys) on every dynamodb project that's
+    missing them or has them wrong. Projects written before the status or timeline
+    indexes were added to the table have none, so they're in none of the list views,
+    the timeline or the replica's incremental syncs until this has been run.
+    Projects are read a page at a time.
+    ::parameter table: dynamodb table object
+    ::returns how many projects were updated """
+    columns = ("number", "created", "done", "started_on", "stopped_on", "continuous",
+               "last_modified") + model.DERIVED_COLUMNS
+    updated = 0
+    # Everything but the counter item, which isn't a project
+    for item in iter_pages(table.scan,
+                           FilterExpression=conditions.Attr('number').ne(model.COUNTER_NUMBER),
+                           **projection(columns)):
+        wanted = model.add_timeline(model.add_status(dict(item)))
+        changed = {column: wanted.get(column) for column in model.DERIVED_COLUMNS
+                   if wanted.get(column) != item.get(column)}
+        if changed:
+            expression, names, values = update_expression(changed)
+            kwargs = {'ExpressionAttributeValues': values} if values else {}
+            table.update_item(Key={'number': item['number']}, UpdateExpression=expression,
+                              ExpressionAttributeNames=names, **kwargs)
+            updated = updated + 1
+    return updated
+
+
+class ReadCache:
+    """ Process wide, read-through cache for the list view queries.
+    Entries are least-recently-used evicted once there are more than maxsize of them,
+    expire after ttl seconds, and carry a set of tags (project statuses) so a write
+    can drop exactly the entries that might show the project it changed.
     """
-    if current_app.config['DBTYPE'] == "sqlite3":
-        db = g.pop("db", None)
 
-        if db is not e:
-            db.close()
-    # Otherwise, do nothing, dynamodb has no close as such
+    def __init__(self, maxsize, ttl, max_rows):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.entries = OrderedDict()  # key -> (expires, tags, value)
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key):
+        """ Look up a key
+        ::returns the cached list or Page, or None on a miss """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return entry[2]
+
+    def put(self, key, tags, value):
+        """ Store a list of rows, or a Page holding one, unless it's too big to be
+        worth keeping """
+        rows = value.rows if isinstance(value, Page) else value
+        if len(rows) > self.max_rows:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, frozenset(tags), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def invalidate(self, tags):
+        """ Drop every entry carrying any of the given tags """
+        tags = set(tags)
+        with self.lock:
+            stale = [key for key, entry in self.entries.items() if entry[1] & tags]
+            for key in stale:
+                del self.entries[key]
+            self.counters['invalidations'] += len(stale)
+
+    def stats(self):
+        """ Counters, for checking the cache is earning its keep """
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries))
+
+
+class _CachingPage(Page):  # pylint: disable=too-few-public-methods
+    """ Passes a freshly read page through to the template, row by row, and
+    stores it in the cache once it has been read to the end """
+
+    def __init__(self, page, store):
+        super().__init__(None)
+        self.page = page
+        self.store = store
+
+    def __iter__(self):
+        rows = []
+        for row in self.page:
+            rows.append(row)
+            yield row
+        self.next_cursor = self.page.next_cursor
+        self.store(Page(rows, next_cursor=self.next_cursor))
+
+
+_cache = None
+
+
+def _with_dates(value):
+    """ Normalise the dates in a freshly loaded list or Page of rows, as they're read """
+    if isinstance(value, Page):
+        value.rows = map(model.with_dates, value.rows)
+        return value
+    return [model.with_dates(row) for row in value]
+
+
+def cached(key, tags, load):
+    """ Read-through cache in front of a list view query.
+    ::parameter key: hashable key for the query, including any cursor
+    ::parameter tags: project statuses the result shows, "all" included if it
+                      shows every status
+    ::parameter load: function to run the query on a miss, returning a list or a Page
+    ::returns list or Page, as load does, of rows passed through model.with_dates """
+    if _cache is None:
+        return _with_dates(load())
+
+    value = _cache.get(key)
+    if value is not None:
+        return value
+
+    value = _with_dates(load())
+    if isinstance(value, Page):
+        return _CachingPage(value, lambda page: _cache.put(key, tags, page))
+    _cache.put(key, tags, value)
+    return value
+
+
+def invalidate(*statuses):
+    """ Tell the read cache a project has been written. Pass its status before and
+    after the write (or just one for a create or delete), and every cached result
+    that could have shown it is dropped. """
+    if _cache is not None:
+        _cache.invalidate(set(statuses) | {"all"})
+
+
+def cache_stats():
+    """ Hit/miss counters for the read cache
+    ::returns dict, empty if the cache is off """
+    if _cache is None:
+        return {}
+    return _cache.stats()
+
+
+def close_db(e=None):  # pylint: disable=unused-argument
+    """If this request borrowed a database connection, hand it back to the pool.
+    """
+    db = g.pop("db", None)
+    if db is not None and current_app.config['DBTYPE'] == "sqlite3":
+        _get_sqlite_pool().put(db)
+    # Otherwise, do nothing, the dynamodb table object just stays put
 
 
 def init_app(app):
     """Register database functions with the Flask app. This is called by
     the application factory.
     """
+    global _cache  # pylint: disable=global-statement
+    lazy.load(app.config['DBTYPE'])
     app.teardown_appcontext(close_db)
+    if app.config.get('CACHE_SIZE', 0) > 0:
+        _cache = ReadCache(app.config['CACHE_SIZE'], app.config['CACHE_TTL'],
+                           app.config['CACHE_MAX_ROWS'])
+    else:
+        _cache = None
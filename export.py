@@ -0,0 +1,98 @@
+""" Export.py:
+    Dump projects out of the database, for backups and reporting: as csv in the
+    layout the importer reads, so an export can be loaded straight back in, or as
+    json lines. Projects are read and written one at a time, from a sqlite cursor
+    or the pages of a dynamodb scan, so it takes the same memory however big the
+    table is. Given a watermark, only projects modified since are exported, which
+    keeps nightly incremental backups small.
+    """
+
+import csv
+import datetime
+import json
+from flask import current_app
+import database
+import lazy
+import model
+
+FORMATS = ("csv", "jsonl")
+
+# Only imported if the app runs on dynamodb, see lazy.py
+conditions = lazy.Module("boto3.dynamodb.conditions")
+
+
+def projects(since=None):
+    """ Every project, with out of line memoranda put back
+    ::parameter since: watermark; leave out projects last modified before this.
+                       Ones modified in the watermark's own minute are kept, as
+                       they may have changed after it was taken, and so are any
+                       with no last_modified at all.
+    ::returns generator of dicts with model.CSV_COLUMNS """
+    if current_app.config["DBTYPE"] == "sqlite3":
+        db = database.get_db()
+        query = f"""select {','.join('p.' + column for column in model.CSV_COLUMNS
+                                     if column != 'memoranda')}, t.memoranda
+                 from projects p join projects_text t on t.number = p.number"""
+        if since:
+            rows = db.execute(query + """ where p.last_modified >= ? or p.last_modified is null
+                              order by p.number""", (since,))
+        else:
+            rows = db.execute(query + " order by p.number")
+        for row in rows:
+            yield {column: row[column] for column in model.CSV_COLUMNS}
+    else:
+        # Only projects have a status, which leaves out the counter item
+        wanted = conditions.Attr('status').exists()
+        if since:
+            wanted = wanted & (conditions.Attr('last_modified').gte(since)
+                               | conditions.Attr('last_modified').not_exists())
+        for item in database.iter_pages(database.get_db().scan, FilterExpression=wanted):
+            item = database.load_memoranda(item)
+            yield {column: item.get(column) for column in model.CSV_COLUMNS}
+
+
+def csv_date(value):
+    """ A stored date as the importer expects to read it. Not cached like
+    model.parse_date: a full export sees most dates just the once.
+    ::parameter value: ISO date string, or None
+    ::returns string, blank if unset """
+    if not model.is_set(value):
+        return ""
+    try:
+        return datetime.datetime.fromisoformat(str(value)).strftime(model.CSV_DATE_FORMAT)
+    except ValueError:
+        return str(value)
+
+
+def _plain(project):
+    """ A project with its numbers as plain ints rather than dynamodb Decimals """
+    for column in ("number", "continuous"):
+        if project[column] is not None:
+            project[column] = int(project[column])
+    return project
+
+
+def write(out, rows, fmt="csv"):
+    """ Write projects to a file as they're read
+    ::parameter out: text file, opened with newline="" for csv
+    ::parameter rows: projects, see projects()
+    ::parameter fmt: one of FORMATS
+    ::returns (how many were written, the newest last_modified, to pass as the
+              watermark next time) """
+    count = 0
+    newest = None
+    if fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(model.CSV_COLUMNS)
+    for project in rows:
+        project = _plain(project)
+        if fmt == "csv":
+            writer.writerow([csv_date(project[column]) if column in model.DATE_COLUMNS
+                             else project[column] for column in model.CSV_COLUMNS])
+        else:
+            out.write(json.dumps(project) + "\n")
+        count = count + 1
+        stamp = project['last_modified']
+        if model.is_set(stamp) and (newest is None or str(stamp) > newest):
+            newest = str(stamp)
+    return count, newest
@@ -0,0 +1,43 @@
+""" Lazy.py:
+    Modules that are only imported when they're first used. boto3 alone takes a
+    good part of the app's start up time, and a worker on sqlite3 never needs it,
+    so the dynamodb code refers to its libraries through these, e.g.
+        conditions = lazy.Module("boto3.dynamodb.conditions")
+        ... conditions.Key('number').eq(1) ...
+    and they're only imported if the app is running on dynamodb. BACKENDS says which
+    modules each backend needs; database.init_app loads the configured backend's
+    straight away, so the first request doesn't pay for them.
+    """
+
+import importlib
+
+# The modules each database backend uses, that the other doesn't
+BACKENDS = {
+    'sqlite3': ("sqlite3",),
+    'dynamodb': ("boto3", "boto3.dynamodb.conditions", "boto3.dynamodb.types",
+                 "botocore.config"),
+}
+
+
+class Module:  # pylint: disable=too-few-public-methods
+    """ Stands in for a module until one of its attributes is wanted, and only then
+    imports it """
+
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attribute):
+        # Once imported, this finds it in sys.modules
+        return getattr(importlib.import_module(self.__name), attribute)
+
+    def __repr__(self):
+        return f"<lazy module {self.__name!r}>"
+
+
+def load(backend):
+    """ Import the modules a database backend needs, see BACKENDS
+    ::parameter backend: "sqlite3" or "dynamodb" """
+    if backend not in BACKENDS:
+        raise ValueError(f"DBTYPE must be one of {', '.join(BACKENDS)}, not {backend!r}")
+    for name in BACKENDS[backend]:
+        importlib.import_module(name)
@@ -0,0 +1,731 @@
+""" Memtable.py:
+    An in-memory stand-in for the bits of the boto3 dynamodb resource we use.
+    Good enough to drive the application, the importer and the benchmarks without
+    talking to AWS. Not good enough for anything else - there's no persistence,
+    and no attempt to reproduce dynamodb's capacity accounting.
+    """
+import copy
+import re
+import threading
+import time
+from decimal import Decimal
+
+from boto3.dynamodb.conditions import ConditionBase
+from boto3.dynamodb.types import Binary, TypeDeserializer, TypeSerializer
+
+
+class MemoryException(Exception):
+    """ Base for the errors the stand-in raises. Named and shaped like the botocore
+    ClientError subclasses so that except clauses written for the real thing work """
+
+    def __init__(self, message="", code=None):
+        super().__init__(message)
+        self.response = {'Error': {'Code': code or type(self).__name__, 'Message': message}}
+
+
+class ConditionalCheckFailedException(MemoryException):
+    """ A ConditionExpression didn't hold """
+
+
+class ResourceInUseException(MemoryException):
+    """ Table already exists """
+
+
+class ResourceNotFoundException(MemoryException):
+    """ Table doesn't exist """
+
+
+class ProvisionedThroughputExceededException(MemoryException):
+    """ Batch writes went over write_capacity """
+
+
+class TransactionCanceledException(MemoryException):
+    """ One or more conditions in a transaction failed """
+
+    def __init__(self, reasons):
+        super().__init__("Transaction cancelled")
+        self.response['CancellationReasons'] = reasons
+
+
+class _Exceptions:  # pylint: disable=too-few-public-methods
+    """ Mirrors client.exceptions """
+    ConditionalCheckFailedException = ConditionalCheckFailedException
+    ResourceInUseException = ResourceInUseException
+    ResourceNotFoundException = ResourceNotFoundException
+    ProvisionedThroughputExceededException = ProvisionedThroughputExceededException
+    TransactionCanceledException = TransactionCanceledException
+
+
+_SERIALISE_ERROR = "Float types are not supported. Use Decimal types instead."
+
+
+def _to_stored(value):
+    """ Convert a python value the way boto3 would on the way in, so ints come back
+    out as Decimal and bytes as Binary, floats are refused and empty strings/sets are
+    left alone """
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, float):
+        raise TypeError(_SERIALISE_ERROR)
+    if isinstance(value, dict):
+        return {k: _to_stored(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_to_stored(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return {_to_stored(v) for v in value}
+    if isinstance(value, (bytes, bytearray)):
+        value = Binary(bytes(value))
+    if value is not None and not isinstance(value, (str, Binary, Decimal)):
+        raise TypeError("Unsupported type \"" + str(type(value)) + "\" for value \""
+                        + str(value) + "\"")
+    return value
+
+
+def _compare(left, op, right):
+    """ Comparison with dynamodb's rule that mismatched types never match """
+    if left is None or right is None:
+        return False
+    if isinstance(left, (int, Decimal)) != isinstance(right, (int, Decimal)):
+        return False
+    return {'=': left == right, '<>': left != right, '<': left < right,
+            '<=': left <= right, '>': left > right, '>=': left >= right}[op]
+
+
+def _operand(item, value):
+    """ Resolve one side of a condition, either an attribute reference or a literal """
+    if hasattr(value, 'name') and not isinstance(value, (str, bytes)):
+        return item.get(value.name)
+    return _to_stored(value)
+
+
+def evaluate(condition, item):
+    """ Evaluate a boto3 condition object (Attr/Key expressions) against an item
+    ::parameter condition: a ConditionBase from boto3.dynamodb.conditions
+    ::parameter item: dict
+    ::returns True if the item matches """
+    # pylint: disable=too-many-return-statements
+    expr = condition.get_expression()
+    op = expr['operator']
+    values = expr['values']
+    if op == 'AND':
+        return evaluate(values[0], item) and evaluate(values[1], item)
+    if op == 'OR':
+        return evaluate(values[0], item) or evaluate(values[1], item)
+    if op == 'NOT':
+        return not evaluate(values[0], item)
+    if op == 'attribute_exists':
+        return values[0].name in item
+    if op == 'attribute_not_exists':
+        return values[0].name not in item
+    if op in ('=', '<>', '<', '<=', '>', '>='):
+        return _compare(_operand(item, values[0]), op, _operand(item, values[1]))
+    if op == 'BETWEEN':
+        value = _operand(item, values[0])
+        return (_compare(value, '>=', _operand(item, values[1]))
+                and _compare(value, '<=', _operand(item, values[2])))
+    if op == 'IN':
+        value = _operand(item, values[0])
+        return any(_compare(value, '=', _operand(item, v)) for v in values[1:])
+    if op == 'begins_with':
+        value = _operand(item, values[0])
+        return isinstance(value, str) and value.startswith(_operand(item, values[1]))
+    if op == 'contains':
+        value = _operand(item, values[0])
+        return value is not None and _operand(item, values[1]) in value
+    raise NotImplementedError("Condition operator " + op + " not supported by the stand-in")
+
+
+def _resolve_name(token, names):
+    """ Map a '#placeholder' to a real attribute name """
+    token = token.strip()
+    if token.startswith('#'):
+        return names[token]
+    return token
+
+
+def _project(item, projection, names):
+    """ Apply a ProjectionExpression to an item """
+    if not projection:
+        return item
+    wanted = [_resolve_name(name, names or {}) for name in projection.split(',')]
+    return {key: item[key] for key in wanted if key in item}
+
+
+_CLAUSE = re.compile(r'\b(SET|REMOVE|ADD|DELETE)\b', re.IGNORECASE)
+
+
+def _split_top_level(text):
+    """ Split a clause on commas that aren't inside brackets """
+    parts, depth, current = [], 0, ''
+    for char in text:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == ',' and depth == 0:
+            parts.append(current)
+            current = ''
+        else:
+            current += char
+    if current.strip():
+        parts.append(current)
+    return parts
+
+
+def _update_value(item, text, names, values):
+    """ Evaluate the right hand side of a SET action """
+    text = text.strip()
+    func = re.match(r'if_not_exists\s*\((.*),(.*)\)$', text)
+    if func:
+        current = item.get(_resolve_name(func.group(1), names))
+        return current if current is not None else _update_value(item, func.group(2),
+                                                                  names, values)
+    for op in ('+', '-'):
+        if op in text:
+            left, right = text.split(op, 1)
+            left = _update_value(item, left, names, values)
+            right = _update_value(item, right, names, values)
+            return left + right if op == '+' else left - right
+    if text.startswith(':'):
+        return _to_stored(values[text])
+    return item.get(_resolve_name(text, names))
+
+
+def apply_update(item, expression, names=None, values=None):
+    """ Apply a (simple) UpdateExpression string to an item in place.
+    Handles SET with plain values, +/- and if_not_exists, REMOVE, and ADD for
+    numbers and sets, which is all the application uses """
+    names = names or {}
+    values = values or {}
+    pieces = _CLAUSE.split(expression)
+    for pos in range(1, len(pieces), 2):
+        action = pieces[pos].upper()
+        for clause in _split_top_level(pieces[pos + 1]):
+            if action == 'SET':
+                path, rhs = clause.split('=', 1)
+                item[_resolve_name(path, names)] = _update_value(item, rhs, names, values)
+            elif action == 'REMOVE':
+                item.pop(_resolve_name(clause, names), None)
+            elif action == 'ADD':
+                path, value = clause.split()
+                path = _resolve_name(path, names)
+                value = _to_stored(values[value])
+                if isinstance(value, set):
+                    item[path] = item.get(path, set()) | value
+                else:
+                    item[path] = item.get(path, Decimal(0)) + value
+            else:  # DELETE
+                path, value = clause.split()
+                path = _resolve_name(path, names)
+                item[path] = item.get(path, set()) - _to_stored(values[value])
+                if not item[path]:
+                    del item[path]
+    return item
+
+
+def _unwrap(part):
+    """ Take off brackets around the whole of a condition, but not a function call's
+    >>> _unwrap(" ((#lm = :expected)) ")
+    '#lm = :expected'
+    >>> _unwrap("attribute_not_exists(#lm)")
+    'attribute_not_exists(#lm)'
+    >>> _unwrap("(#a = :a) OR (#b = :b)")
+    '(#a = :a) OR (#b = :b)'
+    """
+    part = part.strip()
+    while part.startswith("(") and part.endswith(")"):
+        depth = 0
+        for position, char in enumerate(part):
+            depth = depth + {"(": 1, ")": -1}.get(char, 0)
+            if depth == 0 and position < len(part) - 1:
+                # The first bracket closes before the end, so it doesn't wrap it all
+                return part
+        part = part[1:-1].strip()
+    return part
+
+
+def _string_condition(item, condition, names, values):
+    """ Evaluate the handful of string ConditionExpression forms used in transactions
+    >>> condition = "attribute_exists(#num) AND attribute_not_exists(#lm)"
+    >>> names = {'#num': 'number', '#lm': 'last_modified'}
+    >>> _string_condition({'number': 1}, condition, names, {})
+    True
+    >>> _string_condition({'number': 1, 'last_modified': 'x'}, condition, names, {})
+    False
+    >>> _string_condition(None, condition, names, {})
+    False
+    >>> _string_condition({'last_modified': 'x'}, "(#lm = :expected)", names,
+    ...                   {':expected': 'x'})
+    True
+    """
+    if not condition:
+        return True
+    results = []
+    for part in re.split(r'\s+AND\s+', condition):
+        part = _unwrap(part)
+        negate = part.upper().startswith('NOT ')
+        if negate:
+            part = part[4:]
+        match = re.match(r'(attribute_exists|attribute_not_exists)\s*\((.*)\)$', part.strip())
+        if match:
+            present = item is not None and _resolve_name(match.group(2), names) in item
+            result = present if match.group(1) == 'attribute_exists' else not present
+        else:
+            left, op, right = re.match(r'(\S+)\s*(=|<>|<=|>=|<|>)\s*(\S+)$',
+                                       part.strip()).groups()
+            result = _compare((item or {}).get(_resolve_name(left, names)), op,
+                              _to_stored(values[right]))
+        results.append(not result if negate else result)
+    return all(results)
+
+
+def _condition_holds(item, condition, names=None, values=None):
+    """ Check a ConditionExpression, which may be a boto3 condition object or one of
+    the simple string forms _string_condition understands """
+    if condition is None:
+        return True
+    if isinstance(condition, ConditionBase):
+        return evaluate(condition, item or {})
+    return _string_condition(item, condition, names or {}, values or {})
+
+
+class MemoryTable:
+    """ A dynamodb Table lookalike holding its items in a dict """
+    # pylint: disable=invalid-name,too-many-arguments,too-many-instance-attributes
+
+    def __init__(self, resource, name, key_schema, indexes=None):
+        self.resource = resource
+        self.name = name
+        self.table_name = name
+        self.meta = resource.meta
+        self.key_names = [key['AttributeName'] for key in key_schema]
+        self.indexes = {}
+        for index in indexes or []:
+            self.indexes[index['IndexName']] = {
+                'keys': [key['AttributeName'] for key in index['KeySchema']],
+                'projection': index.get('Projection', {'ProjectionType': 'ALL'})}
+        self.page_items = resource.page_items
+        self.items = {}
+        self.lock = threading.RLock()
+        self.calls = {}
+
+    def _count(self, call):
+        self.calls[call] = self.calls.get(call, 0) + 1
+
+    def _key(self, item):
+        return tuple(item[name] for name in self.key_names)
+
+    @property
+    def item_count(self):
+        """ Number of items in the table """
+        return len(self.items)
+
+    def wait_until_exists(self):
+        """ Tables are created instantly """
+
+    def load(self):
+        """ Nothing to refresh """
+
+    def _capacity(self, items, write=False):
+        size = sum(len(repr(item)) for item in items)
+        unit = 1024 if write else 4096
+        return {'TableName': self.name, 'CapacityUnits': max(1.0, size / unit)}
+
+    def _respond(self, response, kwargs, items, write=False):
+        response['ResponseMetadata'] = {'HTTPStatusCode': 200}
+        if kwargs.get('ReturnConsumedCapacity', 'NONE') != 'NONE':
+            response['ConsumedCapacity'] = self._capacity(items, write)
+        return response
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None,
+                 **kwargs):
+        """ Fetch one item by primary key """
+        self._count('get_item')
+        with self.lock:
+            item = self.items.get(self._key(_to_stored(Key)))
+            response = {}
+            if item is not None:
+                response['Item'] = _project(copy.deepcopy(item), ProjectionExpression,
+                                            ExpressionAttributeNames)
+        return self._respond(response, kwargs, [item] if item else [])
+
+    def put_item(self, *, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        """ Store (replace) a whole item """
+        self._count('put_item')
+        item = _to_stored(copy.deepcopy(Item))
+        response = {}
+        with self.lock:
+            key = self._key(item)
+            current = self.items.get(key)
+            if not _condition_holds(current, ConditionExpression,
+                                    ExpressionAttributeNames, ExpressionAttributeValues):
+                raise ConditionalCheckFailedException("The conditional request failed")
+            self.items[key] = item
+            if ReturnValues == 'ALL_OLD' and current is not None:
+                response['Attributes'] = copy.deepcopy(current)
+        return self._respond(response, kwargs, [item], write=True)
+
+    def update_item(self, *, Key, UpdateExpression, ConditionExpression=None,
+                    ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+                    ReturnValues='NONE', **kwargs):
+        """ Apply an UpdateExpression to one item, creating it if needed """
+        self._count('update_item')
+        key_item = _to_stored(Key)
+        with self.lock:
+            key = self._key(key_item)
+            current = self.items.get(key)
+            if not _condition_holds(current, ConditionExpression,
+                                    ExpressionAttributeNames, ExpressionAttributeValues):
+                raise ConditionalCheckFailedException("The conditional request failed")
+            item = copy.deepcopy(current) if current else dict(key_item)
+            before = copy.deepcopy(item)
+            apply_update(item, UpdateExpression, ExpressionAttributeNames,
+                         ExpressionAttributeValues)
+            self.items[key] = item
+            response = {}
+            if ReturnValues == 'ALL_NEW':
+                response['Attributes'] = copy.deepcopy(item)
+            elif ReturnValues == 'ALL_OLD' and current:
+                response['Attributes'] = before
+            elif ReturnValues == 'UPDATED_NEW':
+                response['Attributes'] = {k: copy.deepcopy(v) for k, v in item.items()
+                                          if before.get(k) != v}
+        return self._respond(response, kwargs, [item], write=True)
+
+    def delete_item(self, Key, ConditionExpression=None, **kwargs):
+        """ Remove one item """
+        self._count('delete_item')
+        with self.lock:
+            key = self._key(_to_stored(Key))
+            if not _condition_holds(self.items.get(key), ConditionExpression):
+                raise ConditionalCheckFailedException("The conditional request failed")
+            item = self.items.pop(key, None)
+        return self._respond({}, kwargs, [item] if item else [], write=True)
+
+    def _page(self, ordered, key_names, kwargs):
+        """ Walk an ordered list of items from ExclusiveStartKey, applying Limit,
+        FilterExpression and ProjectionExpression, and build a response page """
+        start = kwargs.get('ExclusiveStartKey')
+        if start:
+            start = _to_stored(start)
+            position = 0
+            for position, item in enumerate(ordered):
+                if all(item.get(name) == start.get(name) for name in key_names):
+                    position += 1
+                    break
+            ordered = ordered[position:]
+        limit = min(kwargs.get('Limit', self.page_items), self.page_items)
+        evaluated = ordered[:limit]
+        matched = [item for item in evaluated
+                   if kwargs.get('FilterExpression') is None
+                   or evaluate(kwargs['FilterExpression'], item)]
+        response = {
+            'Items': [_project(copy.deepcopy(item), kwargs.get('ProjectionExpression'),
+                               kwargs.get('ExpressionAttributeNames'))
+                      for item in matched],
+            'ScannedCount': len(evaluated)}
+        response['Count'] = len(response['Items'])
+        if len(ordered) > limit:
+            last = evaluated[-1]
+            response['LastEvaluatedKey'] = {name: last[name] for name in key_names}
+        return self._respond(response, kwargs, evaluated)
+
+    def scan(self, **kwargs):
+        """ Scan the table, honouring Segment/TotalSegments for parallel scans """
+        self._count('scan')
+        with self.lock:
+            ordered = sorted(self.items.values(), key=self._key)
+        if 'TotalSegments' in kwargs:
+            total, segment = kwargs['TotalSegments'], kwargs['Segment']
+            ordered = [item for pos, item in enumerate(ordered) if pos % total == segment]
+        return self._page(ordered, self.key_names, kwargs)
+
+    def query(self, KeyConditionExpression, IndexName=None, ScanIndexForward=True, **kwargs):
+        """ Query the table or one of its secondary indexes """
+        self._count('query')
+        if IndexName:
+            index = self.indexes[IndexName]
+            index_keys = index['keys']
+        else:
+            index = None
+            index_keys = self.key_names
+        with self.lock:
+            ordered = [item for item in self.items.values()
+                       if all(name in item for name in index_keys)
+                       and evaluate(KeyConditionExpression, item)]
+        ordered.sort(key=lambda item: tuple(item[name] for name in index_keys)
+                     + self._key(item), reverse=not ScanIndexForward)
+        if index and index['projection']['ProjectionType'] != 'ALL':
+            keep = set(index_keys + self.key_names)
+            keep.update(index['projection'].get('NonKeyAttributes', []))
+            ordered = [{k: v for k, v in item.items() if k in keep} for item in ordered]
+        key_names = list(dict.fromkeys(index_keys + self.key_names))
+        return self._page(ordered, key_names, kwargs)
+
+    def batch_writer(self, overwrite_by_pkeys=None):  # pylint: disable=unused-argument
+        """ Context manager that buffers writes like boto3's BatchWriter """
+        return _BatchWriter(self)
+
+
+class _BatchWriter:
+    """ Buffers puts and deletes and sends them in batches of 25 """
+
+    def __init__(self, table):
+        self.table = table
+        self.buffer = []
+
+    def put_item(self, Item):  # pylint: disable=invalid-name
+        """ Queue a put """
+        self.buffer.append({'PutRequest': {'Item': Item}})
+        self._flush(25)
+
+    def delete_item(self, Key):  # pylint: disable=invalid-name
+        """ Queue a delete """
+        self.buffer.append({'DeleteRequest': {'Key': Key}})
+        self._flush(25)
+
+    def _flush(self, threshold):
+        if len(self.buffer) >= threshold:
+            self.table.resource.batch_write_item(
+                RequestItems={self.table.name: self.buffer})
+            self.buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._flush(1)
+
+
+class _Waiter:  # pylint: disable=too-few-public-methods
+    """ Table creation and deletion are instant, so there's nothing to wait for """
+
+    def wait(self, **kwargs):
+        """ Return straight away """
+
+
+class MemoryClient:
+    """ Lookalike for the low level client, for the calls that only exist there """
+    # pylint: disable=invalid-name,unused-argument
+    exceptions = _Exceptions
+
+    def __init__(self, resource):
+        self.resource = resource
+        self.deserializer = TypeDeserializer()
+
+    def delete_table(self, TableName):
+        """ Drop a table """
+        with self.resource.lock:
+            if TableName not in self.resource.tables:
+                raise ResourceNotFoundException("Requested resource not found")
+            del self.resource.tables[TableName]
+
+    def get_waiter(self, name):
+        """ Waiters return immediately """
+        return _Waiter()
+
+    def describe_table(self, TableName):
+        """ Just enough of a description to see the table's there """
+        table = self.resource.Table(TableName)
+        return {'Table': {'TableName': TableName, 'ItemCount': table.item_count,
+                          'TableStatus': 'ACTIVE'}}
+
+    def _plain(self, typed):
+        return {k: self.deserializer.deserialize(v) for k, v in typed.items()}
+
+    def _consumed(self, response, kwargs, items, write=False):
+        """ Add ConsumedCapacity if asked for: a list, one entry per table
+        ::parameter items: dict of table name: the items read or written """
+        if kwargs.get('ReturnConsumedCapacity', 'NONE') != 'NONE':
+            response['ConsumedCapacity'] = [
+                self.resource.Table(name)._capacity(batch, write)  # pylint: disable=protected-access
+                for name, batch in items.items() if batch]
+        return response
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        """ BatchWriteItem in the low level typed format. Unprocessed items come back
+        typed too, so they can be sent again as they are """
+        plain = {}
+        for name, batch in RequestItems.items():
+            plain[name] = []
+            for request in batch:
+                (kind, body), = request.items()
+                plain[name].append({kind: {part: self._plain(value)
+                                           for part, value in body.items()}})
+        response = self.resource.batch_write_item(RequestItems=plain)
+        serializer = TypeSerializer()
+        unprocessed = {}
+        for name, batch in response['UnprocessedItems'].items():
+            unprocessed[name] = []
+            for request in batch:
+                (kind, body), = request.items()
+                unprocessed[name].append({kind: {
+                    part: {k: serializer.serialize(v) for k, v in value.items()}
+                    for part, value in body.items()}})
+        left = {name: {repr(request) for request in batch}
+                for name, batch in response['UnprocessedItems'].items()}
+        return self._consumed({'UnprocessedItems': unprocessed}, kwargs, {
+            name: [request for request in batch if repr(request) not in left.get(name, ())]
+            for name, batch in plain.items()}, write=True)
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        """ BatchGetItem in the low level typed format """
+        plain = {name: dict(spec, Keys=[self._plain(key) for key in spec['Keys']])
+                 for name, spec in RequestItems.items()}
+        response = self.resource.batch_get_item(RequestItems=plain)
+        serializer = TypeSerializer()
+        return self._consumed(
+            {'Responses': {name: [{k: serializer.serialize(v) for k, v in item.items()}
+                                  for item in items]
+                           for name, items in response['Responses'].items()},
+             'UnprocessedKeys': {}}, kwargs, response['Responses'])
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        """ All-or-nothing set of Put/Update/Delete/ConditionCheck actions, in the low
+        level typed format. Conditions must be attribute_(not_)exists strings or
+        the simple "#a = :b" form """
+        # pylint: disable=too-many-locals
+        with self.resource.lock:
+            reasons = []
+            plans = []
+            for action in TransactItems:
+                (kind, spec), = action.items()
+                table = self.resource.Table(spec['TableName'])
+                names = spec.get('ExpressionAttributeNames', {})
+                values = self._plain(spec.get('ExpressionAttributeValues', {}))
+                if kind == 'Put':
+                    item = self._plain(spec['Item'])
+                    key = table._key(_to_stored(item))  # pylint: disable=protected-access
+                else:
+                    key = table._key(_to_stored(self._plain(spec['Key'])))  # pylint: disable=protected-access
+                    item = None
+                current = table.items.get(key)
+                ok = _string_condition(current, spec.get('ConditionExpression'), names, values)
+                reasons.append({'Code': 'None' if ok else 'ConditionalCheckFailed'})
+                plans.append((kind, table, key, item, spec, names, values))
+            if any(reason['Code'] != 'None' for reason in reasons):
+                raise TransactionCanceledException(reasons)
+            for kind, table, key, item, spec, names, values in plans:
+                if kind == 'Put':
+                    table.items[key] = _to_stored(item)
+                elif kind == 'Delete':
+                    table.items.pop(key, None)
+                elif kind == 'Update':
+                    current = table.items.get(key)
+                    new = copy.deepcopy(current) if current else \
+                        dict(zip(table.key_names, key))
+                    apply_update(new, spec['UpdateExpression'], names, values)
+                    table.items[key] = new
+        # A transaction costs two write units for each item, as dynamodb charges
+        written = {}
+        for kind, table, key, item, *_ in plans:
+            written.setdefault(table.name, []).extend([item or key] * 2)
+        return self._consumed({}, kwargs, written, write=True)
+
+
+class _Meta:  # pylint: disable=too-few-public-methods
+    def __init__(self, client):
+        self.client = client
+
+
+class MemoryDynamoDB:
+    """ Lookalike for boto3.resource('dynamodb').
+    page_items caps how many items a scan or query page holds, standing in for the
+    1MB page limit. write_capacity, if set, is write units per second across all
+    tables, enforced on batch writes only, for exercising throttling. """
+    # pylint: disable=invalid-name,unused-argument,too-many-instance-attributes
+
+    def __init__(self, page_items=1000, write_capacity=None, client=None):
+        if client is not None:
+            # Another resource on an existing client, as boto3 builds one per thread:
+            # the same tables and everything else
+            self.__dict__ = client.resource.__dict__
+            return
+        self.tables = {}
+        self.page_items = page_items
+        self.write_capacity = write_capacity
+        self.second = 0
+        self.spent = 0
+        self.throttled = 0
+        self.lock = threading.RLock()
+        self.meta = _Meta(MemoryClient(self))
+
+    def create_table(self, TableName, KeySchema, GlobalSecondaryIndexes=None, **kwargs):
+        """ Make a new, empty table """
+        # pylint: disable=unused-argument
+        with self.lock:
+            if TableName in self.tables:
+                raise ResourceInUseException("Table already exists: " + TableName)
+            table = MemoryTable(self, TableName, KeySchema, GlobalSecondaryIndexes)
+            self.tables[TableName] = table
+        return table
+
+    def Table(self, name):
+        """ Get an existing table object """
+        with self.lock:
+            if name not in self.tables:
+                raise ResourceNotFoundException("Requested resource not found: " + name)
+            return self.tables[name]
+
+    def _spend(self, units):
+        """ Charge units against write_capacity, if there is one
+        ::returns False if this second's capacity has run out """
+        if self.write_capacity is None:
+            return True
+        with self.lock:
+            second = int(time.monotonic())
+            if second != self.second:
+                self.second = second
+                self.spent = 0
+            if self.spent + units > self.write_capacity:
+                return False
+            self.spent = self.spent + units
+            return True
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        """ Apply up to 25 puts/deletes across tables. With write_capacity set,
+        anything over this second's capacity comes back unprocessed, and if none of
+        it fits the whole call is throttled, as dynamodb does. """
+        requests = sum(len(batch) for batch in RequestItems.values())
+        if requests > 25:
+            raise MemoryException("Too many items requested for the BatchWriteItem call",
+                                  "ValidationException")
+        unprocessed = {}
+        done = 0
+        for name, batch in RequestItems.items():
+            table = self.Table(name)
+            table._count('batch_write_item')  # pylint: disable=protected-access
+            for request in batch:
+                body = request.get('PutRequest', {}).get('Item') or \
+                    request['DeleteRequest']['Key']
+                if not self._spend(len(repr(body)) // 1024 + 1):
+                    unprocessed.setdefault(name, []).append(request)
+                elif 'PutRequest' in request:
+                    table.put_item(Item=request['PutRequest']['Item'])
+                    done = done + 1
+                else:
+                    table.delete_item(Key=request['DeleteRequest']['Key'])
+                    done = done + 1
+        if unprocessed and not done:
+            self.throttled = self.throttled + 1
+            raise ProvisionedThroughputExceededException(
+                "The level of configured provisioned throughput for the table was exceeded")
+        return {'UnprocessedItems': unprocessed}
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        """ Fetch up to 100 items by key across tables """
+        responses = {}
+        for name, spec in RequestItems.items():
+            table = self.Table(name)
+            found = []
+            for key in spec['Keys']:
+                item = table.get_item(
+                    Key=key, ProjectionExpression=spec.get('ProjectionExpression'),
+                    ExpressionAttributeNames=spec.get('ExpressionAttributeNames')).get('Item')
+                if item:
+                    found.append(item)
+            responses[name] = found
+        return {'Responses': responses, 'UnprocessedKeys': {}}
@@ -0,0 +1,361 @@
+""" Metrics.py:
+    Where the time goes. Records how long each route takes, each call to the
+    database (with how many items it read or wrote, and on dynamodb the capacity
+    it consumed), and each template render, and serves the lot in Prometheus text
+    format at /metrics. Requests slower than SLOW_REQUEST_SECONDS are logged, with
+    how their time was split. Set METRICS = False to record nothing.
+    Each worker process keeps its own figures, as it does its own read cache.
+    """
+
+import sqlite3
+import threading
+import time
+from flask import before_render_template, current_app, g, has_app_context, request
+from flask import template_rendered
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Everything recorded: type and help text for each metric
+METRICS = {
+    'projects_request_seconds': (
+        "histogram", "Time to handle a request, streaming the response included"),
+    'projects_db_call_seconds': (
+        "histogram", "Time spent in each kind of database call, rows fetched included"),
+    'projects_db_items_total': (
+        "counter", "Items read or written by each kind of database call"),
+    'projects_dynamodb_capacity_units_total': (
+        "counter", "Dynamodb capacity units consumed, from ReturnConsumedCapacity"),
+    'projects_template_render_seconds': (
+        "histogram", "Time rendering each template, less database reads made during it"),
+    'projects_slow_requests_total': (
+        "counter", "Requests over SLOW_REQUEST_SECONDS"),
+}
+
+# Dynamodb table calls that are timed and asked for their consumed capacity
+TABLE_CALLS = ("scan", "query", "get_item", "put_item", "update_item", "delete_item")
+
+# Dynamodb client calls, which work on many items at once, timed likewise. Their
+# consumed capacity comes back as a list, one entry per table.
+CLIENT_CALLS = ("transact_write_items", "batch_write_item", "batch_get_item")
+
+# name: {labels: value} for counters, or {labels: [count per bucket..., sum, count]}
+_values = {name: {} for name in METRICS}
+_lock = threading.Lock()
+
+
+def inc(name, labels, amount=1):
+    """ Add to a counter
+    ::parameter name: one of METRICS
+    ::parameter labels: tuple of (label, value) pairs """
+    with _lock:
+        _values[name][labels] = _values[name].get(labels, 0) + amount
+
+
+def observe(name, labels, seconds):
+    """ Record a time in a histogram
+    ::parameter name: one of METRICS
+    ::parameter labels: tuple of (label, value) pairs
+    ::parameter seconds: how long it took """
+    with _lock:
+        counts = _values[name].get(labels)
+        if counts is None:
+            counts = _values[name][labels] = [0] * (len(BUCKETS) + 2)
+        for position, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                counts[position] = counts[position] + 1
+        counts[-2] = counts[-2] + seconds
+        counts[-1] = counts[-1] + 1
+
+
+def record_call(backend, call, seconds, items=None):
+    """ Record a database call, and add it to the current request's database time
+    ::parameter backend: "sqlite3", "dynamodb" or "replica"
+    ::parameter call: what sort of call, e.g. "query" or "select"
+    ::parameter seconds: how long it took
+    ::parameter items: how many items it read or wrote, if known """
+    labels = (("backend", backend), ("call", call))
+    observe('projects_db_call_seconds', labels, seconds)
+    if items:
+        inc('projects_db_items_total', labels, items)
+    if has_app_context():
+        g.metrics_db_seconds = g.get('metrics_db_seconds', 0.0) + seconds
+        g.metrics_db_calls = g.get('metrics_db_calls', 0) + 1
+
+
+class TimedTable:  # pylint: disable=too-few-public-methods
+    """ Stands in for a dynamodb table object, timing TABLE_CALLS and recording the
+    capacity they consume. Its meta.client is a TimedClient. Everything else is
+    passed straight through. """
+
+    def __init__(self, table):
+        self.table = table
+        self.meta = TimedMeta(table.meta)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.table, name)
+        if name not in TABLE_CALLS:
+            return attribute
+
+        def call(**kwargs):
+            kwargs.setdefault('ReturnConsumedCapacity', 'TOTAL')
+            start = time.perf_counter()
+            response = attribute(**kwargs)
+            if 'Items' in response:
+                items = len(response['Items'])
+            else:
+                items = 0 if name == "get_item" and 'Item' not in response else 1
+            record_call("dynamodb", name, time.perf_counter() - start, items)
+            capacity = response.get('ConsumedCapacity', {}).get('CapacityUnits')
+            if capacity:
+                inc('projects_dynamodb_capacity_units_total',
+                    (("table", self.table.name), ("call", name)), float(capacity))
+            return response
+        return call
+
+
+class TimedMeta:  # pylint: disable=too-few-public-methods
+    """ A table's meta, with its client swapped for a TimedClient """
+
+    def __init__(self, meta):
+        self.meta = meta
+        self.client = TimedClient(meta.client)
+
+    def __getattr__(self, name):
+        return getattr(self.meta, name)
+
+
+def _client_items(name, kwargs, response):
+    """ How many items a CLIENT_CALLS call wrote or read """
+    if name == "transact_write_items":
+        return len(kwargs['TransactItems'])
+    if name == "batch_get_item":
+        return sum(len(items) for items in response.get('Responses', {}).values())
+    return (sum(len(batch) for batch in kwargs['RequestItems'].values())
+            - sum(len(batch) for batch in response.get('UnprocessedItems', {}).values()))
+
+
+class TimedClient:  # pylint: disable=too-few-public-methods
+    """ Stands in for a dynamodb client, timing CLIENT_CALLS and recording the
+    capacity they consume, table by table. Everything else, the exceptions
+    included, is passed straight through. """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name not in CLIENT_CALLS:
+            return attribute
+
+        def call(**kwargs):
+            kwargs.setdefault('ReturnConsumedCapacity', 'TOTAL')
+            start = time.perf_counter()
+            try:
+                response = attribute(**kwargs)
+            except Exception:
+                # A cancelled transaction or a throttled batch still took the time
+                record_call("dynamodb", name, time.perf_counter() - start)
+                raise
+            record_call("dynamodb", name, time.perf_counter() - start,
+                        _client_items(name, kwargs, response))
+            for capacity in response.get('ConsumedCapacity', []):
+                if capacity.get('CapacityUnits'):
+                    inc('projects_dynamodb_capacity_units_total',
+                        (("table", capacity['TableName']), ("call", name)),
+                        float(capacity['CapacityUnits']))
+            return response
+        return call
+
+
+def instrument_table(table):
+    """ A dynamodb table object, timed if metrics are on, see TimedTable """
+    if current_app.config.get('METRICS'):
+        return TimedTable(table)
+    return table
+
+
+class TimedCursor(sqlite3.Cursor):
+    """ A sqlite cursor that times its statement, and the fetching of its rows, and
+    records them as one call once it's been read to the end (or dropped) """
+    backend = "sqlite3"
+    call = None
+    seconds = 0.0
+    rows = 0
+
+    def execute(self, sql, parameters=()):
+        """ Run a statement, timed. A query is recorded once its rows are read. """
+        self.call = sql.split(None, 1)[0].lower()
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        self.seconds = time.perf_counter() - start
+        self.rows = 0
+        if self.description is None:
+            # Nothing to fetch, so that's it
+            self._finish(max(self.rowcount, 0))
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        """ Run a statement for each set of parameters, timed """
+        self.call = sql.split(None, 1)[0].lower()
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        self.seconds = time.perf_counter() - start
+        self._finish(max(self.rowcount, 0))
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.seconds = self.seconds + time.perf_counter() - start
+            self._finish(self.rows)
+            raise
+        self.seconds = self.seconds + time.perf_counter() - start
+        self.rows = self.rows + 1
+        return row
+
+    def fetchone(self):
+        """ The next row, or None, as sqlite3.Cursor does but through __next__ """
+        return next(self, None)
+
+    def fetchall(self):
+        """ The rest of the rows, as sqlite3.Cursor does but through __next__ """
+        return list(self)
+
+    def _finish(self, items):
+        if self.call is not None:
+            record_call(self.backend, self.call, self.seconds, items)
+            self.call = None
+
+    def __del__(self):
+        # A page stops reading once it has one row more than it shows
+        self._finish(self.rows)
+
+
+class TimedConnection(sqlite3.Connection):
+    """ A sqlite connection whose execute and executemany use TimedCursor """
+    backend = "sqlite3"
+
+    def _cursor(self):
+        cursor = self.cursor(TimedCursor)
+        cursor.backend = self.backend
+        return cursor
+
+    def execute(self, sql, parameters=()):
+        """ As sqlite3.Connection.execute, with a TimedCursor """
+        return self._cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        """ As sqlite3.Connection.executemany, with a TimedCursor """
+        return self._cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        """ Commit, timed """
+        start = time.perf_counter()
+        super().commit()
+        record_call(self.backend, "commit", time.perf_counter() - start)
+
+
+def connect(path, backend="sqlite3", **kwargs):
+    """ sqlite3.connect, timed if metrics are on, see TimedConnection
+    ::parameter path: database file
+    ::parameter backend: what to record its calls as
+    ::parameter kwargs: anything else for sqlite3.connect
+    ::returns connection """
+    if not current_app.config.get('METRICS'):
+        return sqlite3.connect(path, **kwargs)
+    conn = sqlite3.connect(path, factory=TimedConnection, **kwargs)
+    conn.backend = backend
+    return conn
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+
+
+def _note_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def _finish_request(error=None):  # pylint: disable=unused-argument
+    """ Record the request once it's completely done, which for a streamed
+    response is once the last of it has gone """
+    if 'metrics_start' not in g:
+        return
+    seconds = time.perf_counter() - g.pop('metrics_start')
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    observe('projects_request_seconds',
+            (("route", route), ("method", request.method),
+             ("status", str(g.get('metrics_status', 500)))), seconds)
+    threshold = current_app.config.get('SLOW_REQUEST_SECONDS')
+    if threshold and seconds >= threshold:
+        inc('projects_slow_requests_total', (("route", route),))
+        current_app.logger.warning(
+            "Slow request: %s %s took %.3fs, of which database %.3fs in %d calls, "
+            "templates %.3fs", request.method, request.full_path, seconds,
+            g.get('metrics_db_seconds', 0.0), g.get('metrics_db_calls', 0),
+            g.get('metrics_render_seconds', 0.0))
+
+
+def _start_render(sender, template, **kwargs):  # pylint: disable=unused-argument
+    g.setdefault('metrics_renders', []).append(
+        (time.perf_counter(), g.get('metrics_db_seconds', 0.0)))
+
+
+def _finish_render(sender, template, **kwargs):  # pylint: disable=unused-argument
+    """ Record a render. A streamed list reads its rows as it renders, so the
+    database time taken meanwhile is left out; it's in projects_db_call_seconds. """
+    renders = g.get('metrics_renders')
+    if not renders:
+        return
+    start, db_seconds = renders.pop()
+    seconds = (time.perf_counter() - start) - (g.get('metrics_db_seconds', 0.0) - db_seconds)
+    g.metrics_render_seconds = g.get('metrics_render_seconds', 0.0) + seconds
+    observe('projects_template_render_seconds', (("template", template.name),), seconds)
+
+
+def _format_labels(labels, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in labels + extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render(gauges=None):
+    """ Everything recorded, in Prometheus text format
+    ::parameter gauges: dict of name: value for other figures to include as they are
+    ::returns string """
+    lines = []
+    with _lock:
+        for name, (kind, help_text) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(_values[name].items()):
+                if kind == "counter":
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+                    continue
+                for bound, count in zip(BUCKETS, value):
+                    lines.append(f"{name}_bucket{_format_labels(labels, (('le', bound),))} "
+                                 f"{count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, (('le', '+Inf'),))} "
+                             f"{value[-1]}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+    for name, value in (gauges or {}).items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def init_app(app):
+    """ Hook the request and template timing into the Flask app, if METRICS is on """
+    if not app.config.get('METRICS'):
+        return
+    app.before_request(_start_request)
+    app.after_request(_note_status)
+    app.teardown_request(_finish_request)
+    before_render_template.connect(_start_render, app)
+    template_rendered.connect(_finish_render, app)
@@ -0,0 +1,306 @@
+""" Model.py:
+    Record level rules shared by the web app and the data importer.
+    Nothing in here touches a database or Flask, so the importer can use it too.
+    """
+import collections
+import datetime
+import functools
+import zlib
+
+# Every project is in exactly one of these states. The list views each show one.
+STATUSES = ("active", "paused", "todo", "done", "habit")
+
+# Secondary index on (status, status_key) for dynamodb
+STATUS_INDEX = "status-index"
+
+# Dates the timeline view picks projects by. On dynamodb each has a secondary index
+# of its own (see timeline_index), partitioned by month and sorted on the time.
+TIMELINE_COLUMNS = ("created", "started_on", "done")
+
+# Attributes holding dates, stored as ISO strings to the minute
+DATE_COLUMNS = ("created", "done", "started_on", "stopped_on", "last_modified")
+STORED_DATE_FORMAT = "%Y-%m-%dT%H:%M"
+DISPLAY_DATE_FORMAT = "%a, %d %b, %Y, %I:%M %p"
+
+# On dynamodb, the item with this number isn't a project. It holds counters, such
+# as the last project number handed out, in LAST_NUMBER, and the stats counters
+# (see stat_counters).
+COUNTER_NUMBER = 0
+LAST_NUMBER = "last_number"
+
+# The columns of the csv files the importer reads and the export writes, in order,
+# and how their dates are written
+CSV_COLUMNS = ("number", "idea", "created", "done", "started_on", "stopped_on", "continuous",
+               "links", "memoranda", "last_modified")
+CSV_DATE_FORMAT = "%d/%m/%Y %H:%M"
+
+# Attributes the edit form can change, all of them but the number
+EDITABLE = ("idea", "memoranda", "links", "created", "done", "started_on", "stopped_on",
+            "continuous", "last_modified")
+
+# Attributes a bulk edit can set on many projects at once (see bulk.py): the ones
+# that move a project from one status to another
+BULK_EDITABLE = ("created", "done", "started_on", "stopped_on", "continuous")
+
+# Memoranda longer than this many bytes are compressed and kept out of line, in a
+# table of their own, so everything else that reads a project doesn't drag them along
+MEMO_THRESHOLD = 4096
+
+# How many distinct stored dates to remember the display form of. Lists share a
+# lot of dates (imports, bulk edits), and it's a few hundred bytes apiece.
+DATE_CACHE_SIZE = 16384
+
+
+def is_set(value):
+    """ True if a stored value counts as 'present'. Blank strings, None, NaN and
+    the odd '0' that has crept into the done column all count as unset """
+    if value is None or value != value:  # pylint: disable=comparison-with-itself
+        return False
+    return str(value) not in ("", "0")
+
+
+def project_status(project):
+    """ Work out which state a project is in
+    ::parameter project: dict (or dict-like) of project attributes
+    ::returns one of STATUSES """
+    if is_set(project.get('done')):
+        return "done"
+    if str(project.get('continuous')) in ("1", "1.0"):
+        return "habit"
+    if is_set(project.get('started_on')):
+        if is_set(project.get('stopped_on')):
+            return "paused"
+        return "active"
+    return "todo"
+
+
+# The date each status is sorted on in the status index, see status_key. The rest
+# are sorted on their number.
+STATUS_DATES = {"active": "started_on", "paused": "stopped_on", "done": "done"}
+
+
+def status_key(project, status):
+    """ Sort key within a status, so each list view comes back from the index in the
+    order it's shown in. Dates are ISO strings so they sort as text; numbers are
+    zero padded to do the same
+    ::parameter project: dict of project attributes
+    ::parameter status: the project's status
+    ::returns string sort key """
+    if status in STATUS_DATES:
+        return str(project[STATUS_DATES[status]])
+    return f"{int(project['number']):010d}"
+
+
+def add_status(project):
+    """ Set the derived status and status_key attributes on a project item
+    ::parameter project: dict of project attributes, updated in place
+    ::returns the same dict """
+    status = project_status(project)
+    project['status'] = status
+    project['status_key'] = status_key(project, status)
+    return project
+
+
+def timeline_index(column):
+    """ The dynamodb index for the timeline on one date, and its keys
+    ::parameter column: one of TIMELINE_COLUMNS
+    ::returns (index name, month attribute, time attribute) """
+    return f"{column}-timeline", f"{column}_month", f"{column}_at"
+
+
+# The dynamodb index the replica's sync reads what's changed from (see replica.sync):
+# on last_modified, keyed the same way as the timeline indexes
+MODIFIED_INDEX, MODIFIED_MONTH, MODIFIED_AT = timeline_index("last_modified")
+
+# The timeline index keys, and every attribute dynamodb writes work out from the
+# rest (see add_status and add_timeline), so the indexes that use them are kept up
+# to date
+TIMELINE_KEYS = tuple(key for column in TIMELINE_COLUMNS for key in timeline_index(column)[1:])
+DERIVED_COLUMNS = ("status", "status_key") + TIMELINE_KEYS + (MODIFIED_MONTH, MODIFIED_AT)
+
+
+def epoch(value):
+    """ A stored date as a number that sorts the same way: seconds since 1970, taking
+    the date as UTC
+    ::parameter value: ISO date string
+    ::returns int, or None if it's unset or won't parse """
+    if not is_set(value):
+        return None
+    try:
+        when = datetime.datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+    return int(when.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def add_timeline(project):
+    """ Set the timeline index keys on a project item: the month (YYYY-MM) and the
+    time (see epoch) of each of TIMELINE_COLUMNS it has, and of last_modified for
+    MODIFIED_INDEX. Keys for dates it doesn't have are removed, which leaves it out
+    of that index.
+    ::parameter project: dict of project attributes, updated in place
+    ::returns the same dict """
+    for column in TIMELINE_COLUMNS + ("last_modified",):
+        _, month, when = timeline_index(column)
+        seconds = epoch(project.get(column))
+        if seconds is None:
+            project.pop(month, None)
+            project.pop(when, None)
+        else:
+            project[month] = str(project[column])[:7]
+            project[when] = seconds
+    return project
+
+
+def months(start, end):
+    """ The months a date range has any of, for the timeline partitions it covers
+    ::parameter start: ISO date string, the earliest in the range
+    ::parameter end: ISO date string, the first after it
+    ::returns list of YYYY-MM strings """
+    last = datetime.datetime.fromisoformat(end) - datetime.timedelta(minutes=1)
+    year, month = int(start[:4]), int(start[5:7])
+    found = []
+    while f"{year:04d}-{month:02d}" <= last.strftime("%Y-%m"):
+        found.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return found
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(value):
+    """ Normalise a stored date and work out how it's shown, once per distinct value
+    ::parameter value: date as stored - an ISO string, or None/blank/'0' if unset
+    ::returns (ISO string to the minute, display string), or (None, '-') if unset.
+              Anything that won't parse is passed through as is. """
+    if not is_set(value):
+        return None, "-"
+    try:
+        when = datetime.datetime.fromisoformat(str(value))
+    except ValueError:
+        return str(value), str(value)
+    return when.strftime(STORED_DATE_FORMAT), when.strftime(DISPLAY_DATE_FORMAT)
+
+
+def with_dates(row):
+    """ Copy a fetched row, normalising its dates and adding their display strings
+    under 'display', so templates don't have to parse anything
+    ::parameter row: dict or sqlite3.Row of project attributes
+    ::returns new dict """
+    project = dict(row)
+    display = {}
+    for column in DATE_COLUMNS:
+        if column in project:
+            project[column], display[column] = parse_date(project[column])
+        else:
+            display[column] = "-"
+    project['display'] = display
+    return project
+
+
+def _form_value(value):
+    """ A value as the edit form sees it: text, with blank or missing as None.
+    Browsers send textarea line breaks as CRLF, so they're made plain LF. """
+    if value is None or value == "":
+        return None
+    return str(value).replace("\r\n", "\n")
+
+
+def modified_stamp(expected):
+    """ The last_modified for a write that only goes in if the project's is still
+    expected: the time now, or if that isn't later (two saves in one minute, or a
+    clock that's behind), a minute after expected. It always moves on, so another
+    write made from the same stale read can't match it.
+    ::parameter expected: the last_modified the project was loaded with, or None
+    ::returns ISO string to the minute """
+    now = datetime.datetime.now().replace(second=0, microsecond=0)
+    if is_set(expected):
+        try:
+            previous = datetime.datetime.fromisoformat(str(expected))
+        except ValueError:
+            previous = None
+        if previous is not None and previous.replace(second=0, microsecond=0) >= now:
+            now = previous.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+    return now.strftime(STORED_DATE_FORMAT)
+
+
+def changes(project, form):
+    """ Work out what an edit changes, so only that has to be written
+    ::parameter project: dict of the project's attributes as loaded (see with_dates)
+    ::parameter form: the submitted edit form
+    ::returns dict of attribute: new value, None meaning it's been cleared. continuous
+               is an int, as the importer stores it and the templates compare it. """
+    changed = {}
+    for column in EDITABLE:
+        value = _form_value(form.get(column))
+        if value != _form_value(project.get(column)):
+            changed[column] = int(value) if column == "continuous" and value else value
+    return changed
+
+
+def split_memo(project, threshold=MEMO_THRESHOLD):
+    """ Take large memoranda out of a project, to be stored out of line. The project
+    is left with memo_size, their length, in place of memoranda.
+    ::parameter project: dict of project attributes, updated in place
+    ::parameter threshold: most bytes of memoranda to leave in the project
+    ::returns the compressed memoranda, or None if they're small enough to stay """
+    memo = project.get('memoranda')
+    if not isinstance(memo, str):
+        return None
+    data = memo.encode("utf-8")
+    if len(data) <= threshold:
+        return None
+    del project['memoranda']
+    project['memo_size'] = len(memo)
+    return zlib.compress(data)
+
+
+def unsplit_memo(body):
+    """ Memoranda back from their compressed, out of line form
+    ::parameter body: bytes (or dynamodb Binary) from split_memo, or None
+    ::returns string, or None """
+    if body is None:
+        return None
+    return zlib.decompress(bytes(body)).decode("utf-8")
+
+
+def stat_counters(project):
+    """ The stats counters a project counts towards: "status:<its status>", and for a
+    done project, "done:<YYYY-MM>" for the month it was done in
+    ::parameter project: dict of project attributes. Its status attribute is used if
+                         it has one, as the dates it's worked out from may not be there.
+    ::returns list of counter names """
+    status = project.get('status') or project_status(project)
+    names = ["status:" + status]
+    if status == "done":
+        names.append("done:" + str(project['done'])[:7])
+    return names
+
+
+def count_changes(before, after):
+    """ How the stats counters move when a project is written
+    ::parameter before: the project as it was, or None if it's new
+    ::parameter after: the project as it is now, or None if it's gone
+    ::returns dict of counter name: change, leaving out any that don't change """
+    changes_by_name = collections.Counter()
+    for name in stat_counters(before) if before else []:
+        changes_by_name[name] -= 1
+    for name in stat_counters(after) if after else []:
+        changes_by_name[name] += 1
+    return {name: change for name, change in changes_by_name.items() if change}
+
+
+def counter_update(counts):
+    """ update_item parameters to apply changes to the stats counters on the dynamodb
+    counter item. ADD is atomic, so writers running at once don't lose counts.
+    ::parameter counts: dict of counter name: change, see count_changes
+    ::returns dict of update_item parameters """
+    names = {}
+    values = {}
+    for position, (name, change) in enumerate(counts.items()):
+        names[f"#c{position}"] = name
+        values[f":c{position}"] = change
+    return {'Key': {'number': COUNTER_NUMBER},
+            'UpdateExpression': "ADD " + ", ".join(f"#c{position} :c{position}"
+                                                   for position in range(len(counts))),
+            'ExpressionAttributeNames': names,
+            'ExpressionAttributeValues': values}
@@ -7,9 +7,24 @@
 #
 import datetime
 import operator
-from flask import Flask, flash, redirect, render_template, request, url_for
-from boto3.dynamodb.conditions import Key, Attr
+import os
+import sys
+import click
+from flask import (Flask, g, jsonify, redirect, render_template, request,
+                   stream_template, url_for)
+from jinja2 import FileSystemBytecodeCache
+import bulk
 import database
+import export
+import lazy
+import metrics
+import model
+import replica
+import search
+import stats
+
+# Only imported if the app runs on dynamodb, see lazy.py
+conditions = lazy.Module("boto3.dynamodb.conditions")
 
 
 # MEMO On Data
@@ -39,10 +54,21 @@ app = Flask('projects')
 
 # Load the config file
 app.config.from_pyfile('projects.cfg')
+# Any setting can be overridden from the environment, e.g. FLASK_DBTYPE=sqlite3
+app.config.from_prefixed_env()
+
+# Keep compiled templates on disk, so a new worker loads them rather than compiling
+# them again. This has to be set up before anything uses app.jinja_env.
+if app.config.get('TEMPLATE_CACHE_PATH'):
+    os.makedirs(app.config['TEMPLATE_CACHE_PATH'], exist_ok=True)
+    app.jinja_options = dict(app.jinja_options, bytecode_cache=FileSystemBytecodeCache(
+        app.config['TEMPLATE_CACHE_PATH']))
 
 with app.app_context():
     # Set the DB type into G so we can access from the database functions module
     database.init_app(app)
+    replica.init_app(app)
+    metrics.init_app(app)
 
 
 # bp = Blueprint("test", 'projects')
@@ -51,14 +77,13 @@ with app.app_context():
 
 @app.template_filter()
 def format_datetime(datestring, fmt='standard'):
-    """ Display date formatter, for jinja2 template use
+    """ Display date formatter, for jinja2 template use. Rows from the database
+    already carry their display dates (see model.with_dates), so this is only for
+    the odd raw value
     :parameters datestring (a standard date string), fmt (optional) - standard (only one currently)
     """
-
-    if datestring:
-        datestring = datetime.datetime.strptime(datestring, "%Y-%m-%dT%H:%M")
-        if fmt == 'standard':
-            return datetime.datetime.strftime(datestring, "%a, %d %b, %Y, %I:%M %p")
+    if fmt == 'standard':
+        return model.parse_date(datestring)[1]
     return "-"
 
 
@@ -71,176 +96,498 @@ def hello():
 @app.route("/")
 def home():
     """ Main index page, also show a list of currently active projects for focus """
-    db = database.get_db()
-    if app.config["DBTYPE"] == "sqlite3":
-        projects = db.execute("""select number,idea,created,started_on from projects
-                            where started_on is not NULL and ( done='0' or done is NULL )
-                            order by started_on""").fetchall()
-    else:
-        projects = db.scan(
-            FilterExpression=Attr('started_on').exists() & ~Attr('done').exists()
-        )
-        projects = sorted(projects['Items'], key=operator.itemgetter('number'))
+    columns = ("number", "idea", "created", "started_on")
+
+    def load():
+        db = replica.get_read_db()
+        if replica.read_type() == "sqlite3":
+            return db.execute(f"""select {','.join(columns)} from projects
+                            where status = 'active' order by started_on""").fetchall()
+        return database.query_status(db, "active", columns)
+
+    projects = database.cached(("active",), {"active"}, load)
     return render_template("index.html.j2", title="Currently Active", projects=projects)
 
 
 @app.route("/paused")
 def paused():
     """ Projects that have been stopped but not completed """
-    db = database.get_db()
-    if app.config["DBTYPE"] == "sqlite3":
-        projects = db.execute("""select number,idea,created,started_on,stopped_on,done
+    columns = ("number", "idea", "created", "started_on", "stopped_on")
+
+    def load():
+        db = replica.get_read_db()
+        if replica.read_type() == "sqlite3":
+            return db.execute(f"""select {','.join(columns)}
                         from projects
-                        where started_on is not NULL and stopped_on is not NULL 
-                        and done is NULL order by started_on""").fetchall()
-    else:
-        projects = db.scan(
-            FilterExpression=Attr('started_on').exists() & Attr('stopped_on').exists()
-                             & ~Attr('done').exists()
-        )
-        projects = sorted(projects['Items'], key=operator.itemgetter('stopped_on'))
-    return render_template("list.html.j2", title="Paused", projects=projects)
+                        where status = 'paused' order by stopped_on""").fetchall()
+        return database.query_status(db, "paused", columns)
+
+    projects = database.cached(("paused",), {"paused"}, load)
+    return render_template("list.html.j2", title="Paused", projects=projects, columns=columns)
 
 
 @app.route("/todo")
 def todo():
-    """ Projects that are not done yet """
-    db = database.get_db()
-    if app.config["DBTYPE"] == "sqlite3":
-        projects = db.execute("""select number,idea,created,started_on,stopped_on,done
-                        from projects
-                        where done is NULL order by number""").fetchall()
-    else:
-        projects = db.scan(
-            FilterExpression=Attr('done').not_exists()
-        )
-        projects = sorted(projects['Items'], key=operator.itemgetter('number'))
+    """ Projects that haven't been started yet, a page at a time """
     columns = ("number", "idea", "created", "continuous")
-    return render_template("list.html.j2", title="To Do", projects=projects, columns=columns)
+
+    def load():
+        db = replica.get_read_db()
+        after = database.decode_cursor(request.args.get("after"))
+        if replica.read_type() == "sqlite3":
+            # Ask for one more than a page, so we know if there's a next page
+            return database.Page(
+                db.execute(f"""select {','.join(columns)}
+                        from projects
+                        where status = 'todo' and number > ?
+                        order by number limit ?""",
+                           (after or 0, app.config["PAGE_SIZE"] + 1)),
+                app.config["PAGE_SIZE"], operator.itemgetter('number'))
+        return database.query_status_page(db, "todo", columns, after)
+
+    projects = database.cached(("todo", request.args.get("after")), {"todo"}, load)
+    return stream_template("list.html.j2", title="To Do", projects=projects, columns=columns)
 
 
 @app.route("/done")
 def done():
-    """ Projects that have been completed """
-    db = database.get_db()
-    if app.config["DBTYPE"] == "sqlite3":
-        projects = db.execute("""select number,idea,created,started_on,stopped_on,done
-                        from projects
-                        where (done is NOT NULL) order by done DESC""").fetchall()
-    else:
-        projects = db.scan(
-            FilterExpression=Attr('done').exists()
-        )
-        projects = sorted(projects['Items'], key=operator.itemgetter('done'), reverse=True)
+    """ Projects that have been completed, most recent first, a page at a time """
     columns = ("number", "idea", "created", "started_on", "stopped_on", "done")
-    return render_template("list.html.j2", title="Completed", projects=projects,
+
+    def load():
+        db = replica.get_read_db()
+        after = database.decode_cursor(request.args.get("after"))
+        if replica.read_type() == "sqlite3":
+            # Several projects can be done at the same time, so the cursor is (done, number)
+            if after:
+                rows = db.execute(f"""select {','.join(columns)}
+                            from projects
+                            where status = 'done' and (done, number) < (?, ?)
+                            order by done DESC, number DESC limit ?""",
+                                  (after[0], after[1], app.config["PAGE_SIZE"] + 1))
+            else:
+                rows = db.execute(f"""select {','.join(columns)}
+                            from projects
+                            where status = 'done'
+                            order by done DESC, number DESC limit ?""",
+                                  (app.config["PAGE_SIZE"] + 1,))
+            return database.Page(rows, app.config["PAGE_SIZE"],
+                                 operator.itemgetter('done', 'number'))
+        return database.query_status_page(db, "done", columns, after, newest_first=True)
+
+    projects = database.cached(("done", request.args.get("after")), {"done"}, load)
+    return stream_template("list.html.j2", title="Completed", projects=projects,
                            columns=columns)
 
 
 @app.route("/list")
 def getlist():
-    """ Return a rendering of a list of all items """
-    db = database.get_db()
-    if app.config["DBTYPE"] == "sqlite3":
-        projects = db.execute("""select number,idea,created,done from projects
-                               order by number""").fetchall()
-    else:
-        projects = db.scan()
-        projects = sorted(projects['Items'], key=operator.itemgetter('number'))
+    """ Return a rendering of a list of all items, a page at a time.
+    On dynamodb, this is in table order rather than by number, as sorting
+    would mean reading the whole table first """
     columns = ("number", "idea", "created", "done")
-    return render_template("list.html.j2", title="All", projects=projects, columns=columns)
+
+    def load():
+        db = replica.get_read_db()
+        after = database.decode_cursor(request.args.get("after"))
+        if replica.read_type() == "sqlite3":
+            return database.Page(
+                db.execute(f"""select {','.join(columns)} from projects
+                       where number > ? order by number limit ?""",
+                           (after or 0, app.config["PAGE_SIZE"] + 1)),
+                app.config["PAGE_SIZE"], operator.itemgetter('number'))
+        # Skipping the counter item, which isn't a project
+        return database.read_page(db.scan, after,
+                                  FilterExpression=conditions.Attr('status').exists(),
+                                  **database.projection(columns))
+
+    projects = database.cached(("all", request.args.get("after")), {"all"}, load)
+    return stream_template("list.html.j2", title="All", projects=projects, columns=columns)
 
 
 @app.route("/habits")
 def gethabits():
     """ Return a rendering of a list of all items marked continuous and not done """
-    db = database.get_db()
-    if app.config["DBTYPE"] == "sqlite3":
-        projects = db.execute("""select number,idea,created from projects
-                               where continuous = 1 order by number""").fetchall()
-    else:
-        projects = db.scan(
-            FilterExpression=Attr('continuous').eq(1)
-        )
-        projects = sorted(projects['Items'], key=operator.itemgetter('number'))
     columns = ("number", "idea", "created", "continuous")
+
+    def load():
+        db = replica.get_read_db()
+        if replica.read_type() == "sqlite3":
+            return db.execute(f"""select {','.join(columns)} from projects
+                               where status = 'habit' order by number""").fetchall()
+        return database.query_status(db, "habit", columns)
+
+    projects = database.cached(("habit",), {"habit"}, load)
     return render_template("list.html.j2", title="Habits", projects=projects, columns=columns)
 
 
+@app.route("/timeline")
+def timeline():
+    """ Projects created, started or done between two dates, oldest first, a page at
+    a time. It reads an index on that date, so it takes as long as there are
+    projects in the range, however many there are outside it. """
+    columns = ("number", "idea", "created", "started_on", "done")
+    column = request.args.get("on")
+    if column not in model.TIMELINE_COLUMNS:
+        column = "done"
+    # Each date pages through an index of its own, so its cursors only work for it
+    g.cursor_view = f"timeline-{column}"
+    today = datetime.date.today()
+    try:
+        last = datetime.date.fromisoformat(request.args.get("to") or today.isoformat())
+        first = (datetime.date.fromisoformat(request.args["from"]) if request.args.get("from")
+                 else last - datetime.timedelta(days=app.config["TIMELINE_DAYS"]))
+    except ValueError:
+        show_message("Dates should look like 2024-12-31.")
+        last = today
+        first = last - datetime.timedelta(days=app.config["TIMELINE_DAYS"])
+    # From the start of the first day up to, but not including, the day after the last
+    start = f"{first.isoformat()}T00:00"
+    end = f"{(last + datetime.timedelta(days=1)).isoformat()}T00:00"
+
+    def load():
+        db = replica.get_read_db()
+        after = database.decode_cursor(request.args.get("after"))
+        if replica.read_type() == "sqlite3":
+            after = after or ("", 0)
+            # Only done projects have a done date, so that one reads the done view's index
+            done_only = "and status = 'done'" if column == "done" else ""
+            return database.Page(
+                db.execute(f"""select {','.join(columns)} from projects
+                        where {column} >= ? and {column} < ? {done_only}
+                        and ({column}, number) > (?, ?)
+                        order by {column}, number limit ?""",
+                           (start, end, after[0], after[1], app.config["PAGE_SIZE"] + 1)),
+                app.config["PAGE_SIZE"], operator.itemgetter(column, 'number'))
+        return database.query_timeline_page(db, column, (start, end), columns, after)
+
+    projects = database.cached(("timeline", column, start, end, request.args.get("after")),
+                               {"all"}, load)
+    return stream_template("timeline.html.j2", title=f"{column} {first} to {last}",
+                           projects=projects, columns=columns, on=column, first=first,
+                           last=last, timeline_columns=model.TIMELINE_COLUMNS)
+
+
+@app.route("/search")
+def find():
+    """ Projects matching a search, best match first """
+    text = request.args.get("q", "")
+    projects = search.search(text, app.config["SEARCH_LIMIT"])
+    return render_template("list.html.j2", title=f"Search for '{text}'", projects=projects,
+                           columns=search.RESULT_COLUMNS)
+
+
+@app.cli.command("search-index")
+def search_index():
+    """ Rebuild the search index, e.g. after importing straight into the database """
+    search.rebuild()
+
+
+@app.route("/stats")
+def show_stats():
+    """ Counts of projects in each status and done each month, see stats.py """
+    return render_template("stats.html.j2", title="Stats", stats=stats.read())
+
+
+@app.route("/stats.json")
+def stats_json():
+    """ The same stats as /stats, as json """
+    return jsonify(stats.read())
+
+
+@app.cli.command("stats-reconcile")
+def stats_reconcile():
+    """ Recount the stats counters from every project, in case they've drifted """
+    stats.reconcile()
+
+
+@app.cli.command("reindex")
+def reindex():
+    """ Set the status and timeline index keys on every dynamodb project that hasn't
+    got them, e.g. after adding the status and timeline indexes (see
+    data-import/db_init.yaml) to an existing table. The stats can't have counted
+    projects that had no status, so they're recounted afterwards. """
+    if app.config["DBTYPE"] == "dynamodb":
+        updated = database.reindex(database.get_db())
+        if updated:
+            stats.reconcile()
+        click.echo(f"Updated {updated} projects.", err=True)
+
+
+@app.cli.command("export")
+@click.argument("filename", default="-")
+@click.option("--format", "fmt", type=click.Choice(export.FORMATS), default="csv",
+              help="csv, as the importer reads, or json lines")
+@click.option("--since", help="only projects modified since this date, e.g. the last "
+                              "export's watermark")
+def export_projects(filename, fmt, since):
+    """ Export projects to FILENAME, or to standard output """
+    if since:
+        # Checked here, as anything else would be compared with last_modified as text
+        try:
+            since = datetime.datetime.fromisoformat(since).strftime(model.STORED_DATE_FORMAT)
+        except ValueError as error:
+            raise click.BadParameter(f"should be an ISO date such as 2024-12-31T09:30, "
+                                     f"not {since!r}", param_hint="--since") from error
+    else:
+        since = None
+    if filename == "-":
+        count, newest = export.write(sys.stdout, export.projects(since), fmt)
+    else:
+        with open(filename, "w", newline="", encoding="utf-8") as out:
+            count, newest = export.write(out, export.projects(since), fmt)
+    click.echo(f"Exported {count} projects. Watermark for next time: --since {newest or since}",
+               err=True)
+
+
+@app.cli.command("replica-sync")
+@click.option("--full", is_flag=True, help="read everything, and drop anything that's gone")
+def replica_sync(full):
+    """ Bring the dynamodb read replica up to date now, e.g. after an import """
+    if replica.enabled():
+        click.echo(f"Read {replica.sync_now(full)} projects.", err=True)
+
+
+@app.cli.command("compile-templates")
+def compile_templates():
+    """ Compile every template into TEMPLATE_CACHE_PATH, e.g. when deploying, so
+    even the first worker to start has them ready """
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    click.echo(f"Compiled {len(names)} templates into {app.config['TEMPLATE_CACHE_PATH']}",
+               err=True)
+
+
+def bulk_numbers(numbers, status, on, before):
+    """ The projects a bulk edit is for: the numbers given, or those selected by
+    status and date, see bulk.select
+    ::returns list of project numbers
+    ::raises ValueError if they're not given one way or the other """
+    if numbers is not None:
+        if status is not None:
+            raise ValueError("Give either numbers or a status to select by, not both")
+        return [int(number) for number in numbers]
+    if status is None:
+        raise ValueError("Give either numbers or a status to select by")
+    return bulk.select(status, on or "created", before)
+
+
+@app.route("/bulk", methods=("POST",))
+def bulk_edit():
+    """ Make one change to many projects, see bulk.py. Takes json:
+        {"set": {attribute: value, ...}, and either "numbers": [n, ...],
+         or "status": status, "on": date attribute, "before": date}
+    and returns the result for each project, and how many had each. """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("set"), dict):
+        return jsonify({'error': "Expected a json object with a set object"}), 400
+    try:
+        change = bulk.parse_change(body["set"].items())
+        numbers = bulk_numbers(body.get("numbers"), body.get("status"), body.get("on"),
+                               body.get("before"))
+    except (TypeError, ValueError) as error:
+        return jsonify({'error': str(error)}), 400
+    results = bulk.apply(numbers, change)
+    return jsonify({'results': results, 'summary': bulk.summary(results)})
+
+
+@app.cli.command("bulk-edit")
+@click.option("--set", "pairs", multiple=True, required=True, metavar="ATTRIBUTE=VALUE",
+              help=f"what to change, any of {', '.join(model.BULK_EDITABLE)}; a date "
+                   "can be now, and a blank value clears it. Can be given more than once.")
+@click.option("--numbers", help="comma separated project numbers")
+@click.option("--status", type=click.Choice(model.STATUSES),
+              help="pick every project in this status...")
+@click.option("--on", type=click.Choice(bulk.SELECT_COLUMNS), default="created",
+              help="...with this date (default created)...")
+@click.option("--before", help="...before this one")
+def bulk_edit_command(pairs, numbers, status, on, before):
+    """ Make one change to many projects, e.g. mark every project started before
+    2020 as done: --set done=now --status active --on started_on --before 2020-01-01 """
+    try:
+        change = bulk.parse_change(pair.partition("=")[::2] for pair in pairs)
+        numbers = bulk_numbers(numbers.split(",") if numbers else None, status, on, before)
+    except ValueError as error:
+        raise click.BadParameter(str(error)) from error
+    results = bulk.apply(numbers, change)
+    for result in results:
+        if result['result'] != "updated":
+            click.echo(f"{result['number']}: {result['result']}", err=True)
+    click.echo(", ".join(f"{count} {result}" for result, count in bulk.summary(results).items()),
+               err=True)
+
+
+@app.route("/replica")
+def replica_status():
+    """ How far behind dynamodb the read replica is, as json """
+    return jsonify(replica.status())
+
+
+@app.route("/metrics")
+def show_metrics():
+    """ Timings from metrics.py, with the read cache and replica figures, for Prometheus """
+    gauges = {f"projects_cache_{name}": value for name, value in database.cache_stats().items()}
+    lag = replica.status().get('lag')
+    if lag is not None:
+        gauges['projects_replica_lag_seconds'] = lag
+    return app.response_class(metrics.render(gauges), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route("/cache")
+def cache():
+    """ Read cache hit and miss counters, as json """
+    return jsonify(database.cache_stats())
+
+
 @app.route("/project/<num>")
 def show_project(num):
     """ Return a rendering of a specific project item """
-    db = database.get_db()
-    if app.config["DBTYPE"] == "sqlite3":
-        project = db.execute("""select number,idea,created,done,memoranda,last_modified,
-                             started_on,stopped_on,continuous,links
-                             from projects where number = ?""", (num,)).fetchone()
-        return render_template("project.html.j2", title=project['idea'], project=project)
+    db = replica.get_read_db()
+    if replica.read_type() == "sqlite3":
+        project = db.execute("""select p.number,p.idea,p.created,p.done,t.memoranda,p.last_modified,
+                             p.started_on,p.stopped_on,p.continuous,p.links
+                             from projects p join projects_text t on t.number = p.number
+                             where p.number = ?""", (num,)).fetchone()
+        return render_template("project.html.j2", title=project['idea'],
+                               project=model.with_dates(project))
     else:
         project = db.query(
-            KeyConditionExpression=Key('number').eq(int(num))
+            KeyConditionExpression=conditions.Key('number').eq(int(num))
         )
-        project = project['Items']
-        return render_template("project.html.j2", title=project[0]['idea'], project=project[0])
+        project = database.load_memoranda(project['Items'][0])
+        return render_template("project.html.j2", title=project['idea'],
+                               project=model.with_dates(project))
+
+
+def show_message(message):
+    """ Show a message at the top of the page this request renders. Unlike flash it's
+    kept in the request rather than the session, so it doesn't need a SECRET_KEY,
+    but it's only shown if the page is rendered straight away, not after a redirect.
+    ::parameter message: text to show """
+    g.setdefault('messages', []).append(message)
+
+
+def validate(form):
+    """ Check a submitted project form
+    ::parameter form: request.form
+    ::returns error message, or None if it's fine """
+    if not form.get("idea"):
+        return "Idea is required."
+    return None
+
+
+@app.route("/project/new", methods=("GET", "POST"))
+def new_project():
+    """ Add a new project using the same form as editing one. sqlite3 numbers it
+    with AUTOINCREMENT; dynamodb from the counter item, see database.next_number """
+    dtnow = datetime.datetime.strftime(datetime.datetime.now(), "%Y-%m-%dT%H:%M")
+    if request.method == "POST":
+        error = validate(request.form)
+        if error is not None:
+            show_message(error)
+        else:
+            db = database.get_db()
+            # Everything filled in, and when it was created unless that was given
+            project = {'created': dtnow, 'last_modified': dtnow}
+            project.update(model.changes({}, request.form))
+            if app.config["DBTYPE"] == "sqlite3":
+                num = database.insert_project_row(db, project)
+            else:
+                # A project put in some other way can have the next number already,
+                # so that one's skipped
+                written = False
+                while not written:
+                    project['number'] = num = database.next_number(db)
+                    model.add_timeline(model.add_status(project))
+                    stored = dict(project)
+                    written = database.insert_project(db, stored)
+                # sqlite3 has triggers for these
+                search.update(project)
+                stats.count(None, stored)
+                replica.apply(project)
+
+            database.invalidate(model.project_status(project))
+            return redirect(url_for("show_project", num=num))
+
+    return render_template("edit.html.j2", title="New Project", project={}, dtnow=dtnow)
+
+
+def save_edit(project, changed, expected):
+    """ Write what an edit changed, if nobody else has saved the project since it was
+    loaded, see edit_project
+    ::parameter project: the project as loaded (see model.with_dates)
+    ::parameter changed: dict of attribute: new value, see model.changes
+    ::parameter expected: the last_modified it was loaded with
+    ::returns True if written, False if it had been changed in the meantime """
+    db = database.get_db()
+    # Blank items are None: NULL for sqlite3, and removed for dynamodb.
+    if app.config["DBTYPE"] == "sqlite3":
+        return database.update_project_row(db, project['number'], changed, expected)
+
+    # Keep the status and timeline indexes up to date. SQLite needs neither.
+    merged = model.add_timeline(model.add_status(dict(project, **changed)))
+    for column in model.DERIVED_COLUMNS:
+        if merged.get(column) != project.get(column):
+            changed[column] = merged.get(column)
+    written = database.update_project(db, project, changed, expected)
+    if written:
+        # sqlite3 has triggers for these
+        search.update(merged)
+        stats.count(project, merged)
+        replica.apply(merged)
+    return written
 
 
 @app.route("/project/<num>/edit", methods=("GET", "POST"))
 def edit_project(num):
     """ Edit a specific project entry using a rendered form and handle
-    updating the relevant datastore with the form input """
+    updating the relevant datastore with the form input.
+    Only what's changed is written, and only if nobody else has saved the project
+    since the form was loaded, going by the last_modified it was loaded with.
+    That's why it reads from the database itself, never the dynamodb replica. """
     db = database.get_db()
     if app.config["DBTYPE"] == "sqlite3":
-        project = db.execute("""select number,idea,created,done,memoranda,last_modified,
-                                started_on,stopped_on,continuous,links
-                                from projects where number = ?""", (num,)).fetchone()
+        project = db.execute("""select p.number,p.idea,p.created,p.done,t.memoranda,p.last_modified,
+                                p.started_on,p.stopped_on,p.continuous,p.links
+                                from projects p join projects_text t on t.number = p.number
+                                where p.number = ?""", (num,)).fetchone()
     else:
         project = db.query(
-            KeyConditionExpression=Key('number').eq(int(num)),
+            KeyConditionExpression=conditions.Key('number').eq(int(num)),
             Select='ALL_ATTRIBUTES'
         )
-        project = project['Items'][0]
+        project = database.load_memoranda(project['Items'][0])
+    # As stored, so the write can check it's still the same
+    loaded_stamp = dict(project).get('last_modified')
+    project = model.with_dates(project)
 
     if request.method == "POST":
 
-        error = None
-
-        if not request.form["idea"]:
-            error = "Idea is required."
+        error = validate(request.form)
 
         if error is not None:
-            flash(error)
+            show_message(error)
         else:
-            db = database.get_db()
-            # Remember to convert empty items to NULL for sqlite3
-            # For dynamodb, we simply remove or don't add that entry.
-            if app.config["DBTYPE"] == "sqlite3":
-                db.execute(
-                    """UPDATE projects SET idea = ?, memoranda = ?, created = ?, done = ?, 
-                    last_modified = ?, started_on = ?, stopped_on = ?, continuous = ?, 
-                    links = ? where number = ?;""",
-                    (request.form["idea"], request.form["memoranda"],
-                     request.form["created"], convert_blank_to_null(request.form["done"]),
-                     convert_blank_to_null(request.form["last_modified"]),
-                     convert_blank_to_null(request.form["started_on"]),
-                     convert_blank_to_null(request.form["stopped_on"]), request.form["continuous"],
-                     request.form["links"], num)
-                )
-                db.commit()
-            else:
-                # Check for any empty items and don't add them to the key value store
-                # Add the number, which is the primary key first, as it's not stored in the
-                # form data.
-                my_items = {'number': int(num)}
-                for key, entry in request.form.items():
-                    if entry:
-                        my_items[key] = entry
-                db.put_item(
-                    Item=my_items
-                )
-
-            return redirect(url_for("show_project", num=num))
+            changed = model.changes(project, request.form)
+            expected = request.form.get("expected_modified") or None
+            written = True
+            if changed:
+                # Stamped here rather than taken from the form, so it's sure to change
+                changed['last_modified'] = model.modified_stamp(expected)
+                written = save_edit(project, changed, expected)
+
+            if written:
+                # Drop any cached list that showed this project before, or should now
+                database.invalidate(model.project_status(dict(project)),
+                                    model.project_status(request.form))
+                return redirect(url_for("show_project", num=num))
+            show_message("Someone else has saved this project since you started editing it, "
+                         "so your changes haven't been saved. Reload the page to see theirs, "
+                         "then make yours again.")
 
     return render_template("edit.html.j2", title="Editing", project=project,
+                           loaded_stamp=loaded_stamp,
                            dtnow=datetime.datetime.strftime(datetime.datetime.now(),
                                                             "%Y-%m-%dT%H:%M"))
 
@@ -0,0 +1,357 @@
+""" Replica.py:
+    A local sqlite copy of the dynamodb table, for the views to read from, so a page
+    view doesn't have to go all the way to dynamodb. It has the same schema as a
+    sqlite3 database (data-import/db_init.sql), so the sqlite3 queries read it as
+    they are; views ask read_type() which kind of query to run, and get_read_db()
+    for the connection.
+    Writes still go to dynamodb, and the app applies each one to the replica as
+    soon as it has gone in. Writes from anywhere else are picked up by a background
+    thread, which every REPLICA_SYNC_INTERVAL seconds pulls whatever has changed
+    since the last sync, going by last_modified. If the replica falls more than
+    REPLICA_MAX_LAG seconds behind (or hasn't been filled yet), reads go straight
+    to dynamodb until it catches up.
+    Only the sync sees writes made elsewhere, so a project deleted from dynamodb,
+    or imported with an old last_modified, only shows in the replica after a full
+    sync: "flask --app projects replica-sync --full". The others are found through
+    an index on last_modified (see model.MODIFIED_INDEX), so a sync reads only what's
+    changed. That means a write from elsewhere has to set the index's keys, as the
+    app and the importer do (see model.add_timeline), for a sync to see it.
+    """
+
+import datetime
+import os
+import threading
+import time
+from flask import current_app, g
+import database
+import lazy
+import model
+
+# Only imported if the app runs on dynamodb, see lazy.py
+conditions = lazy.Module("boto3.dynamodb.conditions")
+
+# The replica's schema is the sqlite3 one
+SCHEMA_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data-import",
+                          "db_init.sql")
+
+# A write made elsewhere can be stamped a little before it lands, e.g. by a slow
+# writer or a clock that's behind, so each sync goes back this far past the
+# newest last_modified the last one saw
+OVERLAP = datetime.timedelta(minutes=5)
+
+# Changes pulled by a sync overwrite what's there unless it's newer, so a sync that
+# read a project before the app wrote it doesn't put the old version back
+UPSERT_SQL = """INSERT INTO projects (number, idea, created, done, started_on, stopped_on,
+             continuous, links, memoranda, last_modified)
+             VALUES (:number, :idea, :created, :done, :started_on, :stopped_on,
+             :continuous, :links, :memoranda, :last_modified)
+             ON CONFLICT (number) DO UPDATE SET
+             idea = excluded.idea, created = excluded.created, done = excluded.done,
+             started_on = excluded.started_on, stopped_on = excluded.stopped_on,
+             continuous = excluded.continuous, links = excluded.links,
+             memoranda = excluded.memoranda, last_modified = excluded.last_modified"""
+IF_NOT_NEWER = """
+             WHERE coalesce(excluded.last_modified, '') >= coalesce(projects.last_modified, '')"""
+
+# Per worker process: the replica's connection pool, the sync thread, and how
+# things stand, as status() reports it
+_pool = None
+_thread = None
+_state = {'synced_as_of': None, 'watermark': None, 'syncs': 0, 'fallbacks': 0,
+          'last_error': None}
+_lock = threading.Lock()
+
+
+def enabled():
+    """ True if reads should come from a replica: dynamodb, with REPLICA_PATH set """
+    return (current_app.config["DBTYPE"] == "dynamodb"
+            and bool(current_app.config.get("REPLICA_PATH")))
+
+
+def _get_pool():
+    """ The worker's pool of replica connections, creating the replica if need be """
+    global _pool  # pylint: disable=global-statement
+    with _lock:
+        if _pool is None:
+            pool = database.SQLitePool(current_app.config['REPLICA_PATH'],
+                                       current_app.config['SQLITE_POOL_SIZE'], "replica")
+            conn = pool.get()
+            if conn.execute("""select 1 from sqlite_master
+                            where type = 'table' and name = 'projects'""").fetchone() is None:
+                with open(SCHEMA_SQL, encoding="utf-8") as schema:
+                    conn.executescript(schema.read())
+            conn.execute("""CREATE TABLE IF NOT EXISTS replica_state (
+                         name TEXT PRIMARY KEY, value)""")
+            conn.commit()
+            pool.put(conn)
+            _pool = pool
+        return _pool
+
+
+def _start_sync():
+    """ Start the worker's sync thread, if it isn't going already """
+    global _thread  # pylint: disable=global-statement
+    with _lock:
+        if _thread is None:
+            app = current_app._get_current_object()  # pylint: disable=protected-access
+            _thread = threading.Thread(target=_run, args=(app,), name="replica-sync",
+                                       daemon=True)
+            _thread.start()
+
+
+def lag():
+    """ How far behind dynamodb the replica may be
+    ::returns seconds since the start of the last sync, or None if there hasn't been one """
+    if _state['synced_as_of'] is None:
+        return None
+    return time.time() - _state['synced_as_of']
+
+
+def read_type():
+    """ Which kind of database this request's reads go to: "sqlite3" if that's the
+    database, or it's dynamodb with a replica that's up to date enough; otherwise
+    "dynamodb". Decided once per request, so every read in it agrees.
+    ::returns "sqlite3" or "dynamodb" """
+    if "read_type" not in g:
+        g.read_type = current_app.config["DBTYPE"]
+        if enabled():
+            _start_sync()
+            behind = lag()
+            if behind is not None and behind <= current_app.config['REPLICA_MAX_LAG']:
+                g.read_type = "sqlite3"
+            else:
+                _state['fallbacks'] = _state['fallbacks'] + 1
+    return g.read_type
+
+
+def get_read_db():
+    """ The connection for this request's reads, see read_type. A replica
+    connection is borrowed from its pool, and handed back by close_replica. """
+    if read_type() == "sqlite3" and enabled():
+        if "replica_db" not in g:
+            g.replica_db = _get_pool().get()
+        return g.replica_db
+    return database.get_db()
+
+
+def close_replica(e=None):  # pylint: disable=unused-argument
+    """ If this request borrowed a replica connection, hand it back """
+    conn = g.pop("replica_db", None)
+    if conn is not None:
+        _get_pool().put(conn)
+
+
+def _row(item):
+    """ A dynamodb project as a replica row, memoranda and all """
+    row = {column: item.get(column) for column in model.CSV_COLUMNS}
+    for column in ("number", "continuous"):
+        if row[column] is not None:
+            row[column] = int(row[column])
+    return row
+
+
+def _store(conn, items, sql):
+    """ Write projects to the replica, in the caller's transaction. Large memoranda
+    go to the memoranda table, as on sqlite3, but only for rows sql has written. """
+    threshold = current_app.config['MEMO_THRESHOLD']
+    for item in items:
+        row = _row(item)
+        body = model.split_memo(row, threshold)
+        row.pop('memo_size', None)
+        row.setdefault('memoranda', None)
+        if not conn.execute(sql, row).rowcount:
+            continue
+        if body is None:
+            conn.execute("DELETE FROM memoranda WHERE number = ?", (row['number'],))
+        else:
+            conn.execute("""INSERT INTO memoranda (number, body) VALUES (?, ?)
+                         ON CONFLICT (number) DO UPDATE SET body = excluded.body""",
+                         (row['number'], body))
+
+
+def apply(project):
+    """ Copy a project the app has just written to dynamodb into the replica, so
+    the next read sees it without waiting for a sync
+    ::parameter project: the project as written, with its memoranda """
+    if not enabled():
+        return
+    pool = _get_pool()
+    conn = pool.get()
+    try:
+        _store(conn, [project], UPSERT_SQL)
+        conn.commit()
+    finally:
+        pool.put(conn)
+
+
+def apply_changes(changes):
+    """ As apply, for projects the app has only changed some attributes of, which
+    are all that's written. Memoranda can't be changed this way.
+    ::parameter changes: dict of number: {attribute: new value}, as written """
+    if not enabled():
+        return
+    pool = _get_pool()
+    conn = pool.get()
+    try:
+        for number, changed in changes.items():
+            row = {column: value for column, value in changed.items()
+                   if column in model.CSV_COLUMNS and column != 'memoranda'}
+            if row:
+                conn.execute(f"""UPDATE projects SET {', '.join(c + ' = ?' for c in row)}
+                             WHERE number = ?""", (*row.values(), int(number)))
+        conn.commit()
+    finally:
+        pool.put(conn)
+
+
+def _get_state(conn, name):
+    row = conn.execute("select value from replica_state where name = ?", (name,)).fetchone()
+    return None if row is None else row['value']
+
+
+def _set_state(conn, name, value):
+    conn.execute("""insert into replica_state (name, value) values (?, ?)
+                 on conflict (name) do update set value = excluded.value""", (name, value))
+
+
+def _sync_page(conn, items, full):
+    """ Write one page of a sync to the replica, and commit it """
+    _store(conn, items, UPSERT_SQL + IF_NOT_NEWER)
+    if full:
+        conn.executemany("INSERT OR IGNORE INTO seen (number) VALUES (?)",
+                         [(int(item['number']),) for item in items])
+    conn.commit()
+
+
+def _changed(table, since):
+    """ Projects modified since a given time, from model.MODIFIED_INDEX: a query on
+    each month from then to now, so a sync costs what's changed, not the size of
+    the table
+    ::parameter table: dynamodb table object
+    ::parameter since: ISO date string
+    ::returns generator of items """
+    # Running on a little, for writes stamped by a clock that's ahead
+    end = (datetime.datetime.now() + OVERLAP).strftime(model.STORED_DATE_FORMAT)
+    for month in model.months(since, end):
+        yield from database.iter_pages(
+            table.query, IndexName=model.MODIFIED_INDEX,
+            KeyConditionExpression=conditions.Key(model.MODIFIED_MONTH).eq(month)
+            & conditions.Key(model.MODIFIED_AT).gte(model.epoch(since)))
+
+
+def sync(conn, table, full=False):
+    """ Bring the replica up to date with dynamodb. Only projects modified since
+    the last sync (less OVERLAP) are read, unless it's a full sync or the first
+    one, which reads everything and also drops anything dynamodb no longer has.
+    Committed a page at a time.
+    ::parameter conn: replica connection
+    ::parameter table: dynamodb table object
+    ::parameter full: read everything, rather than just what's changed
+    ::returns how many projects were read """
+    started = time.time()
+    watermark = _get_state(conn, 'watermark')
+    full = full or watermark is None
+    if full:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS seen (number INTEGER PRIMARY KEY)")
+        conn.execute("DELETE FROM seen")
+        # Only projects have a status, which leaves out the counter item
+        items = database.iter_pages(table.scan,
+                                    FilterExpression=conditions.Attr('status').exists())
+    else:
+        since = datetime.datetime.fromisoformat(watermark) - OVERLAP
+        items = _changed(table, since.strftime(model.STORED_DATE_FORMAT))
+
+    count = 0
+    page = []
+    for item in items:
+        page.append(database.load_memoranda(item))
+        stamp = item.get('last_modified')
+        if stamp and (watermark is None or stamp > watermark):
+            watermark = stamp
+        if len(page) == current_app.config['PAGE_SIZE']:
+            _sync_page(conn, page, full)
+            count = count + len(page)
+            page = []
+    _sync_page(conn, page, full)
+    count = count + len(page)
+
+    if full:
+        conn.execute("DELETE FROM projects WHERE number NOT IN (SELECT number FROM seen)")
+        conn.execute("DELETE FROM memoranda WHERE number NOT IN (SELECT number FROM seen)")
+    _set_state(conn, 'watermark', watermark)
+    _set_state(conn, 'synced_as_of', started)
+    conn.commit()
+    with _lock:
+        _state.update(synced_as_of=started, watermark=watermark, syncs=_state['syncs'] + 1)
+    return count
+
+
+def sync_now(full=False):
+    """ Sync straight away, whether it's due or not, e.g. after an import
+    ::parameter full: read everything, rather than just what's changed
+    ::returns how many projects were read """
+    pool = _get_pool()
+    conn = pool.get()
+    try:
+        return sync(conn, database.get_db(), full)
+    finally:
+        pool.put(conn)
+
+
+def _claim(conn, interval):
+    """ Each worker has a sync thread, but one sync an interval is plenty, so the
+    first to get here each interval does it
+    ::returns True if it's this worker's turn """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        claimed = _get_state(conn, 'claimed')
+        if claimed is not None and now - claimed < interval:
+            return False
+        _set_state(conn, 'claimed', now)
+        return True
+    finally:
+        conn.commit()
+
+
+def sync_if_due():
+    """ Sync, unless another worker has started one within the interval. Either way,
+    pick up how far behind the replica is, as whichever worker synced it left it. """
+    interval = current_app.config['REPLICA_SYNC_INTERVAL']
+    pool = _get_pool()
+    conn = pool.get()
+    try:
+        if _claim(conn, interval):
+            sync(conn, database.get_db())
+        with _lock:
+            _state.update(synced_as_of=_get_state(conn, 'synced_as_of'),
+                          watermark=_get_state(conn, 'watermark'))
+    finally:
+        pool.put(conn)
+
+
+def _run(app):
+    """ The sync thread. A failed sync is recorded and tried again next interval,
+    while reads fall back to dynamodb once the replica is too far behind. """
+    while True:
+        with app.app_context():
+            try:
+                sync_if_due()
+                _state['last_error'] = None
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                _state['last_error'] = repr(error)
+            interval = app.config['REPLICA_SYNC_INTERVAL']
+        time.sleep(interval)
+
+
+def status():
+    """ How the replica is doing, for /replica
+    ::returns dict, with lag in seconds (None if it's never been synced) """
+    if not enabled():
+        return {'enabled': False}
+    return dict(_state, enabled=True, lag=lag())
+
+
+def init_app(app):
+    """ Register the replica's teardown with the Flask app """
+    app.teardown_appcontext(close_replica)
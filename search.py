@@ -0,0 +1,157 @@
+""" Search.py:
+    Full text search over a project's idea, memoranda and links.
+    On sqlite3 this is the projects_search FTS5 table, which triggers keep in step
+    with projects (see data-import/db_init.sql). Dynamodb has nothing of the kind,
+    so for that we keep the same sort of index in a local sqlite file, built once
+    from a scan and then updated by every write the app makes. A dynamodb read
+    replica has projects_search too, so while it's up to date, that's used.
+    """
+
+import os
+import re
+import sqlite3
+import threading
+from flask import current_app
+import database
+import model
+import replica
+
+# How much a match in idea, memoranda and links (in that order) counts for
+WEIGHTS = (10.0, 1.0, 0.5)
+
+# Attributes a search result shows
+RESULT_COLUMNS = ("number", "idea", "created", "status")
+
+# The local index for dynamodb. One connection per worker, shared by its threads.
+_index = None
+_index_lock = threading.Lock()
+
+
+def match_query(text):
+    """ Turn what was typed into the search box into an FTS5 query, in which every
+    word has to appear. FTS5 query syntax isn't passed through, so punctuation
+    can't cause a syntax error.
+    ::parameter text: search string
+    ::returns FTS5 MATCH expression, or None if there's nothing to search for """
+    words = re.findall(r"\w+", text or "")
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words)
+
+
+def _open_index(path):
+    """ Open (creating if need be) the local index for dynamodb
+    ::returns (connection, True if it was just created and so is empty) """
+    created = not os.path.exists(path)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    # rowid is the project number. Shown attributes are stored unindexed, so a
+    # search never has to go back to dynamodb.
+    conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(
+                    idea, memoranda, links, created UNINDEXED, status UNINDEXED,
+                    tokenize = 'porter unicode61')""")
+    return conn, created
+
+
+def _get_index():
+    """ The worker's connection to the local index, building the index from a full
+    scan of the table the first time round. After that it persists between runs. """
+    global _index  # pylint: disable=global-statement
+    with _index_lock:
+        if _index is None:
+            conn, created = _open_index(current_app.config['SEARCH_INDEX_PATH'])
+            if created:
+                _fill_index(conn, _scan_projects())
+            _index = conn
+        return _index
+
+
+def _scan_projects():
+    """ Every item in the dynamodb table, with any out of line memoranda put back """
+    memos = {memo['number']: memo['body']
+             for memo in database.scan_table(database.get_memo_table())}
+    items = database.scan_table(database.get_db())
+    for item in items:
+        if 'memo_size' in item:
+            item['memoranda'] = model.unsplit_memo(memos.get(item['number']))
+    return items
+
+
+def _index_rows(items):
+    """ Local index rows for dynamodb items, skipping anything that isn't a project """
+    for item in items:
+        if 'status' in item:
+            yield (int(item['number']), item.get('idea'), item.get('memoranda'),
+                   item.get('links'), item.get('created'), item['status'])
+
+
+def _fill_index(conn, items):
+    """ Replace the whole of the local index with the given items """
+    with conn:
+        conn.execute("DELETE FROM search")
+        conn.executemany("""INSERT INTO search(rowid, idea, memoranda, links, created, status)
+                         VALUES (?, ?, ?, ?, ?, ?)""", _index_rows(items))
+        conn.execute("INSERT INTO search(search) VALUES ('optimize')")
+
+
+def update(item):
+    """ Bring the local index up to date with a project that's just been written to
+    dynamodb. (Not needed for sqlite3, whose triggers do it.)
+    ::parameter item: the project as written """
+    conn = _get_index()
+    with _index_lock, conn:
+        conn.execute("DELETE FROM search WHERE rowid = ?", (int(item['number']),))
+        conn.executemany("""INSERT INTO search(rowid, idea, memoranda, links, created, status)
+                         VALUES (?, ?, ?, ?, ?, ?)""", _index_rows([item]))
+
+
+def update_shown(items):
+    """ As update, for projects whose searchable text hasn't changed, only what a
+    result shows of them: just those columns are rewritten
+    ::parameter items: the projects as written, with at least number, created and status """
+    conn = _get_index()
+    with _index_lock, conn:
+        conn.executemany("UPDATE search SET created = ?, status = ? WHERE rowid = ?",
+                         [(item.get('created'), item['status'], int(item['number']))
+                          for item in items])
+
+
+def rebuild():
+    """ Rebuild the search index from scratch, e.g. after an import """
+    if current_app.config["DBTYPE"] == "sqlite3":
+        db = database.get_db()
+        db.execute("INSERT INTO projects_search(projects_search) VALUES ('rebuild')")
+        db.commit()
+    else:
+        conn = _get_index()
+        items = _scan_projects()
+        with _index_lock:
+            _fill_index(conn, items)
+
+
+def search(text, limit):
+    """ Best matches for a search, best first
+    ::parameter text: search string, as typed
+    ::parameter limit: most results to return
+    ::returns list of rows with RESULT_COLUMNS """
+    query = match_query(text)
+    if query is None:
+        return []
+
+    if replica.read_type() == "sqlite3":
+        db = replica.get_read_db()
+        rows = db.execute(f"""select p.number,p.idea,p.created,p.status
+                         from projects_search s join projects p on p.number = s.rowid
+                         where projects_search match ?
+                         order by bm25(projects_search, {', '.join(map(str, WEIGHTS))})
+                         limit ?""", (query, limit)).fetchall()
+    else:
+        conn = _get_index()
+        with _index_lock:
+            rows = conn.execute(f"""select rowid as number,idea,created,status
+                             from search where search match ?
+                             order by bm25(search, {', '.join(map(str, WEIGHTS))})
+                             limit ?""", (query, limit)).fetchall()
+    return [model.with_dates(row) for row in rows]
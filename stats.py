@@ -0,0 +1,113 @@
+""" Stats.py:
+    Counts of projects in each status, and of projects done each month, for /stats.
+    They're kept as running counters rather than counted when asked for, so the
+    dashboard is one small read however many projects there are. On sqlite3,
+    triggers move them on every write (see data-import/db_init.sql). On dynamodb
+    they're attributes of the counter item, which every write that can change a
+    project's status moves with an atomic ADD (see model.counter_update).
+    Anything that writes without going through here (or dies part way) can leave
+    them out, so reconcile() puts them right from a full count.
+    """
+
+import collections
+from flask import current_app
+import database
+import model
+import replica
+
+# Most counters to set in one update_item when reconciling on dynamodb, to keep
+# well inside its expression size limits
+RECONCILE_BATCH = 50
+
+
+def count(before, after):
+    """ Move the counters for a project that's just been written to dynamodb.
+    (Not needed for sqlite3, whose triggers do it.)
+    ::parameter before: the project as it was, or None if it's new
+    ::parameter after: the project as written, or None if it's gone """
+    counts = model.count_changes(before, after)
+    if counts:
+        database.get_db().update_item(**model.counter_update(counts))
+
+
+def count_many(writes):
+    """ count, for many projects written at once, moving the counters with as few
+    updates as there are RECONCILE_BATCH counters that change
+    ::parameter writes: (before, after) for each project, as count takes them """
+    counts = collections.Counter()
+    for before, after in writes:
+        counts.update(model.count_changes(before, after))
+    counts = [(name, change) for name, change in counts.items() if change]
+    for start in range(0, len(counts), RECONCILE_BATCH):
+        database.get_db().update_item(
+            **model.counter_update(dict(counts[start:start + RECONCILE_BATCH])))
+
+
+def _counter_item(table):
+    """ The counters on the dynamodb counter item
+    ::returns dict of counter name: count """
+    item = table.get_item(Key={'number': model.COUNTER_NUMBER}).get('Item', {})
+    return {name: int(value) for name, value in item.items() if ":" in name}
+
+
+def _read_counters():
+    """ Every counter, in one read, from a dynamodb read replica if it's up to date
+    ::returns dict of counter name: count """
+    if replica.read_type() == "sqlite3":
+        db = replica.get_read_db()
+        return {row['name']: row['count']
+                for row in db.execute("select name, count from project_stats")}
+    return _counter_item(database.get_db())
+
+
+def read():
+    """ The stats for the dashboard
+    ::returns dict of 'statuses': {status: count} for every status, and
+              'done_per_month': {YYYY-MM: count}, newest month first """
+    counters = _read_counters()
+    months = sorted(((name.split(":", 1)[1], number) for name, number in counters.items()
+                     if name.startswith("done:") and number), reverse=True)
+    return {'statuses': {status: counters.get("status:" + status, 0)
+                         for status in model.STATUSES},
+            'done_per_month': dict(months)}
+
+
+def _count_projects(projects):
+    """ Counters worked out from scratch
+    ::parameter projects: every project, with at least status and done
+    ::returns dict of counter name: count """
+    counters = collections.Counter()
+    for project in projects:
+        if 'status' in project:
+            counters.update(model.stat_counters(project))
+    return counters
+
+
+def reconcile():
+    """ Recount everything and overwrite the counters with the result. Writes made
+    while this runs may be counted twice or not at all, so it's best run when
+    nothing else is writing.
+    ::returns dict of counter name: count, as now stored """
+    if current_app.config["DBTYPE"] == "sqlite3":
+        db = database.get_db()
+        counters = _count_projects(dict(row) for row in
+                                   db.execute("select status, done from projects"))
+        db.execute("delete from project_stats")
+        db.executemany("insert into project_stats (name, count) values (?, ?)",
+                       counters.items())
+        db.commit()
+        return dict(counters)
+
+    table = database.get_db()
+    counters = _count_projects(database.scan_table(
+        table, **database.projection(("number", "status", "done"))))
+    # None marks a counter nothing counts towards any more, to be removed
+    updates = list(counters.items()) + [(name, None) for name in _counter_item(table)
+                                        if name not in counters]
+    for start in range(0, len(updates), RECONCILE_BATCH):
+        expression, names, values = database.update_expression(
+            dict(updates[start:start + RECONCILE_BATCH]), "c")
+        kwargs = {'ExpressionAttributeValues': values} if values else {}
+        table.update_item(Key={'number': model.COUNTER_NUMBER}, UpdateExpression=expression,
+                          ExpressionAttributeNames=names, **kwargs)
+    return dict(counters)